@@ -0,0 +1,123 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Fixtures of the benchmark suite (requires pytest-benchmark):
+
+    $ pytest benchmarks
+    $ ESOCIAL_BENCH_STREAM=1000 pytest benchmarks --benchmark-group-by=group
+
+The size of the "stream" benchmarks is set by ESOCIAL_BENCH_STREAM (default 10000).
+"""
+import os
+import copy
+import tracemalloc
+
+from collections import OrderedDict
+
+import pytest
+
+import esocial
+
+from esocial import xml
+from esocial import client
+
+tests_dir = os.path.join(os.path.dirname(os.path.abspath(esocial.__file__)), 'tests')
+cert_file = os.path.join(tests_dir, 'certs', 'libesocial-cert-test.pfx')
+cert_passw = 'cert@test'
+
+BATCH_SIZE = 50
+STREAM_SIZE = int(os.environ.get('ESOCIAL_BENCH_STREAM', 10000))
+
+
+def sample_file(name):
+    return os.path.join(tests_dir, 'xml', name)
+
+
+def sample_event(evt='S-2220', signed=False):
+    file_name = '{}-v{}{}.xml'.format(evt, esocial.__esocial_version__, '' if signed else '-not_signed')
+    return xml.load_fromfile(sample_file(file_name))
+
+
+def localname(element):
+    return element.tag.split('}', 1)[-1]
+
+
+def element_tojson(element):
+    """The load_fromjson() structure of an element (the inverse of load_fromjson())."""
+    attrs = OrderedDict(element.attrib)
+    children = [child for child in element if isinstance(child.tag, str)]
+    if not children:
+        text = (element.text or '').strip()
+        if attrs:
+            return OrderedDict([('__ATTRS__', attrs), ('__VALUE__', text)])
+        return text
+    result = OrderedDict()
+    if attrs:
+        result['__ATTRS__'] = attrs
+    tags = [localname(child) for child in children]
+    if len(set(tags)) == len(tags):
+        for tag, child in zip(tags, children):
+            result[tag] = element_tojson(child)
+    else:
+        result['_'] = [{tag: element_tojson(child)} for tag, child in zip(tags, children)]
+    return result
+
+
+def event_tojson(event):
+    root = event.getroot()
+    root_json = element_tojson(root)
+    attrs = OrderedDict([('xmlns', root.nsmap[None])])
+    attrs.update(root_json.pop('__ATTRS__', {}))
+    root_json = OrderedDict([('__ATTRS__', attrs)] + list(root_json.items()))
+    return OrderedDict([(localname(root), root_json)])
+
+
+def make_events(n, evt='S-2220'):
+    base_event = sample_event(evt)
+    events = []
+    for i in range(n):
+        event = copy.deepcopy(base_event)
+        event.getroot()[0].set('Id', 'ID1123456780000002021091617310{:0>6}'.format(i))
+        events.append(event)
+    return events
+
+
+@pytest.fixture(scope='session')
+def ws():
+    employer_id = {
+        'tpInsc': 1,
+        'nrInsc': '12345678901234'
+    }
+    return client.WSClient(pfx_file=cert_file, pfx_passw=cert_passw, employer_id=employer_id, target=2)
+
+
+@pytest.fixture
+def signed_batch(ws):
+    # Not shared between tests: _make_send_envelop() moves the events into the envelop (unless skeleton=True)
+    return [ws.signer.sign(event) for event in make_events(BATCH_SIZE)]
+
+
+@pytest.fixture
+def memory(benchmark):
+    """Records the peak of memory allocated by the benchmarked code on extra_info['peak_memory_kb']."""
+    class Tracker(object):
+        def __call__(self, func, *args, **kwargs):
+            tracemalloc.start()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                benchmark.extra_info['peak_memory_kb'] = round(peak / 1024.0, 1)
+    return Tracker()
@@ -0,0 +1,99 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import io
+
+import pytest
+
+from lxml import etree
+
+from esocial import (
+    client,
+    xml,
+)
+
+from conftest import (
+    STREAM_SIZE,
+    make_events,
+)
+
+
+@pytest.mark.benchmark(group='send-envelop')
+def test_make_send_envelop(benchmark, memory, ws, signed_batch):
+    benchmark(memory, ws._make_send_envelop, 1, signed_batch)
+
+
+@pytest.mark.benchmark(group='send-envelop')
+def test_validate_send_envelop(benchmark, ws, signed_batch):
+    envelop = ws._make_send_envelop(1, signed_batch)
+    benchmark(ws.validate_envelop, 'send', envelop)
+
+
+def _serialize_envelop(ws, batch):
+    return etree.tostring(ws._make_send_envelop(1, batch))
+
+
+def _stream_envelop(ws, batch, events):
+    output = io.BytesIO()
+    xml.write_envelop(output, ws._make_send_envelop(1, batch, skeleton=True), events)
+    return output.getvalue()
+
+
+# tracemalloc (see the memory fixture) would hide the differences
+@pytest.mark.benchmark(group='send-serialize')
+def test_serialize_send_envelop(benchmark, ws, signed_batch):
+    benchmark(_serialize_envelop, ws, signed_batch)
+
+
+@pytest.mark.benchmark(group='send-serialize')
+def test_stream_send_envelop(benchmark, ws, signed_batch):
+    benchmark(_stream_envelop, ws, signed_batch, signed_batch)
+
+
+@pytest.mark.benchmark(group='send-serialize')
+def test_stream_send_envelop_serialized(benchmark, ws, signed_batch):
+    # Events signed by worker processes arrive serialized
+    serialized = [etree.tostring(event) for event in signed_batch]
+    benchmark(_stream_envelop, ws, signed_batch, serialized)
+
+
+def _validate_batch(ws, batch, validate, envelop):
+    if validate is not None:
+        for event in batch:
+            validate(event)
+    ws.validate_envelop('send', envelop)
+
+
+@pytest.mark.benchmark(group='batch-validation')
+@pytest.mark.parametrize('validation', [client.VALIDATE_FULL, client.VALIDATE_ONCE, client.VALIDATE_TRUST])
+def test_validate_batch_events(benchmark, ws, signed_batch, validation):
+    # What is validated for a batch: its events (already validated once, in
+    # VALIDATE_ONCE) and the envelop
+    validate = client._event_validator(validation, ws.esocial_version)
+    envelop = ws._make_send_envelop(1, signed_batch, skeleton=True)
+    _validate_batch(ws, signed_batch, validate, envelop)
+    benchmark(_validate_batch, ws, signed_batch, validate, envelop)
+
+
+@pytest.mark.benchmark(group='envelop-validation')
+@pytest.mark.parametrize('skeleton', [False, True], ids=['full', 'skeleton'])
+def test_validate_send_envelop_skeleton(benchmark, ws, signed_batch, skeleton):
+    envelop = ws._make_send_envelop(1, signed_batch, skeleton=skeleton)
+    benchmark(ws.validate_envelop, 'send', envelop)
+
+
+@pytest.mark.benchmark(group='sign-stream')
+def test_sign_events_stream(benchmark, memory, ws):
+    events = make_events(STREAM_SIZE)
+    benchmark.pedantic(memory, args=(ws.sign_events, events), kwargs={'workers': None}, rounds=1)
@@ -0,0 +1,132 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import copy
+import re
+import json
+
+import pytest
+
+from esocial import xml
+
+from conftest import (
+    BATCH_SIZE,
+    STREAM_SIZE,
+    event_tojson,
+    make_events,
+    sample_event,
+    sample_file,
+)
+
+
+@pytest.mark.benchmark(group='sign')
+def test_sign_pem(benchmark, ws):
+    pem_data = {'key_str': ws.cert_data['key_str'], 'cert_str': ws.cert_data['cert_str']}
+    event = sample_event()
+    benchmark.pedantic(xml.sign, args=(event, pem_data), rounds=3)
+
+
+@pytest.mark.benchmark(group='sign')
+def test_sign(benchmark, ws):
+    event = sample_event()
+    benchmark(xml.sign, event, ws.cert_data)
+
+
+@pytest.mark.benchmark(group='sign')
+def test_signer(benchmark, ws):
+    event = sample_event()
+    benchmark(ws.signer.sign, event)
+
+
+@pytest.mark.benchmark(group='sign-batch')
+def test_signer_batch(benchmark, memory, ws):
+    events = make_events(BATCH_SIZE)
+    benchmark(memory, ws.signer.sign_many, events)
+
+
+@pytest.mark.benchmark(group='validate')
+def test_validate(benchmark):
+    event = sample_event(signed=True)
+    benchmark(lambda: xml.XMLValidate(event).validate())
+
+
+@pytest.mark.benchmark(group='validate')
+def test_validate_uncached(benchmark):
+    event = sample_event(signed=True)
+
+    def validate():
+        xml.xsd_cache.clear()
+        xml.XMLValidate(event).validate()
+
+    benchmark(validate)
+
+
+@pytest.mark.benchmark(group='validate-batch')
+def test_validate_batch(benchmark, memory, signed_batch):
+    def validate():
+        for event in signed_batch:
+            xml.XMLValidate(event).validate()
+
+    benchmark(memory, validate)
+
+
+@pytest.mark.benchmark(group='load_fromjson')
+def test_load_fromjson(benchmark):
+    event_json = event_tojson(sample_event())
+    benchmark(xml.load_fromjson, event_json)
+
+
+@pytest.mark.benchmark(group='load_fromjson')
+def test_event_template_fill(benchmark):
+    # Same event of test_load_fromjson, setting every leaf value
+    event = sample_event()
+    template = xml.EventTemplate(event_tojson(event))
+    values = dict(
+        (re.sub(r'{[^}]*}', '', event.getelementpath(element)), element.text)
+        for element in event.getroot().iter()
+        if len(element) == 0 and element is not event.getroot()
+    )
+    benchmark(template.fill, values)
+
+
+@pytest.mark.benchmark(group='load_fromjson-stream')
+def test_load_fromjson_stream(benchmark, memory):
+    # JSON-lines with STREAM_SIZE events, converted one at a time
+    line = json.dumps(event_tojson(sample_event()))
+    lines = (line for i in range(STREAM_SIZE))
+
+    def load():
+        for xml_doc in xml.iterdump_fromjson(lines):
+            pass
+
+    benchmark.pedantic(memory, args=(load,), rounds=1)
+
+
+@pytest.mark.benchmark(group='decode_response')
+@pytest.mark.parametrize('decoder', [xml.decode_response, xml.parse_response], ids=['dotmap', 'dict'])
+@pytest.mark.parametrize('response_file', ['Batch_Response.xml', 'Retrieve_Response.xml'])
+def test_decode_response(benchmark, response_file, decoder):
+    response = xml.load_fromfile(sample_file(response_file)).getroot()
+    benchmark(decoder, response)
+
+
+@pytest.mark.benchmark(group='decode_response')
+@pytest.mark.parametrize('decoder', [xml.decode_response, xml.parse_response], ids=['dotmap', 'dict'])
+def test_decode_response_batch(benchmark, memory, decoder):
+    # Retrieve response with BATCH_SIZE events
+    response = xml.load_fromfile(sample_file('Retrieve_Response.xml')).getroot()
+    events = xml.find(response, 'retornoEventos')
+    for i in range(BATCH_SIZE - len(events)):
+        events.append(copy.deepcopy(events[0]))
+    benchmark(memory, decoder, response)
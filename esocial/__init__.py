@@ -102,4 +102,71 @@ _WS_URL_DOWN = {
 _TARGET_TPAMB = {
     '1': 'production',
     '2': 'tests'
-}
\ No newline at end of file
+}
+
+# Batch groups (envioLoteEventos/@grupo)
+_GROUP_TABLE = 1
+_GROUP_NON_PERIODIC = 2
+_GROUP_PERIODIC = 3
+
+# Event tag name: (event code, batch group)
+# Totalizer events (S-5xxx) are generated by eSocial and can't be sent.
+# S-3000 goes with the group of the event it excludes (infoExclusao/tpEvento).
+_EVENTS = {
+    # Table events
+    'evtInfoEmpregador': ('S-1000', _GROUP_TABLE),
+    'evtTabEstab': ('S-1005', _GROUP_TABLE),
+    'evtTabRubrica': ('S-1010', _GROUP_TABLE),
+    'evtTabLotacao': ('S-1020', _GROUP_TABLE),
+    'evtTabCargo': ('S-1030', _GROUP_TABLE),
+    'evtTabCarreira': ('S-1035', _GROUP_TABLE),
+    'evtTabFuncao': ('S-1040', _GROUP_TABLE),
+    'evtTabHorTur': ('S-1050', _GROUP_TABLE),
+    'evtTabAmbiente': ('S-1060', _GROUP_TABLE),
+    'evtTabProcesso': ('S-1070', _GROUP_TABLE),
+    'evtTabOperPort': ('S-1080', _GROUP_TABLE),
+    # Periodic events
+    'evtRemun': ('S-1200', _GROUP_PERIODIC),
+    'evtRmnRPPS': ('S-1202', _GROUP_PERIODIC),
+    'evtBenPrRP': ('S-1207', _GROUP_PERIODIC),
+    'evtPgtos': ('S-1210', _GROUP_PERIODIC),
+    'evtAqProd': ('S-1250', _GROUP_PERIODIC),
+    'evtComProd': ('S-1260', _GROUP_PERIODIC),
+    'evtContratAvNP': ('S-1270', _GROUP_PERIODIC),
+    'evtInfoComplPer': ('S-1280', _GROUP_PERIODIC),
+    'evtTotConting': ('S-1295', _GROUP_PERIODIC),
+    'evtReabreEvPer': ('S-1298', _GROUP_PERIODIC),
+    'evtFechaEvPer': ('S-1299', _GROUP_PERIODIC),
+    'evtContrSindPatr': ('S-1300', _GROUP_PERIODIC),
+    # Non periodic events
+    'evtAdmPrelim': ('S-2190', _GROUP_NON_PERIODIC),
+    'evtAdmissao': ('S-2200', _GROUP_NON_PERIODIC),
+    'evtAltCadastral': ('S-2205', _GROUP_NON_PERIODIC),
+    'evtAltContratual': ('S-2206', _GROUP_NON_PERIODIC),
+    'evtCAT': ('S-2210', _GROUP_NON_PERIODIC),
+    'evtMonit': ('S-2220', _GROUP_NON_PERIODIC),
+    'evtToxic': ('S-2221', _GROUP_NON_PERIODIC),
+    'evtAfastTemp': ('S-2230', _GROUP_NON_PERIODIC),
+    'evtCessao': ('S-2231', _GROUP_NON_PERIODIC),
+    'evtExpRisco': ('S-2240', _GROUP_NON_PERIODIC),
+    'evtTreiCap': ('S-2245', _GROUP_NON_PERIODIC),
+    'evtAvPrevio': ('S-2250', _GROUP_NON_PERIODIC),
+    'evtConvInterm': ('S-2260', _GROUP_NON_PERIODIC),
+    'evtReintegr': ('S-2298', _GROUP_NON_PERIODIC),
+    'evtDeslig': ('S-2299', _GROUP_NON_PERIODIC),
+    'evtTSVInicio': ('S-2300', _GROUP_NON_PERIODIC),
+    'evtTSVAltContr': ('S-2306', _GROUP_NON_PERIODIC),
+    'evtTSVTermino': ('S-2399', _GROUP_NON_PERIODIC),
+    'evtCdBenefIn': ('S-2400', _GROUP_NON_PERIODIC),
+    'evtCdBenPrRP': ('S-2400', _GROUP_NON_PERIODIC),
+    'evtCdBenefAlt': ('S-2405', _GROUP_NON_PERIODIC),
+    'evtCdBenIn': ('S-2410', _GROUP_NON_PERIODIC),
+    'evtCdBenAlt': ('S-2416', _GROUP_NON_PERIODIC),
+    'evtReativBen': ('S-2418', _GROUP_NON_PERIODIC),
+    'evtCdBenTerm': ('S-2420', _GROUP_NON_PERIODIC),
+    'evtProcTrab': ('S-2500', _GROUP_NON_PERIODIC),
+    'evtContProc': ('S-2501', _GROUP_NON_PERIODIC),
+    'evtExclusao': ('S-3000', None),
+    'evtExcProcTrab': ('S-3500', _GROUP_NON_PERIODIC),
+    'evtBaixa': ('S-8299', _GROUP_NON_PERIODIC),
+}
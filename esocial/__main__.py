@@ -0,0 +1,56 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Command line utilities.
+
+    $ python -m esocial refresh-wsdl --pfx my_cert.pfx [--target tests] [--path /my/cache/dir]
+"""
+import os
+import sys
+import getpass
+import argparse
+
+from esocial import client
+
+
+def refresh_wsdl(args):
+    pfx_passw = os.environ.get('ESOCIAL_PFX_PASSW') or getpass.getpass('Certificate password: ')
+    urls = client.refresh_wsdl_cache(
+        args.pfx,
+        pfx_passw,
+        path=args.path,
+        target=args.target,
+    )
+    for url in urls:
+        print(url)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m esocial')
+    commands = parser.add_subparsers(dest='command')
+    refresh = commands.add_parser('refresh-wsdl', help='Download the webservices WSDLs to the local cache')
+    refresh.add_argument('--pfx', required=True, help='A1 certificate file (PKCS#12)')
+    refresh.add_argument('--target', default=None, help='tests, production, 1 or 2 (default: both)')
+    refresh.add_argument('--path', default=None, help='Cache directory (default: ~/.cache/esocial/wsdl)')
+    refresh.set_defaults(func=refresh_wsdl)
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.print_help()
+        return 1
+    args.func(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,92 +13,310 @@
 # limitations under the License.
 # ==============================================================================
 import os
-import datetime
+import functools
+import threading
 
-import requests
-
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.ssl_ import create_urllib3_context
+from collections import OrderedDict
+from concurrent.futures import (
+    ALL_COMPLETED,
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
 
 import esocial
 
 from esocial import xml
+from esocial.eventid import EventIdGenerator
 from esocial.utils import (
     format_xsd_version,
-    pkcs12_data,
-    encrypt_pem_file,
+    certificate_store,
 )
 
-import zeep
-from zeep import xsd
-from zeep.transports import Transport
-
 from lxml import etree
 
 
 here = os.path.abspath(os.path.dirname(__file__))
 serpro_ca_bundle = os.path.join(here, 'certs', 'serpro_full_chain.pem')
 
+# Stands for the batch envelop in the SOAP envelop of streamed batches
+_BATCH_PLACEHOLDER = 'batchPlaceholder'
+
+# requests and zeep are only imported (through esocial.transport) when a
+# webservice is first used. These names are still available from this module.
+_TRANSPORT_NAMES = (
+    'bundled_wsdl_dir',
+    'WSDL_CACHE_TTL',
+    'WSDLNotCachedError',
+    'WSDLCache',
+    'user_wsdl_cache_dir',
+    'CachedTransport',
+    'AsyncCachedTransport',
+    'ssl_context',
+    'CustomHTTPSAdapter',
+)
+
+
+def __getattr__(name):
+    if name in _TRANSPORT_NAMES:
+        from esocial import transport
+        return getattr(transport, name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def _soap_port(ws):
+    # The WSDL port of the default service of a zeep client (ws.service)
+    service = next(iter(ws.wsdl.services.values()))
+    return next(iter(service.ports.values()))
+
+
+def _soap_request(ws, operation, *args, **kwargs):
+    # (address, SOAP envelop, HTTP headers) of a call to the webservice
+    # operation, as zeep would send it
+    from zeep.wsdl.bindings import Soap12Binding
+    port = _soap_port(ws)
+    soap_action = port.binding.get(operation).soapaction
+    if isinstance(port.binding, Soap12Binding):
+        headers = {'Content-Type': 'application/soap+xml; charset=utf-8; action="{}"'.format(soap_action)}
+    else:
+        headers = {'Content-Type': 'text/xml; charset=utf-8', 'SOAPAction': '"{}"'.format(soap_action)}
+    headers.update(ws.settings.extra_http_headers or {})
+    envelope = ws.create_message(ws.service, operation, *args, **kwargs)
+    return (port.binding_options['address'], envelope, headers)
+
+
+# Validation of the signed events (WSClient validation):
+# full: every event is validated against its XSD
+# once: an event is validated once, while the digest of its bytes is
+#   remembered (see xml.ValidatedEvents)
+# trust: events are not validated (e.g. already checked with xml.validate_many())
+VALIDATE_FULL = 'full'
+VALIDATE_ONCE = 'once'
+VALIDATE_TRUST = 'trust'
+
+
+def _event_validator(validation, esocial_version):
+    # validate(event_signed, serialized=None) of the validation mode (None
+    # when events are trusted)
+    if validation == VALIDATE_FULL:
+        def validate(event_signed, serialized=None):
+            xml.XMLValidate(event_signed, esocial_version=esocial_version).validate()
+        return validate
+    if validation == VALIDATE_ONCE:
+        return xml.ValidatedEvents(esocial_version=esocial_version).validate
+    if validation == VALIDATE_TRUST:
+        return None
+    raise ValueError('Unknown validation mode: {}'.format(validation))
+
+
+_worker_signer = None
+_worker_validate = None
+
+
+def _init_sign_worker(cert_data, esocial_version, validation=VALIDATE_FULL):
+    global _worker_signer, _worker_validate
+    _worker_signer = xml.Signer(cert_data)
+    _worker_validate = _event_validator(validation, esocial_version)
+
+
+def _sign_and_validate(event, signer=None, validate=None):
+    """Sign and validate one event. The event may be an ElementTree or its
+    serialized bytes (when running on a worker process), in which case the
+    signed event is returned serialized too.
+
+    Returns (True, event_signed) or (False, exception). Errors of serialized
+    events refer to the copy parsed on the worker, so the caller reports them
+    by event Id (see send_events()).
+    """
+    serialized = not isinstance(event, etree._ElementTree)
+    if serialized:
+        signer, validate = _worker_signer, _worker_validate
+    try:
+        if serialized:
+            event = xml.load_fromstring(event)
+        event_signed = signer.sign(event)
+        data = etree.tostring(event_signed) if serialized else None
+        if validate is not None:
+            validate(event_signed, data)
+    except Exception as err:
+        return (False, err)
+    if serialized:
+        return (True, data)
+    return (True, event_signed)
+
+
+def partition_events(events, batch_size=50):
+    """Split a stream of events into batches of the same group.
 
-class CustomHTTPSAdapter(HTTPAdapter):
+    Parameters
+    ----------
+    events: iterable of lxml.etree._ElementTree
+    batch_size: maximum number of events per batch
 
-    def __init__(self, ctx_options=None):
-        self.ctx_options = ctx_options
-        super(CustomHTTPSAdapter, self).__init__()
+    Yields
+    ------
+    (group_id, list of events) tuples. At most one incomplete batch per group
+    is held in memory.
+    """
+    groups = OrderedDict()
+    for event in events:
+        group_id = xml.event_group(event)
+        batch = groups.setdefault(group_id, [])
+        batch.append(event)
+        if len(batch) == batch_size:
+            yield (group_id, batch)
+            groups[group_id] = []
+    for group_id, batch in groups.items():
+        if batch:
+            yield (group_id, batch)
 
-    def _configure_ssl_context(self):
-        context = create_urllib3_context()
-        if self.ctx_options is not None:
-            context.load_verify_locations(cafile=self.ctx_options.get('cafile'))
-            with encrypt_pem_file(self.ctx_options.get('cert_data'), self.ctx_options.get('key_passwd')) as pem:
-                context.load_cert_chain(pem.name, password=self.ctx_options.get('key_passwd'))
-        return context
 
-    def init_poolmanager(self, *args, **kwargs):
-        kwargs['ssl_context'] = self._configure_ssl_context()
-        return super(CustomHTTPSAdapter, self).init_poolmanager(*args, **kwargs)
+class WSConnectionPool(object):
+    """Long-lived zeep clients, one per webservice URL.
 
-    def proxy_manager_for(self, *args, **kwargs):
-        kwargs['ssl_context'] = self._configure_ssl_context()
-        return super(CustomHTTPSAdapter, self).proxy_manager_for(*args, **kwargs)
+    All clients share a single requests.Session, so the HTTPS connections (and
+    their TLS sessions) are kept alive between calls and the WSDL of each
+    webservice is downloaded and parsed only once.
+
+    Parameters
+    ----------
+    cert_data: dict returned by esocial.utils.pkcs12_data()
+    key_passwd: the certificate password
+    ca_file: CA bundle used to verify the eSocial servers
+    maxsize: maximum number of connections kept alive per host
+    wsdl_cache: a WSDLCache (or any zeep cache) for the service descriptions
+    offline: if True, service descriptions are never downloaded
+    """
+    def __init__(self, cert_data=None, key_passwd=None, ca_file=serpro_ca_bundle, maxsize=10,
+                 wsdl_cache=None, offline=False):
+        self.cert_data = cert_data
+        self.key_passwd = key_passwd
+        self.ca_file = ca_file
+        self.maxsize = maxsize
+        if wsdl_cache is None:
+            from esocial.transport import WSDLCache
+            wsdl_cache = WSDLCache.default()
+        self.wsdl_cache = wsdl_cache
+        self.offline = offline
+        self._session = None
+        self._clients = {}
+        self._lock = threading.RLock()
+
+    def session(self):
+        import requests
+        from esocial.transport import CustomHTTPSAdapter
+        with self._lock:
+            if self._session is None:
+                self._session = requests.Session()
+                self._session.mount(
+                    'https://',
+                    CustomHTTPSAdapter(
+                        ctx_options={
+                            'cert_data': self.cert_data,
+                            'key_passwd': self.key_passwd,
+                            'cafile': self.ca_file
+                        },
+                        pool_maxsize=self.maxsize,
+                    )
+                )
+            return self._session
+
+    def client(self, url):
+        """Returns the zeep client for `url`, creating it on the first use."""
+        import zeep
+        from esocial.transport import CachedTransport
+        with self._lock:
+            ws = self._clients.get(url)
+            if ws is None:
+                ws_transport = CachedTransport(
+                    session=self.session(),
+                    cache=self.wsdl_cache,
+                    offline=self.offline,
+                )
+                ws = zeep.Client(
+                    url,
+                    transport=ws_transport
+                )
+                self._clients[url] = ws
+            return ws
+
+    def close(self):
+        with self._lock:
+            self._clients = {}
+            if self._session is not None:
+                self._session.close()
+                self._session = None
 
 
 class WSClient(object):
 
+    _connection_pool_class = WSConnectionPool
+
     def __init__(self, pfx_file=None, pfx_passw=None, employer_id=None, sender_id=None,
-                 ca_file=serpro_ca_bundle, target=esocial._TARGET, esocial_version=esocial.__esocial_version__):
+                 ca_file=serpro_ca_bundle, target=esocial._TARGET, esocial_version=esocial.__esocial_version__,
+                 connection_pool=None, wsdl_cache=None, offline=False, store=None,
+                 id_generator=None, validation=VALIDATE_FULL, signer=None, limiter=None):
         self.ca_file = ca_file
         self.pfx_passw = pfx_passw
         if pfx_file is not None:
-            self.cert_data = pkcs12_data(pfx_file, pfx_passw)
+            self.cert_data = certificate_store.load(pfx_file, pfx_passw)
         else:
             self.cert_data = None
+        if connection_pool is None:
+            connection_pool = self._connection_pool_class(
+                self.cert_data,
+                pfx_passw,
+                ca_file,
+                wsdl_cache=wsdl_cache,
+                offline=offline
+            )
+        self.connection_pool = connection_pool
+        self._signer = signer
         self.batch = []
-        self.event_ids = []
+        # Signed events serialized by the sign workers, by Id: written as they
+        # are in streamed batch envelops (see send())
+        self._serialized = {}
+        self._id_generator = id_generator
         self.max_batch_size = 50
         self.employer_id = employer_id
         self.sender_id = sender_id or employer_id
         # self.target = target
         self.esocial_version = esocial_version
+        # esocial.store.EventStore recording the events sent and their results
+        self.store = store
+        self.validation = validation
+        self._validate_event = _event_validator(validation, esocial_version)
+        # limiter(endpoint) returns the context manager held during each call
+        # to the webservice `endpoint` (see _call())
+        self.limiter = limiter
         self._set_target(target)
 
+    @property
+    def signer(self):
+        if self._signer is None and self.cert_data is not None:
+            self._signer = xml.Signer(self.cert_data)
+        return self._signer
+
     def connect(self, url):
-        transport_session = requests.Session()
-        transport_session.mount(
-            'https://',
-            CustomHTTPSAdapter(
-                ctx_options={
-                    'cert_data': self.cert_data,
-                    'key_passwd': self.pfx_passw,
-                    'cafile': self.ca_file
-                }
-            )
-        )
-        ws_transport = Transport(session=transport_session)
-        return zeep.Client(
-            url,
-            transport=ws_transport
-        )
+        return self.connection_pool.client(url)
+
+    def _call(self, endpoint, func, *args, **kwargs):
+        # Every webservice call goes through here. endpoint is 'send',
+        # 'retrieve', 'events_ids' or 'download'
+        if self.limiter is None:
+            return func(*args, **kwargs)
+        with self.limiter(endpoint):
+            return func(*args, **kwargs)
+
+    def close(self):
+        """Close the HTTPS connections kept alive by this client."""
+        self.connection_pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def esocial_send_url(self):
         return esocial._WS_URL[self.target]['send']
@@ -115,19 +333,21 @@ class WSClient(object):
             return employer_id['nrInsc']
         return employer_id['nrInsc'][:8]
 
+    @property
+    def id_generator(self):
+        if self._id_generator is None:
+            self._id_generator = EventIdGenerator(
+                self.employer_id.get('tpInsc'),
+                self._check_nrinsc(self.employer_id)
+            )
+        return self._id_generator
+
     def _event_id(self):
-        id_prefix = 'ID{}{:0<14}{}'.format(
-            self.employer_id.get('tpInsc'),
-            self._check_nrinsc(self.employer_id),
-            datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-        )
-        self.event_ids.append(id_prefix)
-        Q = self.event_ids.count(id_prefix)
-        return '{}{:0>5}'.format(id_prefix, Q)
+        return self.id_generator.next()
 
     def clear_batch(self):
         self.batch = []
-        self.event_ids = []
+        self._serialized = {}
 
     def add_event(self, event, gen_event_id=False):
         if not isinstance(event, etree._ElementTree):
@@ -142,19 +362,124 @@ class WSClient(object):
                 event_id = self._event_id()
                 event_tag.set('Id', event_id)
             # Signing...
-            event_signed = xml.sign(event, self.cert_data)
+            event_signed = self.signer.sign(event)
             # Validating
-            xml.XMLValidate(event_signed).validate()
+            if self._validate_event is not None:
+                self._validate_event(event_signed)
             # Adding the event to batch
             self.batch.append(event_signed)
             return (event_id, event_signed)
         raise Exception('More than {} events per batch is not permitted!'.format(self.max_batch_size))
 
+    def _check_signer(self):
+        if not (self.employer_id and self.sender_id and self.cert_data):
+            raise Exception('In order to sign events, employer_id, sender_id, pfx_file and pfx_passw are needed!')
+
+    def _sign_executor(self, workers):
+        self._check_signer()
+        if workers <= 1:
+            return None
+        worker_cert_data = {
+            'key_str': self.cert_data['key_str'],
+            'cert_str': self.cert_data['cert_str'],
+        }
+        from concurrent.futures import ProcessPoolExecutor
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_sign_worker,
+            initargs=(worker_cert_data, self.esocial_version, self.validation)
+        )
+
+    def sign_events(self, events, gen_event_id=False, workers=None, executor=None):
+        """Sign and validate many events, fanning the work out across processes.
+
+        Parameters
+        ----------
+        events: iterable of lxml.etree._ElementTree
+        gen_event_id: same as in add_event()
+        workers: number of worker processes. If None, os.cpu_count() is used;
+            if 0 or 1, the events are processed in the current process.
+        executor: a process pool to reuse between calls, instead of starting a
+            new one with `workers` processes.
+
+        Returns
+        -------
+        A list of (event_id, event_signed) tuples, in the same order of `events`.
+        If an event could not be signed or is invalid, event_signed is the
+        exception raised for it (e.g. xml.XMLValidateError).
+        """
+        return [
+            (event_id, event_signed)
+            for event_id, event_signed, serialized in self._sign_events(events, gen_event_id, workers, executor)
+        ]
+
+    def _sign_events(self, events, gen_event_id, workers, executor):
+        # Same as sign_events(), also returning the signed events serialized
+        # by the worker processes (or None): (event_id, event_signed, serialized)
+        self._check_signer()
+        event_ids = []
+        for event in events:
+            if not isinstance(event, etree._ElementTree):
+                raise ValueError('Not an ElementTree instance!')
+            # Normally, the element with Id attribute is the first one
+            event_tag = event.getroot().getchildren()[0]
+            event_id = event_tag.get('Id')
+            if gen_event_id:
+                event_id = self._event_id()
+                event_tag.set('Id', event_id)
+            event_ids.append((event_id, event))
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = min(workers, len(event_ids))
+        if executor is None and workers <= 1:
+            results = [
+                _sign_and_validate(event, self.signer, self._validate_event)
+                for event_id, event in event_ids
+            ]
+        else:
+            own_executor = executor is None
+            if own_executor:
+                executor = self._sign_executor(workers)
+                chunksize = max(1, len(event_ids) // (workers * 4))
+            else:
+                chunksize = 1
+            try:
+                results = list(executor.map(
+                    _sign_and_validate,
+                    [etree.tostring(event) for event_id, event in event_ids],
+                    chunksize=chunksize
+                ))
+            finally:
+                if own_executor:
+                    executor.shutdown()
+        signed_events = []
+        for (event_id, event), (ok, result) in zip(event_ids, results):
+            serialized = None
+            if ok and not isinstance(result, etree._ElementTree):
+                serialized = result
+                result = xml.load_fromstring(result)
+            signed_events.append((event_id, result, serialized))
+        return signed_events
+
+    def add_events(self, events, gen_event_id=False, workers=None):
+        """Sign, validate and add many events to the batch. See sign_events().
+
+        Only the events successfully signed and validated are added to the batch.
+        """
+        events = list(events)
+        if len(self.batch) + len(events) > self.max_batch_size:
+            raise Exception('More than {} events per batch is not permitted!'.format(self.max_batch_size))
+        signed_events = []
+        for event_id, event_signed, serialized in self._sign_events(events, gen_event_id, workers, None):
+            if not isinstance(event_signed, Exception):
+                self.batch.append(event_signed)
+                if serialized is not None:
+                    self._serialized[event_id] = serialized
+            signed_events.append((event_id, event_signed))
+        return signed_events
+
     def _xsd(self, which):
-        version = format_xsd_version(esocial.__xsd_versions__[which]['version'])
-        xsd_file = esocial.__xsd_versions__[which]['xsd'].format(version)
-        xsd_file = os.path.join(here, 'xsd', xsd_file)
-        return xml.xsd_fromfile(xsd_file)
+        return xml.xsd_cache.envelop(which)
 
     def validate_envelop(self, which, envelop):
         xmlschema = self._xsd(which)
@@ -163,68 +488,230 @@ class WSClient(object):
             element_test = etree.ElementTree(envelop)
         xml.XMLValidate(element_test, xsd=xmlschema, esocial_version=self.esocial_version).validate()
 
-    def _make_send_envelop(self, group_id):
+    def _add_employer_id(self, cursor):
+        with cursor.add('ideEmpregador') as employer:
+            employer.add('tpInsc', text=str(self.employer_id['tpInsc']))
+            employer.add('nrInsc', text=str(self._check_nrinsc(self.employer_id)))
+
+    def _make_send_envelop(self, group_id, batch=None, skeleton=False):
+        # With skeleton=True, the events are replaced by xml.EVENT_PLACEHOLDER
+        # elements (see xml.write_envelop()). EnvioLoteEventos doesn't
+        # validate the events (xs:any processContents="skip"), so the
+        # skeleton validates as the full envelop
+        if batch is None:
+            batch = self.batch
         version = format_xsd_version(esocial.__xsd_versions__['send']['version'])
         xmlns = 'http://www.esocial.gov.br/schema/lote/eventos/envio/v{}'.format(version)
         batch_envelop = xml.XMLHelper('eSocial', xmlns=xmlns)
-        batch_envelop.add_element(None, 'envioLoteEventos', grupo=str(group_id))
-        batch_envelop.add_element('envioLoteEventos', 'ideEmpregador')
-        batch_envelop.add_element(
-            'envioLoteEventos/ideEmpregador',
-            'tpInsc',
-            text=str(self.employer_id['tpInsc']),
-        )
-        batch_envelop.add_element(
-            'envioLoteEventos/ideEmpregador',
-            'nrInsc',
-            text=str(self._check_nrinsc(self.employer_id)),
-        )
-        batch_envelop.add_element('envioLoteEventos', 'ideTransmissor')
-        batch_envelop.add_element(
-            'envioLoteEventos/ideTransmissor',
-            'tpInsc',
-            text=str(self.sender_id['tpInsc']),
-        )
-        batch_envelop.add_element(
-            'envioLoteEventos/ideTransmissor',
-            'nrInsc',
-            text=str(self.sender_id['nrInsc']),
-        )
-        batch_envelop.add_element('envioLoteEventos', 'eventos')
-        for event in self.batch:
-            # Getting the Id attribute
-            event_tag = event.getroot()
-            event_id = event_tag.getchildren()[0].get('Id')
-            # Adding the event XML
-            event_root = batch_envelop.add_element(
-                'envioLoteEventos/eventos',
-                'evento',
-                Id=event_id,
-            )
-            event_root.append(event_tag)
+        with batch_envelop.cursor().add('envioLoteEventos', grupo=str(group_id)) as batch_tag:
+            self._add_employer_id(batch_tag)
+            with batch_tag.add('ideTransmissor') as sender:
+                sender.add('tpInsc', text=str(self.sender_id['tpInsc']))
+                sender.add('nrInsc', text=str(self.sender_id['nrInsc']))
+            with batch_tag.add('eventos') as events:
+                for event in batch:
+                    # Getting the Id attribute
+                    event_tag = event.getroot()
+                    event_id = event_tag.getchildren()[0].get('Id')
+                    # Adding the event XML
+                    event_element = events.add('evento', Id=event_id).element
+                    if skeleton:
+                        event_element.append(etree.Element(xml.EVENT_PLACEHOLDER))
+                    else:
+                        event_element.append(event_tag)
         return batch_envelop.root
 
-    def send(self, group_id=1, clear_batch=True):
-        batch_to_send = self._make_send_envelop(group_id)
+    def _send_batch(self, group_id, batch, stream=False):
+        batch_to_send = self._make_send_envelop(group_id, batch, skeleton=stream)
         self.validate_envelop('send', batch_to_send)
         # If no exception, batch XML is valid
+        if self.store is not None:
+            # Recorded before sending, so events of a batch lost on the way
+            # are still in the store (without protocol)
+            self.store.add_many(batch, grupo=group_id)
         url = esocial._WS_URL[self.target]['send']
         ws = self.connect(url)
         # ws.wsdl.dump()
         BatchElement = ws.get_element('ns1:EnviarLoteEventos')
-        result = ws.service.EnviarLoteEventos(BatchElement(loteEventos=batch_to_send))
-        del ws
+        serialized = [self._serialized.pop(event.getroot()[0].get('Id'), None) for event in batch]
+        if stream:
+            # Events serialized by the sign workers are not serialized again
+            events = [data or event for data, event in zip(serialized, batch)]
+            placeholder = etree.Element(_BATCH_PLACEHOLDER)
+            result = self._post_soap(
+                ws,
+                'EnviarLoteEventos',
+                BatchElement(loteEventos=placeholder),
+                placeholder,
+                xml.iter_envelop(batch_to_send, events)
+            )
+        else:
+            result = self._call('send', ws.service.EnviarLoteEventos, BatchElement(loteEventos=batch_to_send))
+        return (self._batch_sent(batch, result), batch_to_send)
+
+    def _post_soap(self, ws, operation, request, placeholder, chunks):
+        # Call the webservice operation with the SOAP envelop built by zeep for
+        # `request`, where the `placeholder` element is replaced by the bytes
+        # of `chunks`: that content is never parsed by zeep, and is sent
+        # (chunked) as it is produced
+        from zeep.wsdl.utils import etree_to_string
+        # Serialized before zeep moves it into the SOAP envelop
+        marker = etree.tostring(placeholder)
+        address, envelope, headers = _soap_request(ws, operation, request)
+        head, found, tail = etree_to_string(envelope).partition(marker)
+        if not found:
+            raise ValueError('Placeholder not found in the {} SOAP envelop'.format(operation))
+
+        def body():
+            yield head
+            for chunk in chunks:
+                yield chunk
+            yield tail
+
+        response = self._call('send', ws.transport.post, address, self._request_body(body()), headers)
+        return self._soap_reply(ws, operation, response)
+
+    def _request_body(self, body):
+        # The body of a request (an iterable of bytes), as the transport takes it
+        return body
+
+    def _soap_reply(self, ws, operation, response):
+        binding = _soap_port(ws).binding
+        return binding.process_reply(ws, binding.get(operation), response)
+
+    def _batch_sent(self, batch, result):
+        if self.store is not None:
+            decoded = xml.parse_base_response(result)
+            event_ids = [event.getroot()[0].get('Id') for event in batch]
+            if decoded['lote'] and decoded['lote'].get('protocoloEnvio'):
+                self.store.set_protocol(event_ids, decoded['lote']['protocoloEnvio'])
+            elif decoded['status']:
+                # Batch rejected
+                self.store.set_status(event_ids, decoded['status'].get('cdResposta'), decoded['status'].get('descResposta'))
+        return result
+
+    def send(self, group_id=1, clear_batch=True, stream=False):
+        """Send the batch.
+
+        With stream=True, the batch envelop is written incrementally into the
+        SOAP request, straight from the signed events (see xml.iter_envelop()),
+        and sent as it is written (chunked transfer encoding), so neither a
+        tree nor the bytes of the whole envelop are kept in memory, zeep never
+        handles the events and they are left in their own documents.
+
+        Returns
+        -------
+        A (result, batch_to_send) tuple: the webservice response and the batch
+        envelop sent (lxml Element objects). With stream=True, batch_to_send is
+        the envelop skeleton, where each event is a xml.EVENT_PLACEHOLDER element.
+        """
+        result, batch_to_send = self._send_batch(group_id, self.batch, stream=stream)
         if clear_batch:
             self.clear_batch()
-        # result and batch_to_send is a lxml Element object
         return (result, batch_to_send)
 
+    def send_events(self, events, gen_event_id=False, workers=None, concurrency=1, stream=False):
+        """Sign, validate and send any number of events.
+
+        The events are split into batches of at most max_batch_size events of the
+        same group (see partition_events()), which are sent by `concurrency`
+        threads. The order of the events is kept inside each group, but with
+        concurrency > 1 batches may reach eSocial out of order. A batch is
+        signed while the previous ones are sent, but no more than one batch
+        waits for a free sender, so `events` (e.g. a generator) is consumed
+        as the batches are sent.
+
+        Parameters
+        ----------
+        events: iterable of lxml.etree._ElementTree
+        gen_event_id: same as in add_event()
+        workers: number of processes used to sign and validate the events (see sign_events())
+        concurrency: number of batches sent at the same time
+        stream: same as in send()
+
+        Returns
+        -------
+        An OrderedDict keyed by event Id, with dicts:
+            group: the batch group
+            batch: the sequence number of the event's batch
+            protocol: the batch protocol number (protocoloEnvio), if received
+            response: the webservice response (a lxml Element object)
+            error: the exception raised signing/validating the event or sending its batch
+        """
+        results = OrderedDict()
+        if workers is None:
+            workers = os.cpu_count() or 1
+        executor = self._sign_executor(workers)
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as sender:
+                # future: Id's of the events of the batch being sent
+                in_flight = {}
+                for group_id, batch, batch_ids in self._signed_batches(events, results, gen_event_id, workers, executor):
+                    if len(in_flight) >= concurrency:
+                        self._batches_sent(results, in_flight, FIRST_COMPLETED)
+                    in_flight[sender.submit(self._send_batch, group_id, batch, stream)] = batch_ids
+                self._batches_sent(results, in_flight, ALL_COMPLETED)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return results
+
+    def _batches_sent(self, results, in_flight, return_when):
+        # Record the results of the batches sent, dropping them (and their
+        # envelops) from in_flight
+        done, not_done = wait(list(in_flight), return_when=return_when)
+        for future in done:
+            batch_ids = in_flight.pop(future)
+            try:
+                response, batch_sent = future.result()
+            except Exception as err:
+                self._set_send_results(results, batch_ids, None, err)
+            else:
+                self._set_send_results(results, batch_ids, response, None)
+
+    def _signed_batches(self, events, results, gen_event_id, workers, executor):
+        # Yields (group_id, batch, batch_ids) of the signed and valid events,
+        # registering every event on `results`
+        for n, (group_id, events_chunk) in enumerate(partition_events(events, self.max_batch_size)):
+            batch = []
+            batch_ids = []
+            signed_events = self._sign_events(events_chunk, gen_event_id, workers, executor)
+            for event_id, event_signed, serialized in signed_events:
+                results[event_id] = {
+                    'group': group_id,
+                    'batch': n,
+                    'protocol': None,
+                    'response': None,
+                    'error': None,
+                }
+                if isinstance(event_signed, Exception):
+                    results[event_id]['error'] = event_signed
+                else:
+                    batch.append(event_signed)
+                    batch_ids.append(event_id)
+                    if serialized is not None:
+                        self._serialized[event_id] = serialized
+            if batch:
+                yield (group_id, batch, batch_ids)
+
+    def _set_send_results(self, results, batch_ids, response, error):
+        protocol = None
+        if response is not None:
+            try:
+                decoded = xml.parse_response(response)
+                if decoded['lote']:
+                    protocol = decoded['lote'].get('protocoloEnvio')
+            except Exception as err:
+                error = err
+        for event_id in batch_ids:
+            results[event_id].update(protocol=protocol, response=response, error=error)
+
     def _make_retrieve_envelop(self, protocol_number):
         version = format_xsd_version(esocial.__xsd_versions__['retrieve']['version'])
         xmlns = 'http://www.esocial.gov.br/schema/lote/eventos/envio/consulta/retornoProcessamento/v{}'.format(version)
         envelop_h = xml.XMLHelper('eSocial', xmlns=xmlns)
-        envelop_h.add_element(None, 'consultaLoteEventos')
-        envelop_h.add_element('consultaLoteEventos', 'protocoloEnvio', text=str(protocol_number))
+        with envelop_h.cursor().add('consultaLoteEventos') as search:
+            search.add('protocoloEnvio', text=str(protocol_number))
         return envelop_h.root
 
     def retrieve(self, protocol_number):
@@ -235,184 +722,598 @@ class WSClient(object):
         ws = self.connect(url)
         # ws.wsdl.dump()
         SearchElement = ws.get_element('ns1:ConsultarLoteEventos')
-        result = ws.service.ConsultarLoteEventos(SearchElement(consulta=batch_to_search))
-        del ws
+        result = self._call('retrieve', ws.service.ConsultarLoteEventos, SearchElement(consulta=batch_to_search))
+        return self._batch_retrieved(result)
+
+    def _batch_retrieved(self, result):
+        if self.store is not None:
+            self.store.update_from_response(xml.parse_response(result))
         return result
 
     def _make_employer_events_ids_evelop(self, params):
         version = format_xsd_version(esocial.__xsd_versions__['view_employer_event_id']['version'])
         xmlns = 'http://www.esocial.gov.br/schema/consulta/identificadores-eventos/empregador/v{}'.format(version)
         envelop_h = xml.XMLHelper('eSocial', xmlns=xmlns)
-        envelop_h.add_element(None, 'consultaIdentificadoresEvts')
-        envelop_h.add_element('consultaIdentificadoresEvts', 'ideEmpregador')
-        envelop_h.add_element(
-            'consultaIdentificadoresEvts/ideEmpregador',
-            'tpInsc',
-            text=str(self.employer_id['tpInsc']),
-        )
-        envelop_h.add_element(
-            'consultaIdentificadoresEvts/ideEmpregador',
-            'nrInsc',
-            text=str(self._check_nrinsc(self.employer_id)),
-        )
-        envelop_h.add_element('consultaIdentificadoresEvts', 'consultaEvtsEmpregador')
-        envelop_h.add_element(
-            'consultaIdentificadoresEvts/consultaEvtsEmpregador',
-            'tpEvt',
-            text=str(params.get('tpEvt')),
-        )
-        envelop_h.add_element(
-            'consultaIdentificadoresEvts/consultaEvtsEmpregador',
-            'perApur',
-            text=str(params.get('perApur')),
-        )
-        return xml.sign(etree.ElementTree(envelop_h.root), self.cert_data)
+        with envelop_h.cursor().add('consultaIdentificadoresEvts') as search:
+            self._add_employer_id(search)
+            with search.add('consultaEvtsEmpregador') as events:
+                events.add('tpEvt', text=str(params.get('tpEvt')))
+                events.add('perApur', text=str(params.get('perApur')))
+        return self.signer.sign(etree.ElementTree(envelop_h.root))
     
     def get_employer_events_ids(self, params):
         signed_envelop = self._make_employer_events_ids_evelop(params)
         self.validate_envelop('view_employer_event_id', signed_envelop)
         url = esocial._WS_URL_DOWN[self.target]['send']
         ws = self.connect(url)
-        result = ws.service.ConsultarIdentificadoresEventosEmpregador(consultaEventosEmpregador=signed_envelop.getroot())
-        del ws
+        result = self._call(
+            'events_ids',
+            ws.service.ConsultarIdentificadoresEventosEmpregador,
+            consultaEventosEmpregador=signed_envelop.getroot()
+        )
         return result
     
     def _make_table_events_ids_evelop(self, params):
         version = format_xsd_version(esocial.__xsd_versions__['view_table_event_id']['version'])
         xmlns = 'http://www.esocial.gov.br/schema/consulta/identificadores-eventos/tabela/v{}'.format(version)
         envelop_h = xml.XMLHelper('eSocial', xmlns=xmlns)
-        envelop_h.add_element(None, 'consultaIdentificadoresEvts')
-        envelop_h.add_element('consultaIdentificadoresEvts', 'ideEmpregador')
-        envelop_h.add_element(
-            'consultaIdentificadoresEvts/ideEmpregador',
-            'tpInsc',
-            text=str(self.employer_id['tpInsc']),
-        )
-        envelop_h.add_element(
-            'consultaIdentificadoresEvts/ideEmpregador',
-            'nrInsc',
-            text=str(self._check_nrinsc(self.employer_id)),
-        )
-        envelop_h.add_element('consultaIdentificadoresEvts', 'consultaEvtsTabela')
-        envelop_h.add_element(
-            'consultaIdentificadoresEvts/consultaEvtsTabela',
-            'tpEvt',
-            text=str(params.get('tpEvt')),
-        )
-        for p in ('chEvt', 'dtIni', 'dtFim'):
-            if params.get(p):
-                envelop_h.add_element(
-                    'consultaIdentificadoresEvts/consultaEvtsTabela',
-                    p,
-                    text=str(params.get(p)),
-                )
-        return xml.sign(etree.ElementTree(envelop_h.root), self.cert_data)
+        with envelop_h.cursor().add('consultaIdentificadoresEvts') as search:
+            self._add_employer_id(search)
+            with search.add('consultaEvtsTabela') as events:
+                events.add('tpEvt', text=str(params.get('tpEvt')))
+                for p in ('chEvt', 'dtIni', 'dtFim'):
+                    if params.get(p):
+                        events.add(p, text=str(params.get(p)))
+        return self.signer.sign(etree.ElementTree(envelop_h.root))
     
     def get_table_events_ids(self, params):
         signed_envelop = self._make_table_events_ids_evelop(params)
         self.validate_envelop('view_table_event_id', signed_envelop)
         url = esocial._WS_URL_DOWN[self.target]['send']
         ws = self.connect(url)
-        result = ws.service.ConsultarIdentificadoresEventosTabela(consultaEventosTabela=signed_envelop.getroot())
-        del ws
+        result = self._call(
+            'events_ids',
+            ws.service.ConsultarIdentificadoresEventosTabela,
+            consultaEventosTabela=signed_envelop.getroot()
+        )
         return result
 
     def _make_employee_events_ids_envelop(self, params):
         version = format_xsd_version(esocial.__xsd_versions__['view_employee_event_id']['version'])
         xmlns = 'http://www.esocial.gov.br/schema/consulta/identificadores-eventos/trabalhador/v{}'.format(version)
         envelop_h = xml.XMLHelper('eSocial', xmlns=xmlns)
-        envelop_h.add_element(None, 'consultaIdentificadoresEvts')
-        envelop_h.add_element('consultaIdentificadoresEvts', 'ideEmpregador')
-        envelop_h.add_element(
-            'consultaIdentificadoresEvts/ideEmpregador',
-            'tpInsc',
-            text=str(self.employer_id['tpInsc']),
-        )
-        envelop_h.add_element(
-            'consultaIdentificadoresEvts/ideEmpregador',
-            'nrInsc',
-            text=str(self._check_nrinsc(self.employer_id)),
-        )
-        envelop_h.add_element('consultaIdentificadoresEvts', 'consultaEvtsTrabalhador')
-        for p in ('cpfTrab', 'dtIni', 'dtFim'):
-            envelop_h.add_element(
-                'consultaIdentificadoresEvts/consultaEvtsTrabalhador',
-                p,
-                text=str(params.get(p)),
-            )
-        return xml.sign(etree.ElementTree(envelop_h.root), self.cert_data)
+        with envelop_h.cursor().add('consultaIdentificadoresEvts') as search:
+            self._add_employer_id(search)
+            with search.add('consultaEvtsTrabalhador') as events:
+                for p in ('cpfTrab', 'dtIni', 'dtFim'):
+                    events.add(p, text=str(params.get(p)))
+        return self.signer.sign(etree.ElementTree(envelop_h.root))
     
     def get_employee_events_ids(self, params):
         signed_envelop = self._make_employee_events_ids_envelop(params)
         self.validate_envelop('view_employee_event_id', signed_envelop)
         url = esocial._WS_URL_DOWN[self.target]['send']
         ws = self.connect(url)
-        result = ws.service.ConsultarIdentificadoresEventosTrabalhador(consultaEventosTrabalhador=signed_envelop.getroot())
-        del ws
+        result = self._call(
+            'events_ids',
+            ws.service.ConsultarIdentificadoresEventosTrabalhador,
+            consultaEventosTrabalhador=signed_envelop.getroot()
+        )
         return result
 
     def _make_download_id_envelop(self, ids):
         version = format_xsd_version(esocial.__xsd_versions__['event_download_id']['version'])
         xmlns = 'http://www.esocial.gov.br/schema/download/solicitacao/id/v{}'.format(version)
         envelop_h = xml.XMLHelper('eSocial', xmlns=xmlns)
-        envelop_h.add_element(None, 'download')
-        envelop_h.add_element('download', 'ideEmpregador')
-        envelop_h.add_element(
-            'download/ideEmpregador',
-            'tpInsc',
-            text=str(self.employer_id['tpInsc']),
-        )
-        envelop_h.add_element(
-            'download/ideEmpregador',
-            'nrInsc',
-            text=str(self._check_nrinsc(self.employer_id)),
-        )
-        envelop_h.add_element('download', 'solicDownloadEvtsPorId')
-        for str_id in ids:
-            envelop_h.add_element('download/solicDownloadEvtsPorId', 'id', text=str(str_id))
+        with envelop_h.cursor().add('download') as download:
+            self._add_employer_id(download)
+            with download.add('solicDownloadEvtsPorId') as request:
+                for str_id in ids:
+                    request.add('id', text=str(str_id))
         # Signing
-        return xml.sign(etree.ElementTree(envelop_h.root), self.cert_data)
+        return self.signer.sign(etree.ElementTree(envelop_h.root))
+
+    def _download(self, operation, signed_envelop, stream=False, path=None):
+        url = esocial._WS_URL_DOWN[self.target]['download']
+        ws = self.connect(url)
+        if not stream:
+            return self._call('download', getattr(ws.service, operation), solicitacao=signed_envelop.getroot())
+        response = self._call('download', self._post_stream, ws, operation, solicitacao=signed_envelop.getroot())
+        return self._download_response(response, path)
+
+    def _post_stream(self, ws, operation, **kwargs):
+        # Call the webservice operation, returning the HTTP response unread
+        from zeep.wsdl.utils import etree_to_string
+        address, envelope, headers = _soap_request(ws, operation, **kwargs)
+        return ws.transport.session.post(
+            address,
+            data=etree_to_string(envelope),
+            headers=headers,
+            timeout=ws.transport.operation_timeout,
+            stream=True,
+        )
 
-    def download_events_by_id(self, ids):
+    def _download_response(self, response, path):
+        response.raise_for_status()
+        if response.raw is None:
+            # Already read (asynchronous client)
+            return xml.DownloadResponse(response.content, path=path)
+        # Decoded from the socket as it is read
+        response.raw.decode_content = True
+        return xml.DownloadResponse(response.raw, path=path)
+
+    def download_events_by_id(self, ids, stream=False, path=None):
+        """Download events by their Id's.
+
+        Parameters
+        ----------
+        ids: list of event Id's
+        stream: if True, the SOAP response is not parsed by zeep: a
+            xml.DownloadResponse is returned, which reads the response from
+            the connection and decodes one downloaded event at a time.
+        path: directory where the events are written (only when stream is True,
+            see xml.DownloadResponse)
+        """
         if ids and isinstance(ids, list):
             signed_envelop = self._make_download_id_envelop(ids)
             self.validate_envelop('event_download_id', signed_envelop)
-            url = esocial._WS_URL_DOWN[self.target]['download']
-            ws = self.connect(url)
-            result = ws.service.SolicitarDownloadEventosPorId(solicitacao=signed_envelop.getroot())
-            del ws
-            return result
+            return self._download('SolicitarDownloadEventosPorId', signed_envelop, stream=stream, path=path)
         raise ValueError('Parameter is not a List')
 
     def _make_download_receipt_envelop(self, n_protocols):        
         version = format_xsd_version(esocial.__xsd_versions__['event_download_receipt']['version'])
         xmlns = 'http://www.esocial.gov.br/schema/download/solicitacao/nrRecibo/v{}'.format(version)
         envelop_h = xml.XMLHelper('eSocial', xmlns=xmlns)
-        envelop_h.add_element(None, 'download')
-        envelop_h.add_element('download', 'ideEmpregador')
-        envelop_h.add_element(
-            'download/ideEmpregador',
-            'tpInsc',
-            text=str(self.employer_id['tpInsc']),
-        )
-        envelop_h.add_element(
-            'download/ideEmpregador',
-            'nrInsc',
-            text=str(self._check_nrinsc(self.employer_id)),
-        )
-        envelop_h.add_element('download', 'solicDownloadEventosPorNrRecibo')
-        for str_id in n_protocols:
-            envelop_h.add_element('download/solicDownloadEventosPorNrRecibo', 'nrRec', text=str(str_id))
+        with envelop_h.cursor().add('download') as download:
+            self._add_employer_id(download)
+            with download.add('solicDownloadEventosPorNrRecibo') as request:
+                for str_id in n_protocols:
+                    request.add('nrRec', text=str(str_id))
         # Signing
-        return xml.sign(etree.ElementTree(envelop_h.root), self.cert_data)
+        return self.signer.sign(etree.ElementTree(envelop_h.root))
 
-    def download_events_by_receipt(self, n_protocols):
+    def download_events_by_receipt(self, n_protocols, stream=False, path=None):
+        """Download events by their receipt numbers. See download_events_by_id()."""
         if n_protocols and isinstance(n_protocols, list):
             signed_envelop = self._make_download_receipt_envelop(n_protocols)
             self.validate_envelop('event_download_receipt', signed_envelop)
-            url = esocial._WS_URL_DOWN[self.target]['download']
-            ws = self.connect(url)
-            result = ws.service.SolicitarDownloadEventosPorNrRecibo(solicitacao=signed_envelop.getroot())
-            del ws
-            return result
+            return self._download('SolicitarDownloadEventosPorNrRecibo', signed_envelop, stream=stream, path=path)
         raise ValueError('Parameter is not a List')
+
+
+class _Limits(object):
+    # Holds semaphores (None for no limit), always acquired in the same order,
+    # and then the context manager `inner` (e.g. from a ratelimit.AdaptiveLimiter)
+    __slots__ = ('semaphores', 'inner')
+
+    def __init__(self, *semaphores, inner=None):
+        self.semaphores = [semaphore for semaphore in semaphores if semaphore is not None]
+        self.inner = inner
+
+    def __enter__(self):
+        acquired = []
+        try:
+            for semaphore in self.semaphores:
+                semaphore.acquire()
+                acquired.append(semaphore)
+            if self.inner is not None:
+                self.inner.__enter__()
+        except BaseException:
+            for semaphore in reversed(acquired):
+                semaphore.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if self.inner is not None:
+                self.inner.__exit__(exc_type, exc_value, traceback)
+        finally:
+            for semaphore in reversed(self.semaphores):
+                semaphore.release()
+
+
+class WSClientPool(object):
+    """WSClient's of many employers, for a transmitter (e.g. a procurador)
+    sending events on their behalf.
+
+    The clients of the employers that use the same certificate share its
+    connection pool (HTTPS connections and zeep clients) and its Signer.
+    Certificates and compiled XSDs are already shared by the whole process
+    (see certificate_store and xml.xsd_cache). Clients are found by the
+    employer nrInsc, and their webservice calls are bounded by employer and
+    by endpoint ('send', 'retrieve', 'events_ids' or 'download'):
+
+        pool = WSClientPool(pfx_file='procurador.pfx', pfx_passw='...', sender_id=sender_id,
+                            max_per_employer=2, max_per_endpoint={'send': 8, 'retrieve': 16})
+        for employer_id in employers:
+            pool.add_employer(employer_id)
+        results = pool['12345678'].send_events(events)
+
+    Parameters
+    ----------
+    pfx_file, pfx_passw: the certificate of the employers added without one
+    sender_id: the transmitter (ideTransmissor). If None, each employer is its
+        own transmitter.
+    max_per_employer: maximum number of calls in progress for each employer
+        (None: unbounded)
+    max_per_endpoint: maximum number of calls in progress to each endpoint, for
+        all the employers. A number, a dict by endpoint or None (unbounded).
+    limiter: limiter(endpoint) returns a context manager held during the calls
+        of all the employers, after the limits above (e.g. a
+        ratelimit.AdaptiveLimiter)
+    ca_file, target, esocial_version, wsdl_cache, offline: as in WSClient
+    client_kwargs: other WSClient arguments (e.g. validation or store), for
+        every employer
+    """
+    def __init__(self, pfx_file=None, pfx_passw=None, sender_id=None, max_per_employer=None,
+                 max_per_endpoint=None, ca_file=serpro_ca_bundle, target=esocial._TARGET,
+                 esocial_version=esocial.__esocial_version__, wsdl_cache=None, offline=False, limiter=None,
+                 **client_kwargs):
+        self.pfx_file = pfx_file
+        self.pfx_passw = pfx_passw
+        self.sender_id = sender_id
+        self.max_per_employer = max_per_employer
+        self.max_per_endpoint = max_per_endpoint
+        self.ca_file = ca_file
+        self.target = target
+        self.esocial_version = esocial_version
+        if wsdl_cache is None:
+            from esocial.transport import WSDLCache
+            wsdl_cache = WSDLCache.default()
+        self.wsdl_cache = wsdl_cache
+        self.offline = offline
+        self.limiter = limiter
+        self.client_kwargs = client_kwargs
+        # certificate file -> (connection pool, signer)
+        self._certificates = {}
+        # nrInsc -> WSClient
+        self._clients = OrderedDict()
+        self._employer_limits = {}
+        self._endpoint_limits = {}
+        self._lock = threading.RLock()
+
+    def _certificate(self, pfx_file, pfx_passw):
+        key = os.path.abspath(pfx_file)
+        with self._lock:
+            shared = self._certificates.get(key)
+            if shared is None:
+                cert_data = certificate_store.load(pfx_file, pfx_passw)
+                connection_pool = WSConnectionPool(
+                    cert_data,
+                    pfx_passw,
+                    self.ca_file,
+                    wsdl_cache=self.wsdl_cache,
+                    offline=self.offline
+                )
+                shared = (connection_pool, xml.Signer(cert_data))
+                self._certificates[key] = shared
+            return shared
+
+    def _endpoint_limit(self, endpoint):
+        max_calls = self.max_per_endpoint
+        if isinstance(max_calls, dict):
+            max_calls = max_calls.get(endpoint)
+        if max_calls is None:
+            return None
+        with self._lock:
+            semaphore = self._endpoint_limits.get(endpoint)
+            if semaphore is None:
+                semaphore = self._endpoint_limits[endpoint] = threading.BoundedSemaphore(max_calls)
+            return semaphore
+
+    def _limits(self, nr_insc, endpoint):
+        return _Limits(
+            self._employer_limits.get(nr_insc),
+            self._endpoint_limit(endpoint),
+            inner=None if self.limiter is None else self.limiter(endpoint)
+        )
+
+    def add_employer(self, employer_id, pfx_file=None, pfx_passw=None, sender_id=None, **client_kwargs):
+        """Create the client of an employer, returning it.
+
+        Parameters
+        ----------
+        employer_id: the employer ideEmpregador ({'tpInsc': 1, 'nrInsc': '12345678'})
+        pfx_file, pfx_passw: the employer certificate (default: the pool's)
+        sender_id: the transmitter (default: the pool's)
+        client_kwargs: other WSClient arguments, overriding the pool's
+        """
+        nr_insc = str(employer_id['nrInsc'])
+        if pfx_file is None:
+            pfx_file, pfx_passw = self.pfx_file, self.pfx_passw
+        if pfx_file is None:
+            raise ValueError('No certificate for the employer {}'.format(nr_insc))
+        connection_pool, signer = self._certificate(pfx_file, pfx_passw)
+        kwargs = dict(self.client_kwargs, **client_kwargs)
+        with self._lock:
+            if nr_insc in self._clients:
+                raise ValueError('Employer {} already added'.format(nr_insc))
+            if self.max_per_employer is not None:
+                self._employer_limits[nr_insc] = threading.BoundedSemaphore(self.max_per_employer)
+            ws = WSClient(
+                pfx_file=pfx_file,
+                pfx_passw=pfx_passw,
+                employer_id=employer_id,
+                sender_id=sender_id or self.sender_id,
+                ca_file=self.ca_file,
+                target=self.target,
+                esocial_version=self.esocial_version,
+                connection_pool=connection_pool,
+                signer=signer,
+                limiter=functools.partial(self._limits, nr_insc),
+                **kwargs
+            )
+            self._clients[nr_insc] = ws
+            return ws
+
+    def client(self, nr_insc):
+        """The client of the employer `nr_insc` (KeyError if not added)."""
+        return self._clients[str(nr_insc)]
+
+    __getitem__ = client
+
+    def __contains__(self, nr_insc):
+        return str(nr_insc) in self._clients
+
+    def __len__(self):
+        return len(self._clients)
+
+    def __iter__(self):
+        return iter(list(self._clients.values()))
+
+    def close(self):
+        """Close the HTTPS connections of all the certificates."""
+        with self._lock:
+            for connection_pool, signer in self._certificates.values():
+                connection_pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class AsyncWSConnectionPool(WSConnectionPool):
+    """Long-lived zeep.AsyncClient's, one per webservice URL, sharing one httpx.AsyncClient.
+
+    Service descriptions are still loaded synchronously (as in zeep), with a
+    httpx.Client. Requires httpx (pip install libesocial[async]).
+    """
+    def __init__(self, *args, **kwargs):
+        super(AsyncWSConnectionPool, self).__init__(*args, **kwargs)
+        self._wsdl_session = None
+
+    def _ssl_context(self):
+        from esocial.transport import ssl_context
+        return ssl_context({
+            'cert_data': self.cert_data,
+            'key_passwd': self.key_passwd,
+            'cafile': self.ca_file
+        })
+
+    def session(self):
+        import httpx
+        with self._lock:
+            if self._session is None:
+                self._session = httpx.AsyncClient(
+                    verify=self._ssl_context(),
+                    limits=httpx.Limits(max_keepalive_connections=self.maxsize),
+                )
+            return self._session
+
+    def wsdl_session(self):
+        import httpx
+        with self._lock:
+            if self._wsdl_session is None:
+                self._wsdl_session = httpx.Client(verify=self._ssl_context())
+            return self._wsdl_session
+
+    def client(self, url):
+        import zeep
+        from esocial.transport import AsyncCachedTransport
+        with self._lock:
+            ws = self._clients.get(url)
+            if ws is None:
+                ws_transport = AsyncCachedTransport(
+                    client=self.session(),
+                    wsdl_client=self.wsdl_session(),
+                    cache=self.wsdl_cache,
+                    offline=self.offline,
+                )
+                ws = zeep.AsyncClient(
+                    url,
+                    transport=ws_transport
+                )
+                self._clients[url] = ws
+            return ws
+
+    def close(self):
+        raise TypeError('The httpx.AsyncClient must be closed from the event loop: use "await pool.aclose()"')
+
+    async def aclose(self):
+        with self._lock:
+            self._clients = {}
+            session, self._session = self._session, None
+            wsdl_session, self._wsdl_session = self._wsdl_session, None
+        if wsdl_session is not None:
+            wsdl_session.close()
+        if session is not None:
+            await session.aclose()
+
+
+class AsyncWSClient(WSClient):
+    """asyncio version of WSClient.
+
+    Envelops are built, signed and validated exactly as in WSClient, but the
+    webservices calls are coroutines, so one event loop can keep many
+    requests in flight:
+
+        async with AsyncWSClient(pfx_file=..., pfx_passw=..., employer_id=...) as ws:
+            result, batch_xml = await ws.send()
+            response = await ws.retrieve(protocol_number)
+    """
+    _connection_pool_class = AsyncWSConnectionPool
+
+    async def close(self):
+        await self.connection_pool.aclose()
+
+    def __enter__(self):
+        raise TypeError('Use "async with AsyncWSClient(...)" instead of "with"')
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        raise TypeError('Use "async with AsyncWSClient(...)" instead of "with"')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _call(self, endpoint, func, *args, **kwargs):
+        # limiter(endpoint) must return an asynchronous context manager
+        if self.limiter is None:
+            return await func(*args, **kwargs)
+        async with self.limiter(endpoint):
+            return await func(*args, **kwargs)
+
+    async def _send_batch(self, group_id, batch, stream=False):
+        result, batch_to_send = super(AsyncWSClient, self)._send_batch(group_id, batch, stream=stream)
+        return (await result, batch_to_send)
+
+    def _request_body(self, body):
+        # httpx.AsyncClient only streams asynchronous iterables
+        async def chunks():
+            for chunk in body:
+                yield chunk
+        return chunks()
+
+    async def _soap_reply(self, ws, operation, response):
+        response = ws.transport.new_response(await response)
+        return super(AsyncWSClient, self)._soap_reply(ws, operation, response)
+
+    async def _batch_sent(self, batch, result):
+        return super(AsyncWSClient, self)._batch_sent(batch, await result)
+
+    async def _batch_retrieved(self, result):
+        return super(AsyncWSClient, self)._batch_retrieved(await result)
+
+    async def send(self, group_id=1, clear_batch=True, stream=False):
+        result, batch_to_send = await self._send_batch(group_id, self.batch, stream=stream)
+        if clear_batch:
+            self.clear_batch()
+        return (result, batch_to_send)
+
+    async def send_events(self, events, gen_event_id=False, workers=None, concurrency=1, stream=False):
+        """See WSClient.send_events(). Events are signed on a separate thread,
+        so the event loop is free while batches are being prepared.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        results = OrderedDict()
+        if workers is None:
+            workers = os.cpu_count() or 1
+        executor = self._sign_executor(workers)
+
+        async def send_batch(group_id, batch, batch_ids):
+            try:
+                response, batch_sent = await self._send_batch(group_id, batch, stream)
+            except Exception as err:
+                self._set_send_results(results, batch_ids, None, err)
+            else:
+                self._set_send_results(results, batch_ids, response, None)
+
+        in_flight = set()
+        try:
+            batches = self._signed_batches(events, results, gen_event_id, workers, executor)
+            while True:
+                signed_batch = await loop.run_in_executor(None, next, batches, None)
+                if signed_batch is None:
+                    break
+                if len(in_flight) >= concurrency:
+                    done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        task.result()
+                in_flight.add(asyncio.ensure_future(send_batch(*signed_batch)))
+            if in_flight:
+                done, in_flight = await asyncio.wait(in_flight)
+                for task in done:
+                    task.result()
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return results
+
+    async def retrieve(self, protocol_number):
+        return await super(AsyncWSClient, self).retrieve(protocol_number)
+
+    async def get_employer_events_ids(self, params):
+        return await super(AsyncWSClient, self).get_employer_events_ids(params)
+
+    async def get_table_events_ids(self, params):
+        return await super(AsyncWSClient, self).get_table_events_ids(params)
+
+    async def get_employee_events_ids(self, params):
+        return await super(AsyncWSClient, self).get_employee_events_ids(params)
+
+    async def _download(self, operation, signed_envelop, stream=False, path=None):
+        url = esocial._WS_URL_DOWN[self.target]['download']
+        ws = self.connect(url)
+        if not stream:
+            return await self._call('download', getattr(ws.service, operation), solicitacao=signed_envelop.getroot())
+        # Not ws.settings(raw_response=True): zeep settings are per thread, so
+        # every coroutine on the loop would see them while this one awaits
+        response = await self._call('download', self._post_raw, ws, operation, solicitacao=signed_envelop.getroot())
+        return self._download_response(response, path)
+
+    async def _post_raw(self, ws, operation, **kwargs):
+        # Call the webservice operation, returning the HTTP response unparsed
+        address, envelope, headers = _soap_request(ws, operation, **kwargs)
+        return await ws.transport.post_xml(address, envelope, headers)
+
+    async def download_events_by_id(self, ids, stream=False, path=None):
+        return await super(AsyncWSClient, self).download_events_by_id(ids, stream=stream, path=path)
+
+    async def download_events_by_receipt(self, n_protocols, stream=False, path=None):
+        return await super(AsyncWSClient, self).download_events_by_receipt(n_protocols, stream=stream, path=path)
+
+
+def refresh_wsdl_cache(pfx_file, pfx_passw, path=None, target=None, ca_file=serpro_ca_bundle):
+    """Download the service descriptions of all eSocial webservices into `path`.
+
+    Parameters
+    ----------
+    pfx_file, pfx_passw: the A1 certificate. The eSocial servers only serve
+        their WSDLs to authenticated clients.
+    path: the cache directory. Defaults to the user's cache directory (see
+        transport.user_wsdl_cache_dir()), which the clients' default cache reads.
+    target: 'tests' or 'production' (or the tpAmb codes). If None, both.
+
+    Returns
+    -------
+    The list of refreshed URL's.
+    """
+    if target is None:
+        targets = sorted(esocial._WS_URL)
+    else:
+        targets = [WSClient(target=target).target]
+    from esocial.transport import (
+        WSDLCache,
+        user_wsdl_cache_dir,
+    )
+    if path is None:
+        path = user_wsdl_cache_dir()
+    # timeout=0: nothing is read from the cache, everything is downloaded again
+    cache = WSDLCache(path=path, timeout=0)
+    pool = WSConnectionPool(certificate_store.load(pfx_file, pfx_passw), pfx_passw, ca_file, wsdl_cache=cache)
+    urls = []
+    try:
+        for t in targets:
+            for services in (esocial._WS_URL[t], esocial._WS_URL_DOWN[t]):
+                for url in services.values():
+                    pool.client(url)
+                    urls.append(url)
+    finally:
+        pool.close()
+    return urls
@@ -0,0 +1,281 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Bulk download of the events of an employer.
+
+The identifiers webservices return at most IDS_MAX_RESULTS events per query,
+so queries by date range are resumed from the last event returned until
+every event is found, and the identifiers found are downloaded in chunks of
+DOWNLOAD_MAX_IDS, concurrently.
+"""
+import datetime
+import threading
+import time
+
+from collections import (
+    OrderedDict,
+    deque,
+)
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
+
+from esocial import xml
+
+
+# identificadorEvt maxOccurs (RetornoConsultaIdentificadoresEventos)
+IDS_MAX_RESULTS = 50
+
+# arquivo maxOccurs (RetornoSolicitacaoDownloadEventos)
+DOWNLOAD_MAX_IDS = 50
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def to_datetime(value):
+    """A datetime from a datetime, a date or a string ('YYYY-MM-DD' or 'YYYY-MM-DDThh:mm:ss')."""
+    if isinstance(value, datetime.datetime):
+        return value.replace(microsecond=0)
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    if 'T' in value:
+        return datetime.datetime.strptime(value[:19], DATETIME_FORMAT)
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+
+def months(dt_ini, dt_fim):
+    """The periods (perApur, 'YYYY-MM') from dt_ini to dt_fim."""
+    dt_ini = to_datetime(dt_ini)
+    dt_fim = to_datetime(dt_fim)
+    year, month = dt_ini.year, dt_ini.month
+    periods = []
+    while (year, month) <= (dt_fim.year, dt_fim.month):
+        periods.append('{:04d}-{:02d}'.format(year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return periods
+
+
+def next_page(params, last):
+    """The params of the query resuming a query by date range (dtIni) from
+    the date and time of the last event returned (dhUltimoEvtRetornado).
+    Returns None if it can not be resumed."""
+    if 'dtIni' not in params or not last:
+        return None
+    last = to_datetime(last)
+    if params['dtIni'] is not None and last <= params['dtIni']:
+        # Every event returned has the same date and time: no progress
+        return None
+    return dict(params, dtIni=last)
+
+
+def split_range(dt_ini, dt_fim):
+    """Split [dt_ini, dt_fim] in two halves, to the second. Returns None if
+    the range can not be split."""
+    if dt_fim - dt_ini < datetime.timedelta(seconds=1):
+        return None
+    middle = (dt_ini + (dt_fim - dt_ini) // 2).replace(microsecond=0)
+    return ((dt_ini, middle), (middle + datetime.timedelta(seconds=1), dt_fim))
+
+
+class EventsDownloader(object):
+    """Finds and downloads all events of the employer of a WSClient.
+
+        downloader = EventsDownloader(ws, concurrency=4, rate=5, path='/var/lib/esocial/eventos')
+        for arquivo in downloader.backfill('2021-01-01', '2021-12-31', cpfs=cpfs,
+                                           table_events=['S-1010'], employer_events=['S-1299']):
+            print(arquivo['id'], arquivo['status']['cdResposta'])
+
+    Queries by date range that find more than IDS_MAX_RESULTS events are
+    resumed from the date and time of the last event returned (or, if the
+    webservice doesn't return it, split in halves) until all identifiers are
+    returned. Queries by period (perApur) can be neither resumed nor split:
+    their first IDS_MAX_RESULTS identifiers are returned, and the query is
+    recorded on `incomplete`, as well as queries by date range with more
+    than IDS_MAX_RESULTS events at the same second. Queries that fail are
+    recorded on `errors`.
+
+    Parameters
+    ----------
+    ws: a WSClient
+    concurrency: maximum number of requests in flight
+    rate: maximum number of requests per second. If None, there is no limit.
+    batch_size: maximum number of events per download request
+    path: directory where the downloaded events are written (see
+        xml.DownloadResponse). If None, they are kept in memory.
+    """
+    def __init__(self, ws, concurrency=4, rate=None, batch_size=DOWNLOAD_MAX_IDS, path=None,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.ws = ws
+        self.concurrency = concurrency
+        self.rate = rate
+        self.batch_size = batch_size
+        self.path = path
+        self.clock = clock
+        self.sleep = sleep
+        self.errors = []
+        # (params, total of events found, number of identifiers returned)
+        self.incomplete = []
+        self._last_request = None
+        self._lock = threading.Lock()
+
+    def _wait_rate(self):
+        if self.rate:
+            with self._lock:
+                now = self.clock()
+                if self._last_request is not None:
+                    wait_time = self._last_request + 1.0 / self.rate - now
+                    if wait_time > 0:
+                        self.sleep(wait_time)
+                        now = self.clock()
+                self._last_request = now
+
+    def _query(self, method, params):
+        self._wait_rate()
+        return xml.parse_events_ids(method(params))
+
+    def _run(self, tasks):
+        # Runs the (function, args) tasks of the `tasks` deque on a thread pool,
+        # yielding (args, result or exception) as they finish. Tasks appended
+        # to `tasks` meanwhile are run too.
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while tasks or in_flight:
+                while tasks and len(in_flight) < self.concurrency:
+                    function, args = tasks.popleft()
+                    in_flight[executor.submit(function, *args)] = args
+                done, pending = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                for future in done:
+                    args = in_flight.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as err:
+                        result = err
+                    yield (args, result)
+
+    def _events_ids(self, method, queries):
+        # queries: list of params dicts. Queries with dtIni/dtFim (datetimes)
+        # are resumed (or split) while their results are incomplete
+        found = OrderedDict()
+        tasks = deque((self._query, (method, params)) for params in queries)
+        for (method, params), result in self._run(tasks):
+            if isinstance(result, Exception):
+                self.errors.append((params, result))
+                continue
+            found.update(result['ids'])
+            if result['total'] is None:
+                status = result['status'] or {}
+                if not str(status.get('cdResposta', '')).startswith('2'):
+                    self.errors.append((params, status))
+                continue
+            if result['total'] <= len(result['ids']):
+                continue
+            page = next_page(params, result['last'])
+            if page is not None:
+                tasks.append((self._query, (method, page)))
+                continue
+            halves = None
+            if not result['last'] and params.get('dtIni') is not None and params.get('dtFim') is not None:
+                halves = split_range(params['dtIni'], params['dtFim'])
+            if halves is None:
+                # Only part of the events were found
+                self.incomplete.append((params, result['total'], len(result['ids'])))
+                continue
+            for dt_ini, dt_fim in halves:
+                tasks.append((self._query, (method, dict(params, dtIni=dt_ini, dtFim=dt_fim))))
+        return found
+
+    @staticmethod
+    def _format_params(params):
+        return dict(
+            (k, v.strftime(DATETIME_FORMAT) if isinstance(v, datetime.datetime) else v)
+            for k, v in params.items()
+        )
+
+    def _method(self, name):
+        ws_method = getattr(self.ws, name)
+        return lambda params: ws_method(self._format_params(params))
+
+    def employer_events_ids(self, events, periods):
+        """Identifiers of the periodic events of the employer (e.g. 'S-1299') of
+        the periods ('YYYY-MM'). The events of the workers (e.g. 'S-1200',
+        with cpfTrab) are not found by this query: see employee_events_ids().
+
+        Returns an OrderedDict of event Id: receipt number. Only the first
+        IDS_MAX_RESULTS events of each event and period are found (see
+        `incomplete`).
+        """
+        method = self._method('get_employer_events_ids')
+        return self._events_ids(method, [
+            {'tpEvt': event, 'perApur': period} for event in events for period in periods
+        ])
+
+    def table_events_ids(self, events, dt_ini=None, dt_fim=None):
+        """Identifiers of the table events (e.g. 'S-1010') between dt_ini and dt_fim."""
+        method = self._method('get_table_events_ids')
+        return self._events_ids(method, [
+            {
+                'tpEvt': event,
+                'dtIni': to_datetime(dt_ini) if dt_ini else None,
+                'dtFim': to_datetime(dt_fim) if dt_fim else None,
+            }
+            for event in events
+        ])
+
+    def employee_events_ids(self, cpfs, dt_ini, dt_fim):
+        """Identifiers of the events of the workers (CPF's) between dt_ini and dt_fim."""
+        method = self._method('get_employee_events_ids')
+        return self._events_ids(method, [
+            {'cpfTrab': cpf, 'dtIni': to_datetime(dt_ini), 'dtFim': to_datetime(dt_fim)}
+            for cpf in cpfs
+        ])
+
+    def _download(self, ids):
+        self._wait_rate()
+        return list(self.ws.download_events_by_id(ids, stream=True, path=self.path))
+
+    def download(self, ids):
+        """Download the events, yielding each arquivo (see xml.DownloadResponse).
+
+        Parameters
+        ----------
+        ids: iterable of event Id's (e.g. the result of *_events_ids())
+        """
+        ids = list(ids)
+        tasks = deque(
+            (self._download, (ids[i:i + self.batch_size],))
+            for i in range(0, len(ids), self.batch_size)
+        )
+        for (chunk,), result in self._run(tasks):
+            if isinstance(result, Exception):
+                self.errors.append(({'ids': chunk}, result))
+                continue
+            for arquivo in result:
+                yield arquivo
+
+    def backfill(self, dt_ini, dt_fim, cpfs=(), table_events=(), employer_events=()):
+        """Find and download all the events of an employer from dt_ini to dt_fim:
+        the events of the workers (cpfs), the table events and the periodic
+        events of the employer (employer_events, without workers) of every
+        month of the range.
+        """
+        ids = OrderedDict()
+        if table_events:
+            ids.update(self.table_events_ids(table_events, dt_ini, dt_fim))
+        if employer_events:
+            ids.update(self.employer_events_ids(employer_events, months(dt_ini, dt_fim)))
+        if cpfs:
+            ids.update(self.employee_events_ids(cpfs, dt_ini, dt_fim))
+        return self.download(ids)
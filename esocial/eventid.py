@@ -0,0 +1,146 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Event Id generation.
+
+An event Id is "ID" + tpInsc + nrInsc (14 digits, zero padded to the right)
++ the generation date and time (AAAAMMDDHHMMSS) + a sequence number of 5
+digits, so at most SEQUENCE_MAX events of an employer get Ids in the
+same second.
+"""
+import datetime
+import sqlite3
+import threading
+import time
+
+
+SEQUENCE_MAX = 99999
+
+TIMESTAMP_FORMAT = '%Y%m%d%H%M%S'
+
+_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS event_id_sequences (
+        employer TEXT NOT NULL,
+        second TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        PRIMARY KEY (employer, second)
+    )''',
+)
+
+
+class EventIdGenerator(object):
+    """Generate event Ids with a counter per second, in O(1).
+
+    The generator can be shared by many threads. With `path`, the counters
+    are kept on a SQLite database, so processes using the same file (and the
+    same employer) never generate the same Id, even after restarts:
+
+        ids = EventIdGenerator(1, '12345678', path='/var/lib/esocial/ids.db')
+        ids.next()
+        # 'ID1123456780000002021091617310600001'
+
+    When the SEQUENCE_MAX Ids of a second are taken, the generator waits for
+    the next second. Ids never go back in time, even if the clock does.
+
+    Parameters
+    ----------
+    tp_insc: the employer tpInsc
+    nr_insc: the employer nrInsc, as used in the Ids (see WSClient)
+    path: SQLite database file keeping the counters (default: counters are
+        kept in memory, unique for this generator only)
+    """
+    def __init__(self, tp_insc, nr_insc, path=None, clock=datetime.datetime.now, sleep=time.sleep):
+        self.employer = '{}{:0<14}'.format(tp_insc, nr_insc)
+        self.path = path
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._second = ''
+        self._seq = 0
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            for statement in _SCHEMA:
+                self._db.execute(statement)
+
+    def close(self):
+        if self._db is not None:
+            with self._lock:
+                self._db.close()
+
+    def _reserve(self, now, count):
+        # Reserve `count` sequence numbers of the second `now` (or of the last
+        # second used, if the clock went back), returning (second, first
+        # sequence number), or (second, None) if they don't fit on that second
+        if self._db is None:
+            if now > self._second:
+                self._second, self._seq = now, 0
+            start = self._seq + 1
+            if start + count - 1 > SEQUENCE_MAX:
+                return (self._second, None)
+            self._seq += count
+            return (self._second, start)
+        # BEGIN IMMEDIATE locks the database against other processes until COMMIT
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            row = self._db.execute(
+                'SELECT second, seq FROM event_id_sequences WHERE employer = ? ORDER BY second DESC LIMIT 1',
+                (self.employer,)
+            ).fetchone()
+            if row is None or now > row[0]:
+                second, start = now, 1
+            else:
+                second, start = row[0], row[1] + 1
+            if start + count - 1 > SEQUENCE_MAX:
+                self._db.execute('COMMIT')
+                return (second, None)
+            self._db.execute(
+                'INSERT OR REPLACE INTO event_id_sequences (employer, second, seq) VALUES (?, ?, ?)',
+                (self.employer, second, start + count - 1)
+            )
+            # Only the last second matters
+            self._db.execute(
+                'DELETE FROM event_id_sequences WHERE employer = ? AND second < ?',
+                (self.employer, second)
+            )
+            self._db.execute('COMMIT')
+        except Exception:
+            self._db.execute('ROLLBACK')
+            raise
+        return (second, start)
+
+    def allocate(self, count=1):
+        """Generate `count` Ids (a list), all of the same second."""
+        if not 0 < count <= SEQUENCE_MAX:
+            raise ValueError('count must be between 1 and {}'.format(SEQUENCE_MAX))
+        with self._lock:
+            while True:
+                second, start = self._reserve(self.clock().strftime(TIMESTAMP_FORMAT), count)
+                if start is not None:
+                    break
+                # Sequences of this second are over, wait for the next one
+                while self.clock().strftime(TIMESTAMP_FORMAT) <= second:
+                    self.sleep(0.05)
+        return [
+            'ID{}{}{:0>5}'.format(self.employer, second, seq)
+            for seq in range(start, start + count)
+        ]
+
+    def next(self):
+        """Generate an Id."""
+        return self.allocate(1)[0]
+
+    __call__ = next
@@ -0,0 +1,170 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import heapq
+import random
+import time
+
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
+
+from esocial import xml
+
+
+# status/cdResposta of a batch still waiting to be processed
+BATCH_PROCESSING = '101'
+
+
+class ProtocolPoller(object):
+    """Polls the result of many sent batches until eSocial processes them.
+
+    Each protocol is retrieved after `interval` seconds and, while the batch is
+    still being processed, again after an exponentially growing (and jittered)
+    delay. All polls go through the connection pool of `ws`, so the HTTPS
+    connections and the webservice client are shared by every protocol.
+
+        poller = ProtocolPoller(ws, rate=5)
+        poller.add('1.1.202109.0000000000011111394')
+        for protocol_number, response in poller.poll():
+            print(protocol_number, response.status.cdResposta)
+
+    Parameters
+    ----------
+    ws: a WSClient
+    interval: seconds to wait before the first poll of a protocol
+    max_interval: maximum seconds between two polls of the same protocol
+    backoff: multiplier applied to the wait after every poll
+    jitter: fraction of random variation applied to the waits (0 to 1)
+    rate: maximum number of polls per second. If None, there is no limit.
+    concurrency: maximum number of polls in flight
+    max_errors: consecutive errors (e.g. network errors) before giving up a protocol
+    as_dict: if True, responses are yielded as plain dicts (see
+        xml.parse_response()) instead of DotMaps
+    """
+    def __init__(self, ws, interval=5.0, max_interval=300.0, backoff=2.0, jitter=0.1,
+                 rate=None, concurrency=4, max_errors=3, as_dict=False, clock=time.monotonic, sleep=time.sleep):
+        self.ws = ws
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.rate = rate
+        self.concurrency = concurrency
+        self.max_errors = max_errors
+        self.as_dict = as_dict
+        self.clock = clock
+        self.sleep = sleep
+        self._queue = []
+        self._seq = 0
+        self._last_poll = None
+
+    def __len__(self):
+        return len(self._queue)
+
+    @property
+    def pending(self):
+        """The tracked protocols, not yielded by poll() yet."""
+        return [protocol_number for due, seq, protocol_number, attempt, errors in sorted(self._queue)]
+
+    def _delay(self, attempt):
+        delay = min(self.max_interval, self.interval * (self.backoff ** attempt))
+        if self.jitter:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(0, delay)
+
+    def _schedule(self, protocol_number, attempt, errors, delay):
+        self._seq += 1
+        heapq.heappush(self._queue, (self.clock() + delay, self._seq, protocol_number, attempt, errors))
+
+    def add(self, protocol_number, delay=None):
+        """Track a protocol. It is first polled after `delay` seconds (default: interval)."""
+        if delay is None:
+            delay = self._delay(0)
+        self._schedule(protocol_number, 0, 0, delay)
+
+    def _wait_rate(self):
+        if self.rate:
+            now = self.clock()
+            if self._last_poll is not None:
+                wait_time = self._last_poll + 1.0 / self.rate - now
+                if wait_time > 0:
+                    self.sleep(wait_time)
+                    now = self.clock()
+            self._last_poll = now
+
+    def _retrieve(self, protocol_number):
+        # Responses of batches still being processed are never converted to DotMap
+        return xml.parse_response(self.ws.retrieve(protocol_number))
+
+    def poll(self, timeout=None):
+        """Poll the tracked protocols, yielding (protocol_number, response) as
+        their batches leave the "processing" state.
+
+        response is the decoded response (see xml.decode_response() and
+        `as_dict`) or, if the
+        protocol failed `max_errors` consecutive times, the last exception.
+        If `timeout` seconds pass, stops, without waiting for the polls in
+        flight, and leaves the remaining protocols tracked. Protocols are never lost when the caller stops iterating
+        either: the ones not yielded yet stay tracked (see `pending`), so
+        poll() can be called again later.
+        """
+        deadline = None if timeout is None else self.clock() + timeout
+        in_flight = {}
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            while self._queue or in_flight:
+                if deadline is not None and self.clock() >= deadline:
+                    break
+                while self._queue and self._queue[0][0] <= self.clock() and len(in_flight) < self.concurrency:
+                    due, seq, protocol_number, attempt, errors = heapq.heappop(self._queue)
+                    self._wait_rate()
+                    future = executor.submit(self._retrieve, protocol_number)
+                    in_flight[future] = (protocol_number, attempt, errors)
+                # Waiting for the next protocol due (if a poll can start) or
+                # a poll to finish, but never past the deadline
+                wait_time = None
+                if self._queue and len(in_flight) < self.concurrency:
+                    wait_time = max(0, self._queue[0][0] - self.clock())
+                if deadline is not None:
+                    remaining = max(0, deadline - self.clock())
+                    wait_time = remaining if wait_time is None else min(wait_time, remaining)
+                if not in_flight:
+                    if wait_time:
+                        self.sleep(wait_time)
+                    continue
+                done, pending = wait(list(in_flight), timeout=wait_time, return_when=FIRST_COMPLETED)
+                for future in done:
+                    protocol_number, attempt, errors = in_flight.pop(future)
+                    try:
+                        response = future.result()
+                    except Exception as err:
+                        if errors + 1 >= self.max_errors:
+                            yield (protocol_number, err)
+                        else:
+                            self._schedule(protocol_number, attempt + 1, errors + 1, self._delay(attempt + 1))
+                        continue
+                    if (response['status'] or {}).get('cdResposta') == BATCH_PROCESSING:
+                        self._schedule(protocol_number, attempt + 1, 0, self._delay(attempt + 1))
+                    else:
+                        yield (protocol_number, response if self.as_dict else xml.to_dotmap(response))
+        finally:
+            # Stopped by timeout, or by the caller closing the generator: polls
+            # in flight (or done but not yielded yet) are tracked again, and
+            # the ones still running are not waited for
+            for future, (protocol_number, attempt, errors) in in_flight.items():
+                self._schedule(protocol_number, attempt, errors, 0)
+            executor.shutdown(wait=False)
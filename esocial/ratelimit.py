@@ -0,0 +1,362 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Rate limiting and adaptive concurrency for the eSocial webservices.
+
+AdaptiveLimiter is a WSClient limiter (see WSClient(limiter=...)): each
+webservice endpoint ('send', 'retrieve', 'events_ids' or 'download') gets a
+TokenBucket, spacing the calls, and an AdaptiveConcurrency, bounding the
+calls in progress. The concurrency limit follows AIMD (additive increase,
+multiplicative decrease): it grows slowly while the calls succeed and is cut
+when they fail or their latency spikes, so the clients back off by
+themselves when the webservices are throttling or overloaded.
+"""
+import threading
+import time
+
+from collections import namedtuple
+
+
+# HTTP status codes of a throttling or overloaded webservice
+CONGESTION_STATUS = (429, 502, 503, 504)
+
+
+def congestion_errors():
+    """The exceptions of network errors and timeouts (requests, httpx and zeep)."""
+    from zeep.exceptions import TransportError
+    errors = (OSError, TransportError)
+    try:
+        import httpx
+    except ImportError:
+        return errors
+    return errors + (httpx.TransportError,)
+
+
+def is_congestion(error):
+    """True if `error` is a sign of congestion: a network error or a timeout,
+    or an HTTP response with one of the CONGESTION_STATUS codes. SOAP faults
+    and invalid requests are not."""
+    status_code = getattr(error, 'status_code', None)
+    if status_code is None:
+        status_code = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status_code is not None:
+        return status_code in CONGESTION_STATUS
+    return isinstance(error, congestion_errors())
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class TokenBucket(object):
+    """Up to `rate` calls per second, with bursts of up to `burst` calls.
+
+    Tokens are reserved in order, so the callers wait their turn even
+    when they are many:
+
+        bucket = TokenBucket(rate=5, burst=2)
+        bucket.acquire()  # sleeps if needed
+
+    Parameters
+    ----------
+    rate: tokens added per second
+    burst: maximum number of tokens kept (the bucket starts full)
+    """
+    def __init__(self, rate, burst=1, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0 or burst < 1:
+            raise ValueError('Invalid rate ({}) or burst ({})'.format(rate, burst))
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = float(burst)
+        self._updated = None
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """Take `tokens`, returning the seconds to wait before using them (0 if available)."""
+        with self._lock:
+            now = self.clock()
+            if self._updated is not None:
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self, tokens=1):
+        """Take `tokens`, sleeping until they are available. Returns the seconds slept."""
+        wait_time = self.reserve(tokens)
+        if wait_time > 0:
+            self.sleep(wait_time)
+        return wait_time
+
+
+class AdaptiveConcurrency(object):
+    """Concurrency limit adjusted by the outcome of the calls (AIMD).
+
+    Every successful call adds `increase` / limit to the limit (so it grows
+    by `increase` for each round of `limit` calls), while a failed or slow
+    call multiplies it by `decrease`. Calls started before a decrease don't
+    decrease it again, so a burst of errors cuts the limit only once. The
+    limit stays between `minimum` and `maximum`:
+
+        generation = concurrency.acquire()
+        try:
+            call()
+        except Exception:
+            concurrency.release(generation, success=False)
+            raise
+        concurrency.release(generation, success=True, latency=...)
+
+    Parameters
+    ----------
+    initial: concurrency limit to start with
+    minimum, maximum: bounds of the limit
+    increase: additive increase per round of successful calls
+    decrease: multiplicative decrease (0 to 1) on congestion
+    latency_threshold: seconds above which a successful call counts as
+        congestion. If None, latency is not considered.
+    """
+    def __init__(self, initial=4, minimum=1, maximum=32, increase=1.0, decrease=0.5, latency_threshold=None):
+        if not 1 <= minimum <= initial <= maximum:
+            raise ValueError('Expected 1 <= minimum <= initial <= maximum, got {}, {}, {}'.format(
+                minimum, initial, maximum))
+        if not 0 < decrease < 1:
+            raise ValueError('Expected 0 < decrease < 1, got {}'.format(decrease))
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_threshold = latency_threshold
+        self.in_flight = 0
+        self.successes = 0
+        self.congestions = 0
+        self._generation = 0
+        self._condition = threading.Condition()
+        # (event loop, future) of the coroutines waiting for a slot
+        self._async_waiters = []
+
+    def try_acquire(self):
+        """Take a slot if one is free, returning its generation (None if there is no free slot)."""
+        with self._condition:
+            if self.in_flight >= int(self.limit):
+                return None
+            self.in_flight += 1
+            return self._generation
+
+    def acquire(self):
+        """Take a slot, waiting for one to be free. Returns its generation (see release())."""
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            return self._generation
+
+    async def acquire_async(self):
+        """Same as acquire(), for coroutines: waits without blocking the event loop."""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return self._generation
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            finally:
+                with self._condition:
+                    if (loop, waiter) in self._async_waiters:
+                        self._async_waiters.remove((loop, waiter))
+
+    def release(self, generation, success=None, latency=None):
+        """Free a slot taken by acquire().
+
+        Parameters
+        ----------
+        generation: returned by acquire()
+        success: True if the call succeeded, False if it failed from
+            congestion (e.g. HTTP 5xx, timeouts) or None to adjust nothing
+        latency: seconds the call took
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if success is not None:
+                if success and (self.latency_threshold is None or latency is None
+                                or latency <= self.latency_threshold):
+                    self.successes += 1
+                    self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+                else:
+                    self.congestions += 1
+                    if generation == self._generation:
+                        self._generation += 1
+                        self.limit = max(self.minimum, self.limit * self.decrease)
+            self._condition.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+
+EndpointLimits = namedtuple('EndpointLimits', ('bucket', 'concurrency'))
+
+
+def _by_endpoint(value, endpoint, default=None):
+    # A value for every endpoint, or a dict by endpoint
+    if isinstance(value, dict):
+        return value.get(endpoint, default)
+    return value
+
+
+class _LimiterCall(object):
+    # The limits held during one webservice call
+    __slots__ = ('limiter', 'limits', 'generation', 'started')
+
+    def __init__(self, limiter, limits):
+        self.limiter = limiter
+        self.limits = limits
+        self.generation = None
+        self.started = None
+
+    def __enter__(self):
+        if self.limits.concurrency is not None:
+            self.generation = self.limits.concurrency.acquire()
+        try:
+            if self.limits.bucket is not None:
+                self.limits.bucket.acquire()
+        except BaseException:
+            self._release(None)
+            raise
+        self.started = self.limiter.clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._release(True)
+        elif self.limiter.is_congestion(exc_value):
+            self._release(False)
+        else:
+            self._release(None)
+
+    async def __aenter__(self):
+        import asyncio
+        if self.limits.concurrency is not None:
+            self.generation = await self.limits.concurrency.acquire_async()
+        try:
+            if self.limits.bucket is not None:
+                wait_time = self.limits.bucket.reserve()
+                if wait_time > 0:
+                    await asyncio.sleep(wait_time)
+        except BaseException:
+            self._release(None)
+            raise
+        self.started = self.limiter.clock()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.__exit__(exc_type, exc_value, traceback)
+
+    def _release(self, success):
+        if self.limits.concurrency is not None:
+            latency = None if self.started is None else self.limiter.clock() - self.started
+            self.limits.concurrency.release(self.generation, success=success, latency=latency)
+
+
+class AdaptiveLimiter(object):
+    """Rate and adaptive concurrency limits by webservice endpoint.
+
+    Calling it with an endpoint ('send', 'retrieve', 'events_ids' or
+    'download') returns the context manager held by WSClient (or
+    AsyncWSClient) during each call to that webservice, so it is given to
+    the clients as their limiter. A limiter shared by many clients (e.g.
+    the WSClientPool limiter) limits them together:
+
+        limiter = AdaptiveLimiter(rate={'send': 2, 'retrieve': 10}, concurrency=4,
+                                  latency_threshold={'send': 30, 'retrieve': 10})
+        ws = WSClient(pfx_file='...', pfx_passw='...', employer_id=employer_id, limiter=limiter)
+
+    Calls failing from congestion (see is_congestion(): network errors,
+    timeouts and HTTP 429/502/503/504) decrease the concurrency limit of the
+    endpoint (see AdaptiveConcurrency). Other exceptions, e.g. SOAP faults
+    or validation errors, don't adjust it.
+
+    Every parameter but errors, clock and sleep is a value for all the
+    endpoints or a dict by endpoint.
+
+    Parameters
+    ----------
+    rate: maximum number of calls per second. If None, there is no limit.
+    burst: calls allowed at once, above rate (see TokenBucket)
+    concurrency: initial concurrency limit. If None, there is no limit.
+    min_concurrency, max_concurrency: bounds of the concurrency limit
+    increase, decrease, latency_threshold: see AdaptiveConcurrency
+    errors: exception classes counting as congestion, instead of
+        is_congestion()
+    """
+    def __init__(self, rate=None, burst=1, concurrency=4, min_concurrency=1, max_concurrency=32,
+                 increase=1.0, decrease=0.5, latency_threshold=None, errors=None,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_threshold = latency_threshold
+        self.errors = errors
+        self.clock = clock
+        self.sleep = sleep
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def endpoint(self, endpoint):
+        """The EndpointLimits (bucket, concurrency) of `endpoint`, either may be None."""
+        limits = self._endpoints.get(endpoint)
+        if limits is None:
+            with self._lock:
+                limits = self._endpoints.get(endpoint)
+                if limits is None:
+                    limits = self._endpoints[endpoint] = self._make_limits(endpoint)
+        return limits
+
+    def _make_limits(self, endpoint):
+        bucket = concurrency = None
+        rate = _by_endpoint(self.rate, endpoint)
+        if rate:
+            bucket = TokenBucket(rate, _by_endpoint(self.burst, endpoint, 1), clock=self.clock, sleep=self.sleep)
+        initial = _by_endpoint(self.concurrency, endpoint)
+        if initial is not None:
+            concurrency = AdaptiveConcurrency(
+                initial=initial,
+                minimum=min(initial, _by_endpoint(self.min_concurrency, endpoint, 1)),
+                maximum=max(initial, _by_endpoint(self.max_concurrency, endpoint, 32)),
+                increase=_by_endpoint(self.increase, endpoint, 1.0),
+                decrease=_by_endpoint(self.decrease, endpoint, 0.5),
+                latency_threshold=_by_endpoint(self.latency_threshold, endpoint)
+            )
+        return EndpointLimits(bucket, concurrency)
+
+    def is_congestion(self, error):
+        """True if the call failing with `error` decreases the concurrency limit."""
+        if self.errors is None:
+            return is_congestion(error)
+        return isinstance(error, self.errors)
+
+    def __call__(self, endpoint):
+        return _LimiterCall(self, self.endpoint(endpoint))
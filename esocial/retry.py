@@ -0,0 +1,282 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Retries of batches whose transmission failed, without duplicating events.
+
+When sending a batch fails (e.g. on a timeout), eSocial may or may not have
+received it, and sending it again would duplicate the events that were
+received (or get them rejected). So, before each retry, IdempotentSender
+finds out which events of the batch landed, by the protocol of their batch
+(when the WSClient store knows it) or by the events identifiers webservices,
+and sends again only the missing ones.
+
+The identifiers webservices only list the events of processed batches: the
+events of a batch received but still being processed when they are queried
+are not found, and are sent again. That's why the first retry waits longer
+than eSocial usually takes to process a batch (see IdempotentSender interval).
+"""
+import datetime
+import random
+import time
+
+from collections import OrderedDict
+
+from lxml import etree
+
+import esocial
+
+from esocial import xml
+from esocial.download import EventsDownloader
+from esocial.polling import BATCH_PROCESSING
+
+
+def transport_errors():
+    """The exceptions of a failed transmission: network errors, timeouts and
+    unexpected HTTP responses."""
+    from zeep.exceptions import TransportError
+    return (OSError, TransportError)
+
+
+def _findtext(element, tagname):
+    tag = xml.find(element, tagname)
+    return tag.text if tag is not None else None
+
+
+class IdempotentSender(object):
+    """Sends the batches of a WSClient, retrying the failed transmissions
+    with the events that did not reach eSocial only.
+
+        sender = IdempotentSender(ws, retries=3)
+        for event in events:
+            ws.add_event(event)
+        sent = sender.send()
+        print(sent['response'], sent['landed'])
+
+    The events are sent again with the same Id's. Events received by eSocial
+    are found by the protocol of their batch (with a WSClient store, see
+    esocial.store.EventStore), or else by the identifiers of the table
+    events, of the workers (cpfTrab) events received `window` around the
+    first transmission, and of the periodic events without worker of their
+    period. Events that can not be found this way (e.g. non periodic events
+    without cpfTrab, or periodic events beyond the first IDS_MAX_RESULTS of
+    their period, see EventsDownloader) are sent again.
+
+    A batch whose transmission failed has no protocol, so its events are
+    looked for with the identifiers webservices, which don't see the
+    batches still being processed: `interval` must be longer than the
+    processing time of a batch, or the events of a batch received but not
+    processed yet are sent again (and rejected as duplicates). With a
+    store, events already sent with a protocol (e.g. before the
+    application restarted) are not sent again: their batch is retrieved,
+    waiting for it to be processed, before the first transmission.
+
+    Parameters
+    ----------
+    ws: a WSClient (not an AsyncWSClient)
+    retries: maximum number of retries of a batch
+    interval: seconds to wait before the first retry, so eSocial has time
+        to process the batch that may have been received (see above)
+    max_interval: maximum seconds between two retries
+    backoff: multiplier applied to the wait after every retry
+    jitter: fraction of random variation applied to the waits (0 to 1)
+    window: datetime.timedelta before and after the first transmission where
+        the events are searched (the identifiers webservices use the time
+        of Brasília)
+    concurrency: maximum number of identifiers queries in flight
+    retry_on: exception classes of failed transmissions (default:
+        transport_errors())
+    poll_interval: seconds between the queries (retrieve) of a batch being
+        processed
+    processing_timeout: maximum seconds waiting for a batch to be
+        processed; its events are then considered received, without
+        receipt number
+    """
+    def __init__(self, ws, retries=3, interval=300.0, max_interval=1800.0, backoff=2.0, jitter=0.1,
+                 window=datetime.timedelta(days=1), concurrency=4, retry_on=None,
+                 poll_interval=10.0, processing_timeout=600.0,
+                 now=datetime.datetime.now, sleep=time.sleep):
+        self.ws = ws
+        self.retries = retries
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.window = window
+        self.concurrency = concurrency
+        self.retry_on = transport_errors() if retry_on is None else retry_on
+        self.poll_interval = poll_interval
+        self.processing_timeout = processing_timeout
+        self.now = now
+        self.sleep = sleep
+
+    def _delay(self, attempt):
+        delay = min(self.max_interval, self.interval * (self.backoff ** attempt))
+        if self.jitter:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(0, delay)
+
+    def _retrieve_processed(self, protocol):
+        # The retrieve response of a batch, once processed (or on timeout)
+        waited = 0
+        while True:
+            response = xml.parse_response(self.ws.retrieve(protocol))
+            if (response['status'] or {}).get('cdResposta') != BATCH_PROCESSING:
+                return response
+            if waited >= self.processing_timeout:
+                return response
+            self.sleep(self.poll_interval)
+            waited += self.poll_interval
+
+    def find_landed(self, events, since=None, identifiers=True):
+        """The events (signed ElementTrees) received by eSocial.
+
+        Parameters
+        ----------
+        events: the events looked for
+        since: when the events were first sent (default: now)
+        identifiers: if False, only the events with a protocol in the
+            WSClient store are looked for (no identifiers queries)
+
+        Returns
+        -------
+        An OrderedDict of event Id: receipt number (nrRecibo), which is None
+        if the batch of the event is still being processed after
+        `processing_timeout`. Raises an Exception if a query fails.
+        """
+        store = self.ws.store
+        event_ids = []
+        by_protocol = OrderedDict()
+        table_events = set()
+        periodic_events = set()
+        cpfs = set()
+        for event in events:
+            root = event.getroot()
+            event_tag = root[0]
+            event_id = event_tag.get('Id')
+            event_ids.append(event_id)
+            row = store.get(event_id) if store is not None else None
+            if row is not None and row['protocol']:
+                by_protocol.setdefault(row['protocol'], []).append(event_id)
+                continue
+            if not identifiers:
+                continue
+            code, group = esocial._EVENTS.get(etree.QName(event_tag).localname, (None, None))
+            if group == esocial._GROUP_TABLE:
+                table_events.add(code)
+                continue
+            # Events of workers (e.g. S-1200) are not found by the employer
+            # events query, even if periodic
+            cpf = _findtext(root, 'cpfTrab')
+            if cpf:
+                cpfs.add(cpf)
+            elif group == esocial._GROUP_PERIODIC:
+                period = _findtext(root, 'perApur')
+                if period:
+                    periodic_events.add((code, period))
+        found = {}
+        for protocol, protocol_ids in by_protocol.items():
+            response = self._retrieve_processed(protocol)
+            if (response['status'] or {}).get('cdResposta') == BATCH_PROCESSING:
+                found.update((event_id, None) for event_id in protocol_ids)
+                continue
+            for evt in response['eventos']:
+                receipt = evt.get('recibo') or {}
+                if evt['id'] in protocol_ids and receipt.get('nrRecibo'):
+                    found[evt['id']] = receipt['nrRecibo']
+        if table_events or periodic_events or cpfs:
+            since = since or self.now()
+            dt_ini, dt_fim = since - self.window, self.now() + self.window
+            downloader = EventsDownloader(self.ws, concurrency=self.concurrency)
+            received = OrderedDict()
+            if table_events:
+                received.update(downloader.table_events_ids(sorted(table_events), dt_ini, dt_fim))
+            for code, period in sorted(periodic_events):
+                received.update(downloader.employer_events_ids([code], [period]))
+            if cpfs:
+                received.update(downloader.employee_events_ids(sorted(cpfs), dt_ini, dt_fim))
+            if downloader.errors:
+                raise Exception('Could not find the events received by eSocial: {}'.format(downloader.errors))
+            for event_id, nr_recibo in received.items():
+                if event_id not in found:
+                    found[event_id] = nr_recibo
+        landed = OrderedDict((event_id, found[event_id]) for event_id in event_ids if event_id in found)
+        if store is not None:
+            store.set_receipts(dict(
+                (event_id, nr_recibo) for event_id, nr_recibo in landed.items() if nr_recibo
+            ))
+        return landed
+
+    def send(self, batch=None, group_id=1, stream=False):
+        """Send a batch of signed events, retrying it as needed.
+
+        Parameters
+        ----------
+        batch: list of signed events (lxml.etree._ElementTree). If None, the
+            WSClient batch is sent and, once sent, cleared.
+        group_id, stream: same as in WSClient.send()
+
+        Returns
+        -------
+        A dict:
+            response: the webservice response to the last batch sent (None
+                if every event had landed)
+            batch: the last batch envelop sent (see WSClient.send())
+            sent: the Id's of the events of the last batch sent
+            landed: OrderedDict of event Id: receipt number (see
+                find_landed()) of the events found received, already sent
+                with a protocol (store) or after a failure, which were not
+                sent again
+            attempts: number of transmissions
+
+        The error of the last transmission is raised if every retry fails.
+        """
+        clear_batch = batch is None
+        if batch is None:
+            batch = list(self.ws.batch)
+        pending = OrderedDict((event.getroot()[0].get('Id'), event) for event in batch)
+        result = {'response': None, 'batch': None, 'sent': [], 'landed': OrderedDict(), 'attempts': 0}
+        started = self.now()
+        if self.ws.store is not None:
+            # Events already sent with a protocol are retrieved, not sent again
+            for event_id, nr_recibo in self.find_landed(list(pending.values()), identifiers=False).items():
+                result['landed'][event_id] = nr_recibo
+                del pending[event_id]
+        error = None
+        for retry in range(self.retries + 1):
+            if retry:
+                self.sleep(self._delay(retry - 1))
+                try:
+                    landed = self.find_landed(list(pending.values()), since=started)
+                except Exception as err:
+                    # Not known which events landed: nothing is sent this time
+                    error = err
+                    continue
+                for event_id, nr_recibo in landed.items():
+                    result['landed'][event_id] = nr_recibo
+                    del pending[event_id]
+            if not pending:
+                break
+            result['attempts'] += 1
+            try:
+                response, batch_sent = self.ws._send_batch(group_id, list(pending.values()), stream=stream)
+            except self.retry_on as err:
+                error = err
+                continue
+            result.update(response=response, batch=batch_sent, sent=list(pending))
+            break
+        else:
+            raise error
+        if clear_batch:
+            self.ws.clear_batch()
+        return result
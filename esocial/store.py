@@ -0,0 +1,276 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Local store of the events sent to eSocial."""
+import hashlib
+import sqlite3
+import threading
+import time
+
+from lxml import etree
+
+import esocial
+
+from esocial import xml
+
+
+_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS events (
+        id TEXT PRIMARY KEY,
+        event TEXT NOT NULL,
+        code TEXT,
+        employer TEXT,
+        cpf TEXT,
+        period TEXT,
+        digest TEXT NOT NULL,
+        grupo INTEGER,
+        protocol TEXT,
+        nr_recibo TEXT,
+        status TEXT,
+        status_desc TEXT,
+        created REAL NOT NULL,
+        updated REAL NOT NULL,
+        xml BLOB NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS events_protocol ON events (protocol)',
+    'CREATE INDEX IF NOT EXISTS events_nr_recibo ON events (nr_recibo)',
+    'CREATE INDEX IF NOT EXISTS events_cpf ON events (cpf)',
+    'CREATE INDEX IF NOT EXISTS events_code_period ON events (code, period)',
+    'CREATE INDEX IF NOT EXISTS events_digest ON events (digest)',
+)
+
+# Columns returned by get() and find() (the XML is loaded by load_event())
+_COLUMNS = (
+    'id', 'event', 'code', 'employer', 'cpf', 'period', 'digest', 'grupo',
+    'protocol', 'nr_recibo', 'status', 'status_desc', 'created', 'updated',
+)
+
+_FILTERS = ('event', 'code', 'employer', 'cpf', 'period', 'digest', 'protocol', 'nr_recibo', 'status')
+
+
+def event_digest(event):
+    """SHA256 of the canonical event, without its Id and signature.
+
+    Two events with the same content have the same digest, whatever their
+    Id's, so it identifies re-submissions of an event.
+    """
+    root = event.getroot() if isinstance(event, etree._ElementTree) else event
+    root = etree.fromstring(etree.tostring(root))
+    for signature in root.findall('{http://www.w3.org/2000/09/xmldsig#}Signature'):
+        root.remove(signature)
+    root[0].attrib.pop('Id', None)
+    return hashlib.sha256(etree.tostring(root, method='c14n')).hexdigest()
+
+
+def _findtext(element, tagname):
+    tag = xml.find(element, tagname)
+    return tag.text if tag is not None else None
+
+
+class EventStore(object):
+    """SQLite store of the signed events, with their batch protocol, receipt
+    number (nrRecibo) and processing status, indexed by Id, protocol, receipt,
+    CPF, event type and period.
+
+    With a store, WSClient records every event before sending its batch and
+    updates it with the protocol and, on retrieve(), with the processing
+    results:
+
+        store = EventStore('/var/lib/esocial/eventos.db')
+        ws = WSClient(..., store=store)
+        ws.send()
+        ws.retrieve(protocol_number)
+        store.find(cpf='12345678901', code='S-2220')
+
+    Parameters
+    ----------
+    path: the database file (default: an in-memory database)
+
+    The store can be shared by many threads.
+    """
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            if path != ':memory:':
+                self._db.execute('PRAGMA journal_mode=WAL')
+            for statement in _SCHEMA:
+                self._db.execute(statement)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM events').fetchone()[0]
+
+    def __contains__(self, event_id):
+        return self.get(event_id) is not None
+
+    def add(self, event, grupo=None, protocol=None):
+        """Record a signed event (ElementTree). Returns its Id.
+
+        An event already stored with the same Id is replaced, losing its
+        protocol, receipt and status.
+        """
+        root = event.getroot()
+        event_tag = root[0]
+        event_name = etree.QName(event_tag).localname
+        code = esocial._EVENTS.get(event_name, (None, None))[0]
+        now = time.time()
+        row = (
+            event_tag.get('Id'),
+            event_name,
+            code,
+            _findtext(root, 'ideEmpregador/nrInsc'),
+            _findtext(root, 'cpfTrab'),
+            _findtext(root, 'perApur'),
+            event_digest(event),
+            grupo,
+            protocol,
+            now,
+            now,
+            etree.tostring(event),
+        )
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO events '
+                '(id, event, code, employer, cpf, period, digest, grupo, protocol, created, updated, xml) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                row
+            )
+        return row[0]
+
+    def add_many(self, events, grupo=None, protocol=None):
+        return [self.add(event, grupo=grupo, protocol=protocol) for event in events]
+
+    def set_protocol(self, event_ids, protocol):
+        """Set the batch protocol (protocoloEnvio) of the events."""
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                'UPDATE events SET protocol = ?, updated = ? WHERE id = ?',
+                [(protocol, now, event_id) for event_id in event_ids]
+            )
+
+    def set_status(self, event_ids, status, status_desc=None):
+        """Set the status (cdResposta) of the events, e.g. when their batch was rejected."""
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                'UPDATE events SET status = ?, status_desc = ?, updated = ? WHERE id = ?',
+                [(status, status_desc, now, event_id) for event_id in event_ids]
+            )
+
+    def set_receipts(self, receipts):
+        """Set the receipt numbers (nrRecibo) of the events, from a dict of event Id: receipt number."""
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                'UPDATE events SET nr_recibo = ?, updated = ? WHERE id = ?',
+                [(nr_recibo, now, event_id) for event_id, nr_recibo in receipts.items()]
+            )
+
+    def update_from_response(self, response):
+        """Update the events with the results of a processed batch.
+
+        Parameters
+        ----------
+        response: the decoded retrieve() response (see xml.parse_response()
+            and xml.decode_response())
+
+        Returns
+        -------
+        The number of events updated.
+        """
+        if hasattr(response, 'toDict'):
+            response = response.toDict()
+        protocol = (response.get('lote') or {}).get('protocoloEnvio')
+        now = time.time()
+        rows = []
+        for evt in response.get('eventos') or []:
+            processing = evt.get('processamento') or {}
+            receipt = evt.get('recibo') or {}
+            rows.append((
+                receipt.get('nrRecibo'),
+                processing.get('cdResposta'),
+                processing.get('descResposta'),
+                now,
+                protocol,
+                evt.get('id'),
+            ))
+        with self._lock, self._db:
+            cursor = self._db.executemany(
+                'UPDATE events SET nr_recibo = ?, status = ?, status_desc = ?, updated = ?, '
+                'protocol = COALESCE(?, protocol) WHERE id = ?',
+                rows
+            )
+            return cursor.rowcount
+
+    def get(self, event_id):
+        """The stored data of an event (a dict, without the XML) or None."""
+        rows = self.find(id=event_id)
+        return rows[0] if rows else None
+
+    def find(self, limit=None, **filters):
+        """The events matching all the filters (id, event, code, employer, cpf,
+        period, digest, protocol, nr_recibo or status), oldest first.
+
+            store.find(cpf='12345678901', code='S-2220')
+            store.find(protocol='1.1.202109.0000000000011111394')
+        """
+        where = []
+        params = []
+        for column, value in filters.items():
+            if column != 'id' and column not in _FILTERS:
+                raise ValueError('Can not filter events by {}'.format(column))
+            if value is None:
+                where.append('{} IS NULL'.format(column))
+            else:
+                where.append('{} = ?'.format(column))
+                params.append(value)
+        query = 'SELECT {} FROM events'.format(', '.join(_COLUMNS))
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY created, rowid'
+        if limit is not None:
+            query += ' LIMIT {:d}'.format(limit)
+        with self._lock:
+            return [dict(row) for row in self._db.execute(query, params)]
+
+    def load_event(self, event_id):
+        """The signed event (ElementTree) or None."""
+        with self._lock:
+            row = self._db.execute('SELECT xml FROM events WHERE id = ?', (event_id,)).fetchone()
+        return xml.load_fromstring(row[0]) if row is not None else None
+
+    def duplicate_of(self, event):
+        """The stored data of an event with the same content (see
+        event_digest()) that was not rejected, or None: sending `event` again
+        would be a re-submission.
+        """
+        digest = event_digest(event)
+        for row in self.find(digest=digest):
+            if row['status'] is None or row['status'].startswith('2'):
+                return row
+        return None
@@ -20,7 +20,7 @@ from esocial import client
 here = os.path.dirname(os.path.abspath(__file__))
 # there = os.path.dirname(os.path.abspath(esocial.__file__))
 
-def ws_factory():
+def ws_factory(**kwargs):
     employer_id = {
         'tpInsc': 1,
         'nrInsc': '12345678901234'
@@ -29,5 +29,30 @@ def ws_factory():
         pfx_file=os.path.join(here, 'certs', 'libesocial-cert-test.pfx'),
         pfx_passw='cert@test',
         employer_id=employer_id,
-        target=2
+        target=2,
+        **kwargs
     )
+
+
+def soap_response(operation, xml_file, namespace='http://www.esocial.gov.br/servicos/empregador/lote/eventos/envio/consulta/retornoProcessamento/v1_1_0'):
+    """SOAP envelope, as the eSocial webservices return, with the content of xml_file as the operation result."""
+    with open(os.path.join(here, 'xml', xml_file), 'rb') as fp:
+        content = fp.read()
+    if content.startswith(b'<?xml'):
+        content = content.split(b'?>', 1)[1]
+    return b''.join([
+        b'<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body>',
+        '<{op}Response xmlns="{ns}"><{op}Result>'.format(op=operation, ns=namespace).encode('utf-8'),
+        content,
+        '</{op}Result></{op}Response>'.format(op=operation).encode('utf-8'),
+        b'</s:Body></s:Envelope>',
+    ])
+
+
+def wsdl_cache_factory(path):
+    """WSDLCache with the test WSDLs stored under the send and retrieve webservices URLs."""
+    cache = client.WSDLCache(path=str(path))
+    for which, wsdl_file in (('send', 'WsEnviarLoteEventos.wsdl'), ('retrieve', 'WsConsultarLoteEventos.wsdl')):
+        with open(os.path.join(here, 'wsdl', wsdl_file), 'rb') as fp:
+            cache.add(esocial._WS_URL['tests'][which], fp.read())
+    return cache
@@ -12,12 +12,30 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
+import io
+import os
+import time
+import asyncio
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 import requests
 
+import esocial
+
 from esocial import client
+from esocial import xml
 
-from esocial.tests import ws_factory
+from lxml import etree
+
+from esocial.tests import (
+    here,
+    soap_response,
+    wsdl_cache_factory,
+    ws_factory,
+)
 
 def test_client_target():
     target_tests = [
@@ -36,8 +54,464 @@ def test_client_target():
 def test_client_connect():
     # This test is only for the https transport, once the connection will fail because of the
     # self signed certificate and non-authorized entity
-    ws = ws_factory()
+    # (the WSDL is downloaded)
+    ws = ws_factory(wsdl_cache=client.WSDLCache())
     with pytest.raises(requests.exceptions.HTTPError) as exception_info:
         wsdl_client = ws.connect(ws.esocial_send_url())
     assert '403 Client Error: Forbidden for url' in str(exception_info)
     # wsdl_client.wsdl.dump()
+
+
+def test_client_pool():
+    wsdl_file = os.path.join(here, 'wsdl', 'WsConsultarLoteEventos.wsdl')
+    with ws_factory() as ws:
+        session = ws.connection_pool.session()
+        wsdl_client = ws.connect(wsdl_file)
+        assert ws.connect(wsdl_file) is wsdl_client, '[connect] Expected the same zeep client for the same url'
+        assert wsdl_client.transport.session is session, '[connect] Expected the shared transport session'
+        assert ws.connection_pool.session() is session, '[connect] Expected the same session between calls'
+    assert ws.connection_pool._session is None, '[close] Expected session to be closed'
+    assert ws.connect(wsdl_file) is not wsdl_client, '[close] Expected a new zeep client after close()'
+
+
+def test_client_wsdl_cache(tmp_path):
+    url = 'https://webservices.producaorestrita.esocial.gov.br/servicos/empregador/consultarloteeventos/WsConsultarLoteEventos.svc?wsdl'
+    with open(os.path.join(here, 'wsdl', 'WsConsultarLoteEventos.wsdl'), 'rb') as fp:
+        wsdl_content = fp.read()
+    cache = client.WSDLCache(path=str(tmp_path))
+    assert cache.get(url) is None, '[WSDLCache] Expected a cache miss'
+    cache.add(url, wsdl_content)
+    assert cache.get(url) == wsdl_content, '[WSDLCache] Expected a cache hit'
+    assert client.WSDLCache(path=str(tmp_path), timeout=0).get(url) is None, '[WSDLCache] Expected an expired document'
+    ws = client.WSClient(wsdl_cache=cache, offline=True)
+    wsdl_client = ws.connect(url)
+    assert wsdl_client.get_element('ns1:ConsultarLoteEventos') is not None
+    with pytest.raises(client.WSDLNotCachedError):
+        ws.connect(ws.esocial_send_url())
+
+
+def test_client_bundled_wsdl(tmp_path, monkeypatch):
+    monkeypatch.setenv('ESOCIAL_WSDL_CACHE', str(tmp_path))
+    cache = client.WSDLCache.default()
+    assert cache.path == str(tmp_path), '[WSDLCache] Expected the user cache directory'
+    # The bundled WSDLs are opt-in
+    assert not cache.bundled, '[WSDLCache] Expected the bundled WSDLs off by default'
+    with pytest.raises(client.WSDLNotCachedError):
+        client.WSClient(offline=True).connect(esocial._WS_URL['tests']['send'])
+    # With them, every webservice works offline on a fresh install
+    for target in ('tests', 'production'):
+        ws = client.WSClient(target=target, offline=True, wsdl_cache=client.WSDLCache(bundled=True))
+        for services in (esocial._WS_URL[target], esocial._WS_URL_DOWN[target]):
+            for url in services.values():
+                address = ws.connect(url).service._binding_options['address']
+                assert address == url.split('?')[0], '[WSDLCache] Expected {}, got {}'.format(url, address)
+
+
+def test_client_add_events():
+    ws = ws_factory()
+    events = [
+        xml.load_fromfile(os.path.join(here, 'xml', 'S-2220-v{}-not_signed.xml'.format(esocial.__esocial_version__))),
+        xml.load_fromfile(os.path.join(here, 'xml', 'S-2240-v{}-not_signed.xml'.format(esocial.__esocial_version__))),
+        xml.load_fromfile(os.path.join(here, 'xml', 'S-2220-v{}-not_signed.xml'.format(esocial.__esocial_version__))),
+    ]
+    # Invalid event: missing its required "ideEvento" group
+    invalid_evt = events[2].getroot().getchildren()[0]
+    invalid_evt.remove(xml.find(invalid_evt, 'ideEvento'))
+    results = ws.add_events(events, gen_event_id=True, workers=2)
+    assert len(results) == 3, '[add_events] Expected 3 results, got {}'.format(len(results))
+    for i, tag_name in enumerate(('evtMonit', 'evtExpRisco')):
+        evt_id, evt_sig = results[i]
+        evt_tag = xml.find(evt_sig.getroot(), tag_name)
+        assert evt_tag.get('Id') == evt_id, '[add_events] Expected {}, got {}'.format(evt_id, evt_tag.get('Id'))
+        xml.XMLValidate(evt_sig).validate()
+    assert isinstance(results[2][1], xml.XMLValidateError), '[add_events] Expected XMLValidateError, got {}'.format(results[2][1])
+    assert results[2][1].errors, '[add_events] Expected the validation errors'
+    assert len(ws.batch) == 2, '[add_events] Expected 2 events on batch, got {}'.format(len(ws.batch))
+    # Same results in the current process
+    serial_results = ws_factory().add_events(events[:2], workers=0)
+    assert [r[0] for r in serial_results] == [r[0] for r in results[:2]]
+
+
+def test_client_validation():
+    evt_file = os.path.join(here, 'xml', 'S-2220-v{}-not_signed.xml'.format(esocial.__esocial_version__))
+    ws = ws_factory(validation=client.VALIDATE_ONCE)
+    validated = ws._validate_event.__self__
+    for i in range(2):
+        ws.add_event(xml.load_fromfile(evt_file))
+    assert (validated.misses, validated.hits) == (1, 1), '[validation] Expected the same event to be validated once'
+    invalid = xml.load_fromfile(evt_file)
+    invalid_evt = invalid.getroot()[0]
+    invalid_evt.remove(xml.find(invalid_evt, 'ideEvento'))
+    with pytest.raises(xml.XMLValidateError):
+        ws.add_event(invalid)
+    ws = ws_factory(validation=client.VALIDATE_TRUST)
+    results = ws.add_events([invalid], workers=0)
+    assert not isinstance(results[0][1], Exception), '[validation] Expected the trusted event not to be validated'
+    with pytest.raises(ValueError):
+        ws_factory(validation='sometimes')
+
+
+def test_client_partition_events():
+    evt2220 = xml.load_fromfile(os.path.join(here, 'xml', 'S-2220-v{}-not_signed.xml'.format(esocial.__esocial_version__)))
+    evt1200 = xml.load_fromjson({
+        'eSocial': {
+            '__ATTRS__': {'xmlns': 'http://www.esocial.gov.br/schema/evt/evtRemun/v_S_01_01_00'},
+            'evtRemun': {'__ATTRS__': {'Id': 'ID1'}, 'ideEvento': {'indApuracao': 1}},
+        }
+    })
+    evt3000 = xml.load_fromjson({
+        'eSocial': {
+            '__ATTRS__': {'xmlns': 'http://www.esocial.gov.br/schema/evt/evtExclusao/v_S_01_01_00'},
+            'evtExclusao': {'__ATTRS__': {'Id': 'ID2'}, 'infoExclusao': {'tpEvento': 'S-1200'}},
+        }
+    })
+    assert xml.event_group(evt2220) == 2, '[event_group] Expected 2, got {}'.format(xml.event_group(evt2220))
+    assert xml.event_group(evt1200) == 3, '[event_group] Expected 3, got {}'.format(xml.event_group(evt1200))
+    assert xml.event_group(evt3000) == 3, '[event_group] Expected 3, got {}'.format(xml.event_group(evt3000))
+    events = [evt2220] * 5 + [evt1200] * 3 + [evt3000]
+    batches = list(client.partition_events(events, batch_size=2))
+    groups = [(group_id, len(batch)) for group_id, batch in batches]
+    assert groups == [(2, 2), (2, 2), (3, 2), (3, 2), (2, 1)], '[partition_events] Got {}'.format(groups)
+
+
+def test_client_send_events():
+    ws = ws_factory()
+    sent = []
+    batch_response = xml.load_fromfile(os.path.join(here, 'xml', 'Batch_Response.xml')).getroot()
+
+    def send_batch(group_id, batch, stream=False):
+        sent.append((group_id, len(batch)))
+        return (batch_response, ws._make_send_envelop(group_id, batch))
+
+    ws._send_batch = send_batch
+    ws.max_batch_size = 4
+    evt_file = os.path.join(here, 'xml', 'S-2220-v{}-not_signed.xml'.format(esocial.__esocial_version__))
+    events = [xml.load_fromfile(evt_file) for i in range(6)]
+    results = ws.send_events(events, gen_event_id=True, workers=0, concurrency=2)
+    assert sorted(sent) == [(2, 2), (2, 4)], '[send_events] Got {}'.format(sent)
+    assert len(results) == 6, '[send_events] Expected 6 events, got {}'.format(len(results))
+    for event_id, result in results.items():
+        assert result['error'] is None, '[send_events] {}: {}'.format(event_id, result['error'])
+        assert result['protocol'] == '1.1.202109.0000000000011111111', '[send_events] Got {}'.format(result['protocol'])
+    assert [r['batch'] for r in results.values()] == [0] * 4 + [1] * 2
+
+    # At most concurrency batches are sent, and one more signed, at a time
+    signed = []
+    sent = []
+    ahead = []
+    sign_events = ws._sign_events
+
+    def count_signed(*args):
+        signed.append(1)
+        return sign_events(*args)
+
+    def slow_send_batch(group_id, batch, stream=False):
+        ahead.append(len(signed) - len(sent))
+        time.sleep(0.02)
+        sent.append(1)
+        return (batch_response, None)
+
+    ws._sign_events = count_signed
+    ws._send_batch = slow_send_batch
+    ws.max_batch_size = 1
+    results = ws.send_events((xml.load_fromfile(evt_file) for i in range(8)), gen_event_id=True, workers=0, concurrency=2)
+    assert len(results) == 8 and len(sent) == 8, '[send_events] Got {} results, {} sent'.format(len(results), len(sent))
+    assert max(ahead) <= 3, '[send_events] Expected at most 3 batches signed and not sent, got {}'.format(ahead)
+
+    # No certificate
+    ws = client.WSClient(employer_id={'tpInsc': 1, 'nrInsc': '12345678901234'})
+    with pytest.raises(Exception, match='pfx_file and pfx_passw are needed'):
+        ws.send_events(events, workers=2)
+
+
+class FakeAdapter(requests.adapters.BaseAdapter):
+    def __init__(self, content):
+        super(FakeAdapter, self).__init__()
+        self.content = content
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        request.chunks = None
+        if request.body is not None and not isinstance(request.body, (bytes, str)):
+            # Streamed body
+            request.chunks = list(request.body)
+            request.body = b''.join(request.chunks)
+        response = requests.Response()
+        response.status_code = 200
+        response.headers['Content-Type'] = 'text/xml; charset=utf-8'
+        response._content = self.content
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+def test_client_send_stream(tmp_path):
+    ws = client.WSClient(
+        pfx_file=os.path.join(here, 'certs', 'libesocial-cert-test.pfx'),
+        pfx_passw='cert@test',
+        employer_id={'tpInsc': 1, 'nrInsc': '12345678901234'},
+        wsdl_cache=wsdl_cache_factory(tmp_path),
+        offline=True
+    )
+    adapter = FakeAdapter(soap_response(
+        'EnviarLoteEventos',
+        'Batch_Response.xml',
+        namespace='http://www.esocial.gov.br/servicos/empregador/lote/eventos/envio/v1_1_0'
+    ))
+    ws.connection_pool._session = requests.Session()
+    ws.connection_pool._session.mount('https://', adapter)
+    evt_file = os.path.join(here, 'xml', 'S-2220-v{}-not_signed.xml'.format(esocial.__esocial_version__))
+    envelops = []
+    for stream, workers in ((False, 0), (True, 0), (True, 2)):
+        # With workers, the events serialized by the sign workers are sent as they are
+        ws.add_events([xml.load_fromfile(evt_file) for i in range(3)], gen_event_id=True, workers=workers)
+        result, batch_sent = ws.send(stream=stream)
+        decoded = xml.parse_base_response(result)
+        assert decoded['lote']['protocoloEnvio'] == '1.1.202109.0000000000011111111', '[send] Got {}'.format(decoded)
+        request = adapter.requests[-1]
+        if stream:
+            # Sent as it is written: SOAP head, one chunk per event, tail
+            assert request.headers.get('Transfer-Encoding') == 'chunked', '[send] Got {}'.format(request.headers)
+            assert len(request.chunks) >= 5, '[send] Expected a chunk per event, got {}'.format(len(request.chunks))
+        body = etree.fromstring(request.body)
+        envelops.append(body.find('.//{http://www.esocial.gov.br/schema/lote/eventos/envio/v1_1_1}eSocial'))
+    placeholders = len(batch_sent.findall('.//' + xml.EVENT_PLACEHOLDER))
+    assert placeholders == 3, '[send] Expected the envelop skeleton, got {} placeholders'.format(placeholders)
+    got = [len(envelop.findall('.//{*}evtMonit')) for envelop in envelops]
+    assert got == [3, 3, 3], '[send] Expected 3 events, got {}'.format(got)
+    # Same envelop, but the event Ids
+    for envelop in envelops:
+        for tag in envelop.iter():
+            tag.attrib.pop('Id', None)
+            if tag.tag.endswith('}SignatureValue') or tag.tag.endswith('}DigestValue') or tag.tag.endswith('}URI'):
+                tag.text = None
+            tag.attrib.pop('URI', None)
+    expected = etree.tostring(envelops[0], method='c14n')
+    for envelop in envelops[1:]:
+        assert etree.tostring(envelop, method='c14n') == expected, '[send] Expected the same envelop'
+
+
+def test_client_pool_employers(tmp_path):
+    pfx_file = os.path.join(here, 'certs', 'libesocial-cert-test.pfx')
+    pool = client.WSClientPool(
+        pfx_file=pfx_file,
+        pfx_passw='cert@test',
+        sender_id={'tpInsc': 1, 'nrInsc': '99999999999999'},
+        max_per_employer=2,
+        max_per_endpoint={'retrieve': 3},
+        wsdl_cache=wsdl_cache_factory(tmp_path),
+        offline=True
+    )
+    employers = ['1234567{}'.format(i) for i in range(3)]
+    for nr_insc in employers:
+        pool.add_employer({'tpInsc': 1, 'nrInsc': nr_insc})
+    with pytest.raises(ValueError):
+        pool.add_employer({'tpInsc': 1, 'nrInsc': employers[0]})
+    ws = pool[employers[1]]
+    assert ws.employer_id['nrInsc'] == employers[1], '[WSClientPool] Got {}'.format(ws.employer_id)
+    assert ws.sender_id['nrInsc'] == '99999999999999', '[WSClientPool] Expected the pool transmitter'
+    shared = set((id(ws.connection_pool), id(ws.signer)) for ws in pool)
+    assert len(shared) == 1, '[WSClientPool] Expected the connection pool and signer to be shared'
+
+    lock = threading.Lock()
+    running = {'total': 0, 'max': 0}
+    by_employer = dict((nr_insc, [0, 0]) for nr_insc in employers)
+
+    def call(nr_insc):
+        with lock:
+            running['total'] += 1
+            running['max'] = max(running['max'], running['total'])
+            by_employer[nr_insc][0] += 1
+            by_employer[nr_insc][1] = max(by_employer[nr_insc])
+        time.sleep(0.02)
+        with lock:
+            running['total'] -= 1
+            by_employer[nr_insc][0] -= 1
+
+    with ThreadPoolExecutor(max_workers=12) as executor:
+        for i in range(24):
+            nr_insc = employers[i % 3]
+            executor.submit(pool[nr_insc]._call, 'retrieve', call, nr_insc)
+    assert running['max'] == 3, '[WSClientPool] Expected at most 3 calls to the endpoint, got {}'.format(running['max'])
+    assert max(peak for n, peak in by_employer.values()) <= 2, '[WSClientPool] Got {}'.format(by_employer)
+    pool.close()
+
+
+def test_client_async_retrieve(tmp_path):
+    httpx = pytest.importorskip('httpx')
+    requests_sent = []
+
+    def handler(request):
+        requests_sent.append(request)
+        return httpx.Response(200, content=soap_response('ConsultarLoteEventos', 'Retrieve_Response.xml'))
+
+    async def retrieve():
+        ws = client.AsyncWSClient(wsdl_cache=wsdl_cache_factory(tmp_path), offline=True)
+        ws.connection_pool._session = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        async with ws:
+            return await asyncio.gather(*[ws.retrieve('1.2.202109.000000000000000000{}'.format(i)) for i in range(3)])
+
+    results = asyncio.run(retrieve())
+    ws = client.AsyncWSClient(wsdl_cache=wsdl_cache_factory(tmp_path), offline=True)
+    with pytest.raises(TypeError):
+        with ws:
+            pass
+    with pytest.raises(TypeError):
+        ws.connection_pool.close()
+    assert len(requests_sent) == 3, '[AsyncWSClient] Expected 3 requests, got {}'.format(len(requests_sent))
+    for result in results:
+        decoded = xml.decode_response(result)
+        assert decoded.lote.protocoloEnvio == '1.1.202109.0000000000011111394', '[AsyncWSClient] Got {}'.format(decoded.lote.protocoloEnvio)
+
+
+def test_client_async_send_events():
+    ws = client.AsyncWSClient(
+        pfx_file=os.path.join(here, 'certs', 'libesocial-cert-test.pfx'),
+        pfx_passw='cert@test',
+        employer_id={'tpInsc': 1, 'nrInsc': '12345678901234'},
+    )
+    batch_response = xml.load_fromfile(os.path.join(here, 'xml', 'Batch_Response.xml')).getroot()
+    signed = []
+    sent = []
+    ahead = []
+    sign_events = ws._sign_events
+
+    def count_signed(*args):
+        signed.append(1)
+        return sign_events(*args)
+
+    async def send_batch(group_id, batch, stream=False):
+        ahead.append(len(signed) - len(sent))
+        await asyncio.sleep(0.02)
+        sent.append(1)
+        return (batch_response, None)
+
+    ws._sign_events = count_signed
+    ws._send_batch = send_batch
+    ws.max_batch_size = 1
+    evt_file = os.path.join(here, 'xml', 'S-2220-v{}-not_signed.xml'.format(esocial.__esocial_version__))
+    events = (xml.load_fromfile(evt_file) for i in range(6))
+    results = asyncio.run(ws.send_events(events, gen_event_id=True, workers=0, concurrency=2))
+    assert len(sent) == 6, '[AsyncWSClient] Expected 6 batches sent, got {}'.format(len(sent))
+    assert all(r['protocol'] == '1.1.202109.0000000000011111111' for r in results.values()), '[AsyncWSClient] Got {}'.format(results)
+    assert max(ahead) <= 3, '[AsyncWSClient] Expected at most 3 batches signed and not sent, got {}'.format(ahead)
+
+
+def test_client_async_send_stream(tmp_path):
+    httpx = pytest.importorskip('httpx')
+    bodies = []
+
+    def handler(request):
+        bodies.append((request.headers.get('Transfer-Encoding'), request.content))
+        return httpx.Response(200, content=soap_response(
+            'EnviarLoteEventos',
+            'Batch_Response.xml',
+            namespace='http://www.esocial.gov.br/servicos/empregador/lote/eventos/envio/v1_1_0'
+        ))
+
+    async def send():
+        ws = client.AsyncWSClient(
+            pfx_file=os.path.join(here, 'certs', 'libesocial-cert-test.pfx'),
+            pfx_passw='cert@test',
+            employer_id={'tpInsc': 1, 'nrInsc': '12345678901234'},
+            wsdl_cache=wsdl_cache_factory(tmp_path),
+            offline=True
+        )
+        ws.connection_pool._session = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        evt_file = os.path.join(here, 'xml', 'S-2220-v{}-not_signed.xml'.format(esocial.__esocial_version__))
+        async with ws:
+            ws.add_events([xml.load_fromfile(evt_file) for i in range(3)], gen_event_id=True, workers=0)
+            return await ws.send(stream=True)
+
+    result, batch_sent = asyncio.run(send())
+    decoded = xml.parse_base_response(result)
+    assert decoded['lote']['protocoloEnvio'] == '1.1.202109.0000000000011111111', '[AsyncWSClient] Got {}'.format(decoded)
+    encoding, body = bodies[0]
+    assert encoding == 'chunked', '[AsyncWSClient] Expected a streamed request, got {}'.format(encoding)
+    assert len(etree.fromstring(body).findall('.//{*}evtMonit')) == 3, '[AsyncWSClient] Expected 3 events sent'
+
+
+class FakeStreamAdapter(FakeAdapter):
+    def send(self, request, **kwargs):
+        response = super(FakeStreamAdapter, self).send(request, **kwargs)
+        self.stream = kwargs.get('stream')
+        # Unread body, as returned by a streamed request
+        response._content = False
+        response.raw = io.BytesIO(self.content)
+        return response
+
+
+def test_client_download_stream():
+    ws = client.WSClient(
+        pfx_file=os.path.join(here, 'certs', 'libesocial-cert-test.pfx'),
+        pfx_passw='cert@test',
+        employer_id={'tpInsc': 1, 'nrInsc': '12345678901234'},
+        wsdl_cache=client.WSDLCache(bundled=True),
+        offline=True
+    )
+    adapter = FakeStreamAdapter(download_response())
+    ws.connection_pool._session = requests.Session()
+    ws.connection_pool._session.mount('https://', adapter)
+    ids = ['ID1123456780000002021091617310600001']
+    streamed = ws.download_events_by_id(ids, stream=True)
+    assert adapter.stream, '[WSClient] Expected a streamed request, got stream={}'.format(adapter.stream)
+    assert isinstance(streamed, xml.DownloadResponse), '[WSClient] Got {}'.format(streamed)
+    assert not isinstance(streamed.source, bytes), '[WSClient] Expected the unread response, got the content'
+    assert [arquivo['status']['cdResposta'] for arquivo in streamed] == ['404']
+    request = adapter.requests[0]
+    assert b'SolicitarDownloadEventosPorId' in request.headers['SOAPAction'].encode('utf-8'), \
+        '[WSClient] Got SOAPAction {}'.format(request.headers['SOAPAction'])
+
+
+def download_response():
+    return (
+        '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body>'
+        '<SolicitarDownloadEventosPorIdResponse xmlns="http://www.esocial.gov.br/servicos/empregador/download/solicitacao/v1_0_0">'
+        '<SolicitarDownloadEventosPorIdResult>'
+        '<eSocial xmlns="http://www.esocial.gov.br/schema/download/solicitacao/retorno/v1_0_0"><download>'
+        '<status><cdResposta>201</cdResposta><descResposta>Sucesso.</descResposta></status>'
+        '<retornoSolicDownloadEvts><arquivos><arquivo>'
+        '<status><cdResposta>404</cdResposta><descResposta>Not found.</descResposta></status>'
+        '</arquivo></arquivos></retornoSolicDownloadEvts>'
+        '</download></eSocial></SolicitarDownloadEventosPorIdResult></SolicitarDownloadEventosPorIdResponse>'
+        '</s:Body></s:Envelope>'
+    ).encode('utf-8')
+
+
+def test_client_async_download():
+    # A streamed download and a parsed one, at the same time on the same zeep client
+    httpx = pytest.importorskip('httpx')
+    response = download_response()
+
+    requests_sent = []
+
+    async def handler(request):
+        # The streamed download (the first request) ends last
+        requests_sent.append(request)
+        await asyncio.sleep(0.1 if len(requests_sent) == 1 else 0.01)
+        return httpx.Response(200, content=response, headers={'Content-Type': 'text/xml; charset=utf-8'})
+
+    async def download():
+        ws = client.AsyncWSClient(
+            pfx_file=os.path.join(here, 'certs', 'libesocial-cert-test.pfx'),
+            pfx_passw='cert@test',
+            employer_id={'tpInsc': 1, 'nrInsc': '12345678901234'},
+            wsdl_cache=client.WSDLCache(bundled=True),
+            offline=True
+        )
+        ws.connection_pool._session = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        async with ws:
+            ids = ['ID1123456780000002021091617310600001']
+            streamed = asyncio.ensure_future(ws.download_events_by_id(ids, stream=True))
+            await asyncio.sleep(0.01)
+            parsed = await ws.download_events_by_id(ids)
+            return (await streamed, parsed)
+
+    streamed, parsed = asyncio.run(download())
+    assert isinstance(streamed, xml.DownloadResponse), '[AsyncWSClient] Got {}'.format(streamed)
+    assert [arquivo['status']['cdResposta'] for arquivo in streamed] == ['404']
+    assert isinstance(parsed, etree._Element), '[AsyncWSClient] Expected a parsed response, got {}'.format(parsed)
@@ -0,0 +1,128 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import datetime
+
+from esocial import xml
+from esocial.download import (
+    EventsDownloader,
+    months,
+)
+
+
+IDS_NS = 'http://www.esocial.gov.br/schema/consulta/identificadores-eventos/retorno/v1_0_0'
+DOWNLOAD_NS = 'http://www.esocial.gov.br/schema/download/solicitacao/retorno/v1_0_0'
+
+
+class FakeWSClient(object):
+    """One event per day of 2021 for each CPF, at most 50 identifiers per query
+    and, if `last`, the date and time of the last one returned."""
+    def __init__(self, cpfs, last=True):
+        self.last = last
+        self.queries = 0
+        self.downloads = []
+        self.events = []
+        for cpf in cpfs:
+            for day in range(365):
+                dt = datetime.datetime(2021, 1, 1, 12) + datetime.timedelta(days=day)
+                self.events.append((cpf, dt, 'ID{}{}'.format(cpf, dt.strftime('%Y%m%d%H%M%S'))))
+
+    def get_employee_events_ids(self, params):
+        self.queries += 1
+        dt_ini = datetime.datetime.strptime(params['dtIni'], '%Y-%m-%dT%H:%M:%S')
+        dt_fim = datetime.datetime.strptime(params['dtFim'], '%Y-%m-%dT%H:%M:%S')
+        found = [
+            evt_id for cpf, dt, evt_id in self.events
+            if cpf == params['cpfTrab'] and dt_ini <= dt <= dt_fim
+        ]
+        last = None
+        if self.last and found:
+            last = datetime.datetime.strptime(found[49 if len(found) > 50 else -1][-14:], '%Y%m%d%H%M%S')
+            last = last.strftime('%Y-%m-%dT%H:%M:%S.000-03:00')
+        return ids_response(found[:50], len(found), last)
+
+    def get_employer_events_ids(self, params):
+        self.queries += 1
+        found = ['ID{}{:05d}'.format(params['perApur'].replace('-', ''), n) for n in range(60)]
+        return ids_response(found[:50], len(found))
+
+    def download_events_by_id(self, ids, stream=False, path=None):
+        self.downloads.append(len(ids))
+        arquivos = ''.join(
+            '<arquivo><status><cdResposta>201</cdResposta><descResposta>OK</descResposta></status>'
+            '<evt Id="{}"><eSocial xmlns="http://www.esocial.gov.br/schema/evt/evtMonit/v_S_01_00_00"/></evt></arquivo>'.format(evt_id)
+            for evt_id in ids
+        )
+        return xml.DownloadResponse((
+            '<eSocial xmlns="{}"><download>'
+            '<status><cdResposta>201</cdResposta><descResposta>OK</descResposta></status>'
+            '<retornoSolicDownloadEvts><arquivos>{}</arquivos></retornoSolicDownloadEvts>'
+            '</download></eSocial>'
+        ).format(DOWNLOAD_NS, arquivos).encode('utf-8'), path=path)
+
+
+def ids_response(event_ids, total, last=None):
+    ids = ''.join(
+        '<identificadorEvt><id>{}</id><nrRec>1.1.{}</nrRec></identificadorEvt>'.format(evt_id, evt_id[-14:])
+        for evt_id in event_ids
+    )
+    return xml.load_fromstring((
+        '<eSocial xmlns="{}"><retornoConsultaIdentificadoresEvts>'
+        '<status><cdResposta>201</cdResposta><descResposta>OK</descResposta></status>'
+        '<retornoIdentificadoresEvts><qtdeTotEvtsConsulta>{}</qtdeTotEvtsConsulta>{}'
+        '<identificadoresEvts>{}</identificadoresEvts></retornoIdentificadoresEvts>'
+        '</retornoConsultaIdentificadoresEvts></eSocial>'
+    ).format(
+        IDS_NS,
+        total,
+        '<dhUltimoEvtRetornado>{}</dhUltimoEvtRetornado>'.format(last) if last else '',
+        ids
+    )).getroot()
+
+
+def test_months():
+    periods = months('2020-11-15', datetime.date(2021, 2, 1))
+    assert periods == ['2020-11', '2020-12', '2021-01', '2021-02'], '[months] Got {}'.format(periods)
+
+
+def test_events_downloader():
+    cpfs = ['12345678901', '10987654321']
+    ws = FakeWSClient(cpfs)
+    downloader = EventsDownloader(ws, concurrency=3, rate=1000, batch_size=40)
+    ids = downloader.employee_events_ids(cpfs, '2021-01-01', '2021-12-31T23:59:59')
+    assert len(ids) == len(ws.events), '[EventsDownloader] Expected {} ids, got {}'.format(len(ws.events), len(ids))
+    assert not downloader.errors, '[EventsDownloader] Got {}'.format(downloader.errors)
+    # Resumed from the last event returned: 365 events, 49 new ones per query after the first
+    assert ws.queries == 8 * len(cpfs), '[EventsDownloader] Expected 8 queries by CPF, got {}'.format(ws.queries)
+    arquivos = list(downloader.download(ids))
+    got = sorted(arquivo['id'] for arquivo in arquivos)
+    assert got == sorted(ids), '[EventsDownloader] Expected all events to be downloaded'
+    assert max(ws.downloads) == 40, '[EventsDownloader] Expected at most 40 ids per download, got {}'.format(ws.downloads)
+
+    # Without dhUltimoEvtRetornado, the date ranges are split
+    ws = FakeWSClient(cpfs, last=False)
+    downloader = EventsDownloader(ws)
+    ids = downloader.employee_events_ids(cpfs, '2021-01-01', '2021-12-31T23:59:59')
+    assert len(ids) == len(ws.events) and ws.queries > 8 * len(cpfs), '[EventsDownloader] Got {} ids, {} queries'.format(len(ids), ws.queries)
+    assert not downloader.errors and not downloader.incomplete
+
+
+def test_events_downloader_incomplete():
+    ws = FakeWSClient([])
+    downloader = EventsDownloader(ws)
+    ids = downloader.employer_events_ids(['S-1299'], ['2021-01', '2021-02'])
+    assert len(ids) == 100, '[EventsDownloader] Expected the first 50 ids of each period, got {}'.format(len(ids))
+    assert not downloader.errors, '[EventsDownloader] Got {}'.format(downloader.errors)
+    incomplete = sorted((params['perApur'], total, returned) for params, total, returned in downloader.incomplete)
+    assert incomplete == [('2021-01', 60, 50), ('2021-02', 60, 50)], '[EventsDownloader] Got {}'.format(incomplete)
@@ -0,0 +1,70 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import datetime
+import threading
+
+from esocial import eventid
+from esocial.eventid import EventIdGenerator
+
+
+class FakeClock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += datetime.timedelta(seconds=seconds)
+
+
+def test_event_id_generator(monkeypatch):
+    clock = FakeClock(datetime.datetime(2021, 9, 16, 17, 31, 6))
+    ids = EventIdGenerator(1, '12345678', clock=clock, sleep=clock.sleep)
+    first = ids.next()
+    assert first == 'ID1123456780000002021091617310600001', '[EventIdGenerator] Got {}'.format(first)
+    assert ids.allocate(2)[-1].endswith('0600003'), '[EventIdGenerator] Expected the sequence to go on'
+    # The clock went back: Ids don't
+    clock.now -= datetime.timedelta(seconds=10)
+    assert ids.next() == 'ID1123456780000002021091617310600004', '[EventIdGenerator] Expected the last second to be kept'
+    # Sequences of a second are over: wait for the next one
+    monkeypatch.setattr(eventid, 'SEQUENCE_MAX', 5)
+    clock.now += datetime.timedelta(seconds=10)
+    got = ids.allocate(2)
+    assert got[0] == 'ID1123456780000002021091617310700001', '[EventIdGenerator] Got {}'.format(got)
+
+
+def test_event_id_generator_shared(tmp_path):
+    path = str(tmp_path / 'ids.db')
+    clock = FakeClock(datetime.datetime(2021, 9, 16, 17, 31, 6))
+    generators = [EventIdGenerator(1, '12345678', path=path, clock=clock) for n in range(2)]
+    generated = []
+
+    def generate(ids):
+        for n in range(100):
+            generated.append(ids.next())
+
+    threads = [threading.Thread(target=generate, args=(ids,)) for ids in generators * 2]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(generated)) == 400, '[EventIdGenerator] Expected 400 unique Ids, got {}'.format(len(set(generated)))
+    for ids in generators:
+        ids.close()
+    # Counters survive restarts
+    ids = EventIdGenerator(1, '12345678', path=path, clock=clock)
+    got = ids.next()
+    assert got == 'ID1123456780000002021091617310600401', '[EventIdGenerator] Got {}'.format(got)
@@ -0,0 +1,53 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import sys
+import subprocess
+
+import pytest
+
+
+# Cumulative import time budget, in microseconds, of each module
+IMPORT_TIME_BUDGET = 150000
+
+# Heavy dependencies that must only be imported when the feature that needs
+# them is used
+LAZY_MODULES = ('zeep', 'requests', 'httpx', 'signxml', 'cryptography', 'dotmap', 'asyncio', 'multiprocessing')
+
+
+def importtime(module):
+    """Returns {module name: cumulative import time (us)} of `python -X importtime -c 'import module'`."""
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+        stderr=subprocess.PIPE,
+        check=True,
+        universal_newlines=True,
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative_us)
+    return times
+
+
+@pytest.mark.parametrize('module', ['esocial.xml', 'esocial.utils', 'esocial.client', 'esocial.polling', 'esocial.download', 'esocial.store', 'esocial.eventid', 'esocial.ratelimit', 'esocial.retry'])
+def test_importtime(module):
+    times = importtime(module)
+    loaded = [name for name in times if name.split('.')[0] in LAZY_MODULES]
+    assert not loaded, '[{}] Expected no heavy dependency imported, got {}'.format(module, loaded)
+    assert times[module] < IMPORT_TIME_BUDGET, '[{}] Expected import time < {}us, got {}us'.format(
+        module, IMPORT_TIME_BUDGET, times[module]
+    )
@@ -0,0 +1,105 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import os
+import threading
+import time
+
+from esocial import xml
+from esocial.polling import ProtocolPoller
+
+from esocial.tests import here
+
+
+class FakeWSClient(object):
+    """Answers "processing" (101) for the first `processing_polls` polls of each protocol."""
+    def __init__(self, processing_polls):
+        self.processing_polls = processing_polls
+        self.polls = {}
+
+    def retrieve(self, protocol_number):
+        self.polls[protocol_number] = self.polls.get(protocol_number, 0) + 1
+        response = xml.load_fromfile(os.path.join(here, 'xml', 'Retrieve_Response.xml')).getroot()
+        if protocol_number == 'error':
+            raise IOError('Connection reset')
+        if self.polls[protocol_number] <= self.processing_polls.get(protocol_number, 0):
+            xml.find(response, 'status/cdResposta').text = '101'
+        return response
+
+
+def test_poller():
+    ws = FakeWSClient({'1.1.202109.0000000000000000001': 3, '1.1.202109.0000000000000000002': 1})
+    poller = ProtocolPoller(ws, interval=0.001, max_interval=0.01, rate=1000, concurrency=2, max_errors=2)
+    for protocol_number in ws.processing_polls:
+        poller.add(protocol_number)
+    poller.add('error')
+    results = dict(poller.poll(timeout=10))
+    assert len(poller) == 0, '[ProtocolPoller] Expected no tracked protocols, got {}'.format(len(poller))
+    assert ws.polls == {
+        '1.1.202109.0000000000000000001': 4,
+        '1.1.202109.0000000000000000002': 2,
+        'error': 2,
+    }, '[ProtocolPoller] Got {}'.format(ws.polls)
+    for protocol_number in ws.processing_polls:
+        assert results[protocol_number].status.cdResposta == '201', '[ProtocolPoller] Got {}'.format(results[protocol_number])
+    assert isinstance(results['error'], IOError), '[ProtocolPoller] Got {}'.format(results['error'])
+
+
+def test_poller_backoff():
+    poller = ProtocolPoller(None, interval=1, max_interval=10, backoff=2, jitter=0)
+    delays = [poller._delay(attempt) for attempt in range(6)]
+    assert delays == [1, 2, 4, 8, 10, 10], '[ProtocolPoller] Got {}'.format(delays)
+    poller = ProtocolPoller(None, interval=1, max_interval=10, backoff=2, jitter=0.5)
+    for i in range(20):
+        assert 1 <= poller._delay(1) <= 3, '[ProtocolPoller] Jitter out of range'
+
+
+def test_poller_stop():
+    protocols = ['1.1.202109.000000000000000000{}'.format(i) for i in range(4)]
+    ws = FakeWSClient({})
+    poller = ProtocolPoller(ws, interval=0, concurrency=4)
+    for protocol_number in protocols:
+        poller.add(protocol_number)
+    for protocol_number, response in poller.poll(timeout=10):
+        break
+    # The caller stopped: the protocols not yielded are still tracked
+    remaining = sorted(set(protocols) - {protocol_number})
+    assert sorted(poller.pending) == remaining, '[ProtocolPoller] Got {}'.format(poller.pending)
+    results = dict(poller.poll(timeout=10))
+    assert sorted(results) == remaining, '[ProtocolPoller] Got {}'.format(sorted(results))
+    assert poller.pending == [], '[ProtocolPoller] Got {}'.format(poller.pending)
+
+
+def test_poller_timeout():
+    # Every poll in flight is slow: poll() still stops at the deadline
+    release = threading.Event()
+    ws = FakeWSClient({})
+    retrieve = ws.retrieve
+
+    def slow_retrieve(protocol_number):
+        release.wait(5)
+        return retrieve(protocol_number)
+
+    ws.retrieve = slow_retrieve
+    poller = ProtocolPoller(ws, interval=0, concurrency=2)
+    protocols = ['1.1.202109.000000000000000000{}'.format(i) for i in range(2)]
+    for protocol_number in protocols:
+        poller.add(protocol_number)
+    started = time.monotonic()
+    results = list(poller.poll(timeout=0.1))
+    elapsed = time.monotonic() - started
+    release.set()
+    assert results == [], '[ProtocolPoller] Got {}'.format(results)
+    assert elapsed < 1, '[ProtocolPoller] Expected poll() to stop after 0.1s, took {:.2f}s'.format(elapsed)
+    assert sorted(poller.pending) == protocols, '[ProtocolPoller] Got {}'.format(poller.pending)
@@ -0,0 +1,240 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import asyncio
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import (
+    BaseHTTPRequestHandler,
+    HTTPServer,
+)
+from socketserver import ThreadingMixIn
+
+import esocial
+
+from esocial import (
+    client,
+    xml,
+)
+from esocial.ratelimit import (
+    AdaptiveConcurrency,
+    AdaptiveLimiter,
+    TokenBucket,
+    is_congestion,
+)
+from esocial.tests import (
+    here,
+    soap_response,
+)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, burst=3, clock=clock, sleep=clock.sleep)
+    for i in range(3):
+        bucket.acquire()
+    assert clock.slept == [], '[TokenBucket] Expected a burst of 3, slept {}'.format(clock.slept)
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.slept == [0.5, 0.5], '[TokenBucket] Expected 2 calls per second, slept {}'.format(clock.slept)
+    # Tokens are reserved in order: the callers wait their turn
+    assert [bucket.reserve() for i in range(3)] == [0.5, 1.0, 1.5]
+    # Idle, the bucket fills up to burst
+    clock.now += 100
+    assert [bucket.reserve() for i in range(4)] == [0, 0, 0, 0.5]
+
+
+def test_adaptive_concurrency():
+    concurrency = AdaptiveConcurrency(initial=8, minimum=2, maximum=10, latency_threshold=1.0)
+    generations = [concurrency.acquire() for i in range(8)]
+    assert concurrency.try_acquire() is None, '[AdaptiveConcurrency] Expected no free slot'
+    # A burst of errors cuts the limit once
+    for generation in generations[:4]:
+        concurrency.release(generation, success=False)
+    assert concurrency.limit == 4, '[AdaptiveConcurrency] Expected the limit halved, got {}'.format(concurrency.limit)
+    generation = concurrency.try_acquire()
+    assert generation is None, '[AdaptiveConcurrency] Expected 4 calls in flight to fill the new limit'
+    # Slow calls are congestion too
+    concurrency.release(generations[4], success=True, latency=0.5)
+    generation = concurrency.acquire()
+    concurrency.release(generation, success=True, latency=5.0)
+    assert concurrency.limit == 2.125, '[AdaptiveConcurrency] Got {}'.format(concurrency.limit)
+    for generation in generations[5:]:
+        concurrency.release(generation, success=None)
+    # Errors don't go below minimum, successes above maximum
+    concurrency.release(concurrency.acquire(), success=False)
+    assert concurrency.limit == 2, '[AdaptiveConcurrency] Got {}'.format(concurrency.limit)
+    for i in range(200):
+        concurrency.release(concurrency.acquire(), success=True)
+    assert concurrency.limit == 10, '[AdaptiveConcurrency] Got {}'.format(concurrency.limit)
+    assert concurrency.in_flight == 0, '[AdaptiveConcurrency] Got {} in flight'.format(concurrency.in_flight)
+
+
+def test_adaptive_concurrency_async():
+    concurrency = AdaptiveConcurrency(initial=2, maximum=2)
+    order = []
+
+    async def call(i):
+        generation = await concurrency.acquire_async()
+        order.append(i)
+        await asyncio.sleep(0.01)
+        concurrency.release(generation, success=True)
+
+    async def main():
+        await asyncio.gather(*(call(i) for i in range(6)))
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
+    assert sorted(order) == list(range(6)), '[AdaptiveConcurrency] Got {}'.format(order)
+    assert concurrency.in_flight == 0, '[AdaptiveConcurrency] Got {} in flight'.format(concurrency.in_flight)
+    assert concurrency._async_waiters == [], '[AdaptiveConcurrency] Got {}'.format(concurrency._async_waiters)
+    # A slot freed by another thread wakes the coroutine up
+    generation = concurrency.acquire()
+    concurrency.acquire()
+    timer = threading.Timer(0.05, concurrency.release, (generation,))
+    timer.start()
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(asyncio.wait_for(concurrency.acquire_async(), 5))
+    finally:
+        loop.close()
+    timer.join()
+    assert concurrency.in_flight == 2, '[AdaptiveConcurrency] Got {} in flight'.format(concurrency.in_flight)
+
+
+def test_is_congestion():
+    import requests
+    from zeep.exceptions import Fault, TransportError
+    congestion = [
+        requests.ConnectionError(), requests.Timeout(), TimeoutError(),
+        TransportError(status_code=503), TransportError(status_code=429),
+    ]
+    for error in congestion:
+        assert is_congestion(error), '[is_congestion] Expected congestion: {!r}'.format(error)
+    other = [
+        Fault('Invalid'), ValueError(), TransportError(status_code=500),
+        TransportError(status_code=404), requests.HTTPError(response=FakeResponse(400)),
+    ]
+    for error in other:
+        assert not is_congestion(error), '[is_congestion] Expected no congestion: {!r}'.format(error)
+    assert is_congestion(requests.HTTPError(response=FakeResponse(503)))
+    limiter = AdaptiveLimiter(errors=(ValueError,))
+    assert limiter.is_congestion(ValueError()) and not limiter.is_congestion(OSError())
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class OverloadedSOAPServer(ThreadingHTTPServer):
+    """Answers ConsultarLoteEventos, with HTTP 503 when more than `capacity` requests are in progress."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.in_progress = 0
+        self.rejected = 0
+        self.answered = 0
+        self.lock = threading.Lock()
+        self.response = soap_response('ConsultarLoteEventos', 'Retrieve_Response.xml')
+        HTTPServer.__init__(self, ('127.0.0.1', 0), SOAPHandler)
+
+
+class SOAPHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers['Content-Length']))
+        with server.lock:
+            server.in_progress += 1
+            overloaded = server.in_progress > server.capacity
+        try:
+            if overloaded:
+                status, content = 503, b'Service Unavailable'
+            else:
+                time.sleep(0.01)
+                status, content = 200, server.response
+        finally:
+            with server.lock:
+                server.in_progress -= 1
+                if overloaded:
+                    server.rejected += 1
+                else:
+                    server.answered += 1
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_adaptive_limiter(tmp_path, monkeypatch):
+    server = OverloadedSOAPServer(capacity=2)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    address = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    url = address + '/servicos/empregador/consultarloteeventos/WsConsultarLoteEventos.svc?wsdl'
+    with open(os.path.join(here, 'wsdl', 'WsConsultarLoteEventos.wsdl'), 'rb') as fp:
+        wsdl = fp.read().replace(b'http://127.0.0.1:8088', address.encode('ascii'))
+    cache = client.WSDLCache(path=str(tmp_path))
+    cache.add(url, wsdl)
+    monkeypatch.setitem(esocial._WS_URL['tests'], 'retrieve', url)
+    limiter = AdaptiveLimiter(concurrency=8, max_concurrency=8, increase=0.1)
+    ws = client.WSClient(wsdl_cache=cache, offline=True, limiter=limiter)
+
+    def retrieve(i):
+        for attempt in range(50):
+            try:
+                return ws.retrieve('1.2.202109.00000000000000000{:02d}'.format(i))
+            except Exception:
+                pass
+
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(retrieve, range(40)))
+    finally:
+        server.shutdown()
+        server.server_close()
+        ws.close()
+    concurrency = limiter.endpoint('retrieve').concurrency
+    assert server.answered == 40, '[AdaptiveLimiter] Expected 40 answers, got {}'.format(server.answered)
+    assert all(xml.decode_response(result).lote.protocoloEnvio for result in results)
+    assert concurrency.congestions == server.rejected > 0, '[AdaptiveLimiter] Expected the 503s to be congestion'
+    assert concurrency.limit < 8, '[AdaptiveLimiter] Expected the limit to shrink, got {}'.format(concurrency.limit)
+    assert concurrency.successes == 40 and concurrency.in_flight == 0
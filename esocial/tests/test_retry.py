@@ -0,0 +1,226 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import os
+
+import pytest
+import requests
+
+import esocial
+
+from esocial import (
+    client,
+    xml,
+)
+from esocial.retry import IdempotentSender
+from esocial.store import EventStore
+from esocial.tests import (
+    here,
+    soap_response,
+    wsdl_cache_factory,
+)
+
+
+IDS_NS = 'http://www.esocial.gov.br/schema/consulta/identificadores-eventos/retorno/v1_0_0'
+RETRIEVE_NS = 'http://www.esocial.gov.br/schema/lote/eventos/envio/retornoProcessamento/v1_3_0'
+EVENT_NS = 'http://www.esocial.gov.br/schema/evt/retornoEvento/v1_2_1'
+
+
+class TimeoutAdapter(requests.adapters.BaseAdapter):
+    """Times out the first `timeouts` requests, even though eSocial got them, and then answers `content`."""
+    def __init__(self, content, timeouts):
+        super(TimeoutAdapter, self).__init__()
+        self.content = content
+        self.timeouts = timeouts
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        if len(self.requests) <= self.timeouts:
+            raise requests.exceptions.ReadTimeout('Read timed out')
+        response = requests.Response()
+        response.status_code = 200
+        response.headers['Content-Type'] = 'text/xml; charset=utf-8'
+        response._content = self.content
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+def _events_ids_response(event_ids):
+    ids = ''.join(
+        '<identificadorEvt><id>{}</id><nrRec>1.2.{:019d}</nrRec></identificadorEvt>'.format(event_id, n)
+        for n, event_id in enumerate(event_ids)
+    )
+    return xml.load_fromstring((
+        '<eSocial xmlns="{}"><retornoConsultaIdentificadoresEvts>'
+        '<status><cdResposta>201</cdResposta><descResposta>OK</descResposta></status>'
+        '<retornoIdentificadoresEvts><qtdeTotEvtsConsulta>{}</qtdeTotEvtsConsulta>'
+        '<identificadoresEvts>{}</identificadoresEvts></retornoIdentificadoresEvts>'
+        '</retornoConsultaIdentificadoresEvts></eSocial>'
+    ).format(IDS_NS, len(event_ids), ids)).getroot()
+
+
+def _retrieve_response(status, receipts):
+    events = ''.join((
+        '<evento Id="{0}"><retornoEvento><eSocial xmlns="{1}"><retornoEvento Id="{0}">'
+        '<processamento><cdResposta>{2}</cdResposta><descResposta>-</descResposta></processamento>'
+        '{3}</retornoEvento></eSocial></retornoEvento></evento>'
+    ).format(
+        event_id,
+        EVENT_NS,
+        '201' if nr_recibo else '401',
+        '<recibo><nrRecibo>{}</nrRecibo></recibo>'.format(nr_recibo) if nr_recibo else ''
+    ) for event_id, nr_recibo in receipts)
+    return xml.load_fromstring((
+        '<eSocial xmlns="{}"><retornoProcessamentoLoteEventos>'
+        '<status><cdResposta>{}</cdResposta><descResposta>-</descResposta></status>'
+        '<retornoEventos>{}</retornoEventos>'
+        '</retornoProcessamentoLoteEventos></eSocial>'
+    ).format(RETRIEVE_NS, status, events)).getroot()
+
+
+def _ws(tmp_path, timeouts):
+    ws = client.WSClient(
+        pfx_file=os.path.join(here, 'certs', 'libesocial-cert-test.pfx'),
+        pfx_passw='cert@test',
+        employer_id={'tpInsc': 1, 'nrInsc': '12345678901234'},
+        wsdl_cache=wsdl_cache_factory(tmp_path),
+        offline=True,
+        store=EventStore()
+    )
+    adapter = TimeoutAdapter(soap_response(
+        'EnviarLoteEventos',
+        'Batch_Response.xml',
+        namespace='http://www.esocial.gov.br/servicos/empregador/lote/eventos/envio/v1_1_0'
+    ), timeouts)
+    ws.connection_pool._session = requests.Session()
+    ws.connection_pool._session.mount('https://', adapter)
+    evt_file = os.path.join(here, 'xml', 'S-2220-v{}-not_signed.xml'.format(esocial.__esocial_version__))
+    for i in range(3):
+        ws.add_event(xml.load_fromfile(evt_file), gen_event_id=True)
+    return ws, adapter
+
+
+def test_idempotent_sender(tmp_path):
+    ws, adapter = _ws(tmp_path, timeouts=1)
+    event_ids = [event.getroot()[0].get('Id') for event in ws.batch]
+    queries = []
+
+    def get_employee_events_ids(params):
+        # The first event of the batch that timed out was received
+        queries.append(params)
+        return _events_ids_response(event_ids[:1])
+
+    ws.get_employee_events_ids = get_employee_events_ids
+    waits = []
+    sender = IdempotentSender(ws, jitter=0, sleep=waits.append)
+    sent = sender.send()
+    assert sent['attempts'] == 2 and waits == [300.0], '[IdempotentSender] Got {} attempts, waits {}'.format(sent['attempts'], waits)
+    assert [params['cpfTrab'] for params in queries] == ['12345678901'], '[IdempotentSender] Got {}'.format(queries)
+    assert list(sent['landed']) == event_ids[:1], '[IdempotentSender] Expected the first event landed, got {}'.format(sent['landed'])
+    assert sent['sent'] == event_ids[1:], '[IdempotentSender] Expected the missing events sent, got {}'.format(sent['sent'])
+    resent = xml.load_fromstring(adapter.requests[-1].body).getroot()
+    assert len(resent.findall('.//{*}evtMonit')) == 2, '[IdempotentSender] Expected 2 events sent again'
+    assert xml.decode_response(sent['response']).lote.protocoloEnvio == '1.1.202109.0000000000011111111'
+    assert ws.batch == [], '[IdempotentSender] Expected the batch cleared'
+    assert ws.store.get(event_ids[0])['nr_recibo'] == '1.2.0000000000000000000', '[IdempotentSender] Expected the receipt stored'
+    assert ws.store.get(event_ids[2])['protocol'] == '1.1.202109.0000000000011111111'
+
+    # The batch is not lost when every retry fails
+    ws, adapter = _ws(tmp_path, timeouts=10)
+    ws.get_employee_events_ids = lambda params: _events_ids_response([])
+    sender = IdempotentSender(ws, retries=2, sleep=lambda seconds: None)
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        sender.send()
+    assert len(adapter.requests) == 3, '[IdempotentSender] Expected 3 transmissions, got {}'.format(len(adapter.requests))
+    assert len(ws.batch) == 3, '[IdempotentSender] Expected the batch kept'
+
+
+def _periodic_event(name, event_id, cpf=None):
+    worker = '<ideTrabalhador><cpfTrab>{}</cpfTrab></ideTrabalhador>'.format(cpf) if cpf else ''
+    return xml.load_fromstring((
+        '<eSocial xmlns="http://www.esocial.gov.br/schema/evt/{0}/v_S_01_00_00"><{0} Id="{1}">'
+        '<ideEvento><perApur>2021-09</perApur></ideEvento>{2}</{0}></eSocial>'
+    ).format(name, event_id, worker))
+
+
+def test_idempotent_sender_periodic(tmp_path):
+    ws, adapter = _ws(tmp_path, timeouts=0)
+    remun = _periodic_event('evtRemun', 'ID1123456789012342021091617310600001', cpf='12345678901')
+    fecha = _periodic_event('evtFechaEvPer', 'ID1123456789012342021091617310600002')
+    employee_queries = []
+    employer_queries = []
+
+    def get_employee_events_ids(params):
+        employee_queries.append(params)
+        return _events_ids_response(['ID1123456789012342021091617310600001'])
+
+    def get_employer_events_ids(params):
+        # More events in the period than returned: can not be paged
+        employer_queries.append(params)
+        response = _events_ids_response(['ID1123456789012342021091617310600002'])
+        xml.find(response, 'qtdeTotEvtsConsulta').text = '60'
+        return response
+
+    ws.get_employee_events_ids = get_employee_events_ids
+    ws.get_employer_events_ids = get_employer_events_ids
+    landed = IdempotentSender(ws).find_landed([remun, fecha])
+    assert [params['cpfTrab'] for params in employee_queries] == ['12345678901'], '[IdempotentSender] Got {}'.format(employee_queries)
+    assert [(params['tpEvt'], params['perApur']) for params in employer_queries] == [('S-1299', '2021-09')], '[IdempotentSender] Got {}'.format(employer_queries)
+    assert list(landed) == [
+        'ID1123456789012342021091617310600001', 'ID1123456789012342021091617310600002'
+    ], '[IdempotentSender] Expected both events landed, got {}'.format(landed)
+
+
+def test_idempotent_sender_processing(tmp_path):
+    # The batch was received by eSocial (e.g. before the application
+    # restarted) and is still being processed
+    ws, adapter = _ws(tmp_path, timeouts=0)
+    event_ids = [event.getroot()[0].get('Id') for event in ws.batch]
+    protocol = '1.1.202109.0000000000011111394'
+    ws.store.add_many(ws.batch, protocol=protocol)
+    retrieved = []
+
+    def retrieve(protocol_number):
+        retrieved.append(protocol_number)
+        if len(retrieved) < 3:
+            return _retrieve_response('101', [])
+        # The last event was rejected
+        return _retrieve_response('201', [(event_ids[0], '1.2.1'), (event_ids[1], '1.2.2'), (event_ids[2], None)])
+
+    ws.retrieve = retrieve
+    ws.get_employee_events_ids = lambda params: pytest.fail('[IdempotentSender] Unexpected identifiers query')
+    waits = []
+    sender = IdempotentSender(ws, poll_interval=5, sleep=waits.append)
+    sent = sender.send()
+    assert retrieved == [protocol] * 3 and waits == [5, 5], '[IdempotentSender] Got {} polls, waits {}'.format(len(retrieved), waits)
+    assert dict(sent['landed']) == {event_ids[0]: '1.2.1', event_ids[1]: '1.2.2'}, '[IdempotentSender] Got {}'.format(sent['landed'])
+    assert sent['sent'] == event_ids[2:] and sent['attempts'] == 1, '[IdempotentSender] Got {}'.format(sent['sent'])
+    assert len(adapter.requests) == 1, '[IdempotentSender] Expected 1 transmission, got {}'.format(len(adapter.requests))
+    assert ws.store.get(event_ids[0])['nr_recibo'] == '1.2.1', '[IdempotentSender] Expected the receipt stored'
+
+    # Still processing after processing_timeout: the events are not sent again
+    ws, adapter = _ws(tmp_path, timeouts=0)
+    ws.store.add_many(ws.batch, protocol=protocol)
+    ws.retrieve = lambda protocol_number: _retrieve_response('101', [])
+    waits = []
+    sender = IdempotentSender(ws, poll_interval=5, processing_timeout=20, sleep=waits.append)
+    sent = sender.send()
+    assert waits == [5, 5, 5, 5], '[IdempotentSender] Got waits {}'.format(waits)
+    assert list(sent['landed'].values()) == [None] * 3 and sent['attempts'] == 0, '[IdempotentSender] Got {}'.format(sent)
+    assert adapter.requests == [] and sent['response'] is None, '[IdempotentSender] Expected nothing sent'
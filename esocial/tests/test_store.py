@@ -0,0 +1,68 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import copy
+import os
+
+import esocial
+
+from esocial import xml
+from esocial.store import (
+    EventStore,
+    event_digest,
+)
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+RETRIEVED_IDS = ('ID1123456780000002021091617310600001', 'ID1123456780000002021091617321200001')
+
+
+def _event(event_id):
+    evt = xml.load_fromfile(os.path.join(here, 'xml', 'S-2220-v{}.xml'.format(esocial.__esocial_version__)))
+    evt.getroot()[0].set('Id', event_id)
+    return evt
+
+
+def test_event_store(tmp_path):
+    events = [_event(event_id) for event_id in RETRIEVED_IDS]
+    assert event_digest(events[0]) == event_digest(events[1]), '[event_digest] Expected the same digest for different Ids'
+    changed = copy.deepcopy(events[0])
+    xml.find(changed.getroot(), 'cpfTrab').text = '10987654321'
+    assert event_digest(changed) != event_digest(events[0]), '[event_digest] Expected a new digest for a new content'
+
+    with EventStore(str(tmp_path / 'events.db')) as store:
+        store.add(events[0], grupo=2)
+        assert store.duplicate_of(events[1])['id'] == RETRIEVED_IDS[0], '[EventStore] Expected a duplicate'
+        assert store.duplicate_of(changed) is None, '[EventStore] Expected no duplicate'
+        store.add(events[1], grupo=2)
+        row = store.get(RETRIEVED_IDS[0])
+        expected = ('S-2220', '12345678901', '12345678901234', 2, None)
+        got = (row['code'], row['cpf'], row['employer'], row['grupo'], row['protocol'])
+        assert got == expected, '[EventStore] Expected {}, got {}'.format(expected, got)
+        assert len(store.find(protocol=None)) == 2, '[EventStore] Expected 2 events without protocol'
+
+        store.set_protocol(RETRIEVED_IDS, '1.1.202109.0000000000011111394')
+        response = xml.load_fromfile(os.path.join(here, 'xml', 'Retrieve_Response.xml')).getroot()
+        updated = store.update_from_response(xml.parse_response(response))
+        assert updated == 2, '[EventStore] Expected 2 events updated, got {}'.format(updated)
+        found = store.find(nr_recibo='1.2.0000000000103400109')
+        assert [row['id'] for row in found] == [RETRIEVED_IDS[1]], '[EventStore] Got {}'.format(found)
+        found = store.find(protocol='1.1.202109.0000000000011111394', status='201', cpf='12345678901', code='S-2220')
+        assert len(found) == 2, '[EventStore] Expected 2 events, got {}'.format(len(found))
+        loaded = store.load_event(RETRIEVED_IDS[1])
+        assert event_digest(loaded) == event_digest(events[1]), '[EventStore] Expected the stored event'
+
+    with EventStore(str(tmp_path / 'events.db')) as store:
+        assert len(store) == 2, '[EventStore] Expected the events to persist, got {}'.format(len(store))
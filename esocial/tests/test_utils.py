@@ -12,8 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
+import os
+import shutil
+import ssl
+
 from esocial import utils
 
+from esocial.tests import here
+
 
 def test_format_xsd_version():
     versions = ['2.5.0', '1.1.1', 'S-1.0']
@@ -22,3 +28,34 @@ def test_format_xsd_version():
         xsd_version = utils.format_xsd_version(v)
         assert  xsd_version == expected[i], 'Expetected [{}], Got [{}]'.format(expected[i], xsd_version)
 
+
+
+def test_certificate_store(tmp_path):
+    store = utils.CertificateStore()
+    cert_file = os.path.join(here, 'certs', 'libesocial-cert-test.pfx')
+    cert_data = store.load(cert_file, 'cert@test')
+    assert store.load(cert_file, 'cert@test') is cert_data, '[CertificateStore] Expected the same certificate data'
+    contexts = []
+
+    def factory():
+        context = ssl.create_default_context()
+        with utils.pem_file(cert_data, 'cert@test') as pem:
+            context.load_cert_chain(pem.name, password=pem.password)
+        contexts.append(context)
+        return context
+
+    context = store.ssl_context(cert_data, None, factory)
+    assert store.ssl_context(cert_data, None, factory) is context, '[CertificateStore] Expected the same SSL context'
+    assert len(contexts) == 1, '[CertificateStore] Expected one SSL context, got {}'.format(len(contexts))
+    store.clear()
+    assert store.load(cert_file, 'cert@test') is not cert_data, '[CertificateStore] Expected a new certificate data'
+
+    # A renewed certificate replaces the cached one
+    renewed = str(tmp_path / 'cert.pfx')
+    shutil.copy(cert_file, renewed)
+    cert_data = store.load(renewed, 'cert@test')
+    store.ssl_context(cert_data, None, factory)
+    os.utime(renewed, (1, 1))
+    cert_data = store.load(renewed, 'cert@test')
+    assert store.load(renewed, 'cert@test') is cert_data, '[CertificateStore] Expected the same certificate data'
+    assert len(store._certs) == 2, '[CertificateStore] Expected the old certificate dropped, got {}'.format(len(store._certs))
@@ -13,6 +13,12 @@
 # limitations under the License.
 # ==============================================================================
 import os
+import copy
+import json
+
+from concurrent.futures import ThreadPoolExecutor
+
+import signxml
 
 import esocial
 
@@ -174,3 +180,204 @@ def test_xml_decode_response():
     assert retrieve_resp.lote.dhRecepcao == '2021-09-16T17:32:12.5', '[xml.decode_response] Expected 2021-09-16T17:32:12.5, Got {}'.format(retrieve_resp.lote.dhRecepcao)
     assert retrieve_resp.lote.protocoloEnvio == '1.1.202109.0000000000011111394', '[xml.decode_response] Expected 1.1.202109.0000000000011111394, Got {}'.format(retrieve_resp.lote.protocoloEnvio)
     assert len(retrieve_resp.eventos) == 2, '[xml.decode_response] Expected len() = 2, Got {}'.format(len(retrieve_resp.eventos))
+
+
+def test_xml_parse_response():
+    retrieve_response = esocial.xml.load_fromfile(os.path.join(here, 'xml', 'Retrieve_Response.xml')).getroot()
+    parsed = esocial.xml.parse_response(retrieve_response)
+    assert isinstance(parsed['eventos'][0], dict), '[xml.parse_response] Expected dict, Got {}'.format(type(parsed['eventos'][0]))
+    nr_recibo = parsed['eventos'][0]['recibo']['nrRecibo']
+    assert nr_recibo == '1.2.0000000000103399932', '[xml.parse_response] Expected 1.2.0000000000103399932, Got {}'.format(nr_recibo)
+    decoded = esocial.xml.decode_response(retrieve_response).toDict()
+    assert parsed == decoded, '[xml.parse_response] Expected the same result of decode_response(), Got {}'.format(parsed)
+
+
+def test_xsd_cache():
+    cache = xml.XMLSchemaCache(maxsize=2)
+    evt2220 = xml.load_fromfile(os.path.join(here, 'xml', 'S-2220-v{}.xml'.format(esocial.__esocial_version__)))
+    xsd1 = cache.event('evtMonit')
+    xsd2 = cache.event('evtMonit')
+    assert xsd1 is xsd2, '[XMLSchemaCache] Expected the same compiled schema instance'
+    assert cache.info()['hits'] == 1 and cache.info()['misses'] == 1, '[XMLSchemaCache] Got {}'.format(cache.info())
+    xml.XMLValidate(evt2220, xsd=xsd1).validate()
+    cache.envelop('send')
+    cache.envelop('retrieve')
+    assert len(cache) == 2, '[XMLSchemaCache] Expected 2 schemas, got {}'.format(len(cache))
+    assert (esocial.__esocial_version__, 'evtMonit') not in cache, '[XMLSchemaCache] Expected evtMonit to be evicted'
+    cache.clear()
+    assert cache.info() == {'hits': 0, 'misses': 0, 'maxsize': 2, 'currsize': 0}, '[XMLSchemaCache] Got {}'.format(cache.info())
+
+
+def test_xsd_cache_preload():
+    cache = xml.XMLSchemaCache(maxsize=None)
+    cache.preload(events=['evtMonit', 'evtExpRisco'])
+    assert len(cache) == 2 + len(esocial.__xsd_versions__), '[XMLSchemaCache] Got {}'.format(len(cache))
+    assert cache.misses == len(cache), '[XMLSchemaCache] Got {}'.format(cache.info())
+
+
+def test_xml_signer():
+    cert_data = pkcs12_data(
+        cert_file=os.path.join(here, 'certs', 'libesocial-cert-test.pfx'),
+        password='cert@test'
+    )
+    evt_file = os.path.join(here, 'xml', 'S-2220-v{}-not_signed.xml'.format(esocial.__esocial_version__))
+    signer = xml.Signer({'key_str': cert_data['key_str'], 'cert_str': cert_data['cert_str']})
+    signed_events = signer.sign_many([xml.load_fromfile(evt_file), evt_file])
+    assert len(signed_events) == 2, '[Signer] Expected 2 signed events, got {}'.format(len(signed_events))
+    for evt_signed in signed_events:
+        xml.XMLValidate(evt_signed).validate()
+        signxml.XMLVerifier().verify(evt_signed.getroot(), x509_cert=cert_data['cert_str'])
+    # Same signature as xml.sign()
+    expected = xml.dump_tostring(xml.sign(xml.load_fromfile(evt_file), cert_data))
+    assert xml.dump_tostring(signed_events[0]) == expected, '[Signer] Expected the same signed XML of xml.sign()'
+
+
+def test_xml_cursor():
+    xmlns = 'http://www.esocial.gov.br/schema/lote/eventos/envio/v1_1_1'
+    by_path = xml.XMLHelper('eSocial', xmlns=xmlns)
+    by_path.add_element(None, 'envioLoteEventos', grupo='1')
+    by_path.add_element('envioLoteEventos', 'ideEmpregador')
+    by_path.add_element('envioLoteEventos/ideEmpregador', 'tpInsc', text='1')
+    by_path.add_element('envioLoteEventos/ideEmpregador', 'nrInsc', text='12345678')
+    by_cursor = xml.XMLHelper('eSocial', xmlns=xmlns)
+    with by_cursor.cursor().add('envioLoteEventos', grupo='1') as batch:
+        with batch.add('ideEmpregador') as employer:
+            employer.add('tpInsc', text='1')
+            employer.add('nrInsc', text='12345678')
+    expected = xml.dump_tostring(by_path.root)
+    got = xml.dump_tostring(by_cursor.root)
+    assert got == expected, '[XMLCursor] Expected {}, got {}'.format(expected, got)
+
+
+def test_xml_load_fromjson():
+    evt_json = {
+        'eSocial': {
+            '__ATTRS__': {'xmlns': 'http://www.esocial.gov.br/schema/evt/evtExclusao/v02_05_00'},
+            'evtExclusao': {
+                '__ATTRS__': {'Id': 'ID1000000000000002018081110363700001'},
+                'ideEvento': {'tpAmb': 2, 'procEmi': 1, 'verProc': '1.0'},
+                'infoExclusao': {'tpEvento': 'S-2220', 'nrRecEvt': {'__VALUE__': '1.2.0000000000000000001'}},
+            }
+        }
+    }
+    evt_json_copy = json.loads(json.dumps(evt_json))
+    evt = xml.load_fromjson(evt_json)
+    assert evt_json == evt_json_copy, '[load_fromjson] Expected the JSON structure not to be modified'
+    assert xml.dump_tostring(xml.load_fromjson(evt_json)) == xml.dump_tostring(evt), '[load_fromjson] Expected the same XML'
+    lines = [json.dumps(evt_json)] * 3 + ['']
+    docs = list(xml.iterdump_fromjson(lines))
+    assert len(docs) == 3, '[iterdump_fromjson] Expected 3 documents, got {}'.format(len(docs))
+    assert docs[0] == xml.dump_tostring(evt), '[iterdump_fromjson] Expected {}, got {}'.format(xml.dump_tostring(evt), docs[0])
+    nr_rec = xml.find(next(xml.iterload_fromjson(lines)).getroot(), 'nrRecEvt').text
+    assert nr_rec == '1.2.0000000000000000001', '[iterload_fromjson] Got {}'.format(nr_rec)
+
+
+def test_xml_event_template():
+    cert_data = pkcs12_data(
+        cert_file=os.path.join(here, 'certs', 'libesocial-cert-test.pfx'),
+        password='cert@test'
+    )
+    template = xml.EventTemplate(os.path.join(here, 'xml', 'S-2220-vS-1.0.xml'))
+    assert 'evtMonit/exMedOcup/aso/exame' in template.paths, '[EventTemplate] Got {}'.format(template.paths)
+    evt = template.fill({
+        'evtMonit/@Id': 'ID1000000000000002018081110363700001',
+        'evtMonit/ideEvento/indRetif': 1,
+        'evtMonit/ideEvento/nrRecibo': None,
+        'evtMonit/ideVinculo/cpfTrab': '98765432100',
+    })
+    assert xml.find(evt.getroot(), 'nrRecibo') is None, '[EventTemplate] Expected nrRecibo to be removed'
+    cpf = xml.find(evt.getroot(), 'cpfTrab').text
+    assert cpf == '98765432100', '[EventTemplate] Expected 98765432100, got {}'.format(cpf)
+    xml.XMLValidate(xml.Signer(cert_data).sign(evt)).validate()
+    # The skeleton is not changed by fill()
+    nr_recibo = xml.find(template.fill().getroot(), 'nrRecibo')
+    assert nr_recibo is not None, '[EventTemplate] Expected the skeleton to keep nrRecibo'
+    # Nor the paths, by aliases
+    paths = template.paths
+    evt = template.fill({'evtMonit/exMedOcup/aso/exame[1]/dtExm': '2018-03-20'})
+    assert xml.find(evt.getroot(), 'exame/dtExm').text == '2018-03-20', '[EventTemplate] Expected exame[1] to be exame'
+    assert template.paths == paths, '[EventTemplate] Expected the same paths, got {}'.format(set(template.paths) - set(paths))
+    try:
+        template.fill({'evtMonit/ideVinculo/nisTrab': '1'})
+        assert False, '[EventTemplate] Expected KeyError for an unknown path'
+    except KeyError:
+        pass
+    # Sibling signatures are all removed
+    signed = xml.load_fromfile(os.path.join(here, 'xml', 'S-2220-vS-1.0.xml'))
+    signature = signed.getroot()[-1]
+    signed.getroot().append(copy.deepcopy(signature))
+    skeleton = xml.EventTemplate(signed).fill()
+    assert skeleton.getroot().find('{http://www.w3.org/2000/09/xmldsig#}Signature') is None, '[EventTemplate] Expected no signature'
+
+
+def test_xml_validate_many():
+    evt_file = os.path.join(here, 'xml', 'S-2220-vS-1.0.xml')
+    evt_not_signed = os.path.join(here, 'xml', 'S-2220-vS-1.0-not_signed.xml')
+    with open(evt_file, 'rb') as fp:
+        evt_bytes = fp.read()
+    documents = [evt_file, evt_not_signed, evt_bytes, xml.load_fromfile(evt_not_signed), b'<eSocial>']
+    for workers in (1, 2):
+        report = xml.validate_many(documents, workers=workers)
+        got = [failure['index'] for failure in report]
+        assert got == [1, 3, 4], '[validate_many] Expected failures [1, 3, 4], got {}'.format(got)
+        assert report[0]['source'] == evt_not_signed, '[validate_many] Got {}'.format(report[0])
+        assert report[0]['event'] == 'evtMonit', '[validate_many] Got {}'.format(report[0])
+        assert report[0]['errors'][0]['line'] == 1, '[validate_many] Got {}'.format(report[0]['errors'])
+        # The ElementTree validated on a worker has no line numbers, but the element path
+        expected_line = 1 if workers == 1 else None
+        assert report[1]['errors'][0]['line'] == expected_line, '[validate_many] Got {}'.format(report[1]['errors'])
+        assert report[1]['errors'][0]['path'].startswith('/'), '[validate_many] Got {}'.format(report[1]['errors'])
+
+
+def test_xml_validate_threads():
+    # The threads share the cached schema: each must get the errors of its own document
+    evt_file = os.path.join(here, 'xml', 'S-2220-vS-1.0.xml')
+    documents = []
+    for i in range(40):
+        evt = xml.load_fromfile(evt_file)
+        if i % 2:
+            xml.find(evt.getroot(), 'cpfTrab').text = 'X{}'.format(i)
+        documents.append(evt)
+
+    def errors(i):
+        validator = xml.XMLValidate(documents[i], esocial_version='S-1.0')
+        validator.isvalid()
+        return [e.message for e in validator.last_errors]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for n in range(5):
+            for i, messages in enumerate(executor.map(errors, range(len(documents)))):
+                if i % 2:
+                    assert any("'X{}'".format(i) in message for message in messages), \
+                        '[XMLValidate] Expected the errors of document {}, got {}'.format(i, messages)
+                else:
+                    assert messages == [], '[XMLValidate] Expected no errors for document {}, got {}'.format(i, messages)
+
+
+def test_xml_download_response(tmp_path):
+    evt_file = os.path.join(here, 'xml', 'S-2220-vS-1.0.xml')
+    evt = xml.load_fromfile(evt_file)
+    evt_id = xml.find(evt.getroot(), 'evtMonit').get('Id')
+    arquivo = (
+        '<arquivo><status><cdResposta>201</cdResposta><descResposta>Sucesso.</descResposta></status>'
+        '<evt Id="{id}">{evt}</evt></arquivo>'
+    ).format(id=evt_id, evt=xml.dump_tostring(evt, xml_declaration=False))
+    not_found = '<arquivo><status><cdResposta>404</cdResposta><descResposta>Not found.</descResposta></status></arquivo>'
+    response = (
+        '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body>'
+        '<eSocial xmlns="http://www.esocial.gov.br/schema/download/solicitacao/retorno/v1_0_0"><download>'
+        '<status><cdResposta>201</cdResposta><descResposta>Sucesso.</descResposta></status>'
+        '<retornoSolicDownloadEvts><arquivos>{}</arquivos></retornoSolicDownloadEvts>'
+        '</download></eSocial></s:Body></s:Envelope>'
+    ).format(arquivo * 3 + not_found).encode('utf-8')
+    download = xml.DownloadResponse(response)
+    arquivos = list(download)
+    assert len(arquivos) == 4, '[DownloadResponse] Expected 4 files, got {}'.format(len(arquivos))
+    assert download.status['cdResposta'] == '201', '[DownloadResponse] Got {}'.format(download.status)
+    assert arquivos[0]['id'] == evt_id, '[DownloadResponse] Expected {}, got {}'.format(evt_id, arquivos[0]['id'])
+    assert arquivos[3]['status']['cdResposta'] == '404' and arquivos[3]['evento'] is None, '[DownloadResponse] Got {}'.format(arquivos[3])
+    # The downloaded event keeps its signature
+    xml.XMLValidate(arquivos[2]['evento']).validate()
+    arquivos = list(xml.DownloadResponse(response, path=str(tmp_path)))
+    assert arquivos[0]['evento'] == str(tmp_path / '{}.xml'.format(evt_id)), '[DownloadResponse] Got {}'.format(arquivos[0]['evento'])
+    xml.XMLValidate(arquivos[0]['evento']).validate()
@@ -0,0 +1,200 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""HTTP and zeep transport layer of the eSocial webservices clients.
+
+This module imports requests and zeep, so it is only loaded (by
+esocial.client) when a webservice is first used.
+"""
+import os
+import re
+import time
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.ssl_ import create_urllib3_context
+
+from esocial.utils import (
+    pem_file,
+    certificate_store,
+)
+
+from zeep.cache import Base as ZeepCacheBase
+from zeep.transports import (
+    Transport,
+    AsyncTransport,
+)
+
+
+here = os.path.abspath(os.path.dirname(__file__))
+# WSDLs shipped with the package (read-only), written from the published
+# service contracts: not downloaded from the webservices
+bundled_wsdl_dir = os.path.join(here, 'wsdl')
+
+# Default time to live, in seconds, of the WSDL documents stored on a local cache directory
+WSDL_CACHE_TTL = 7 * 24 * 60 * 60
+
+
+class WSDLNotCachedError(Exception):
+    pass
+
+
+def user_wsdl_cache_dir():
+    """The user's WSDL cache directory: $ESOCIAL_WSDL_CACHE or, by default,
+    $XDG_CACHE_HOME/esocial/wsdl (~/.cache/esocial/wsdl)."""
+    path = os.environ.get('ESOCIAL_WSDL_CACHE')
+    if path:
+        return path
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'esocial', 'wsdl')
+
+
+class WSDLCache(ZeepCacheBase):
+    """On-disk cache for the webservices descriptions (WSDL and imported XSD's).
+
+    Documents are searched on `path` (if given and not older than `timeout`
+    seconds) and, with bundled=True, then on the directory bundled with the
+    package (esocial/wsdl), whose documents never expire and which is never
+    written. New documents are only written to `path`. The clients' default
+    cache is WSDLCache.default(), on the user's cache directory: documents
+    not found there are downloaded from the webservices.
+
+    The bundled WSDLs are not downloaded from the webservices, but written
+    from their published contracts, and nothing checks them against the
+    services: they are meant for tests and for offline use on machines
+    that can not download (see client.refresh_wsdl_cache()) the real ones.
+
+    Parameters
+    ----------
+    path: a writable directory, optional
+    timeout: time to live, in seconds, of the documents on `path`. If None,
+        they never expire.
+    bundled: if True, the documents not found on `path` are searched on the
+        bundled directory.
+    """
+    def __init__(self, path=None, timeout=WSDL_CACHE_TTL, bundled=False):
+        self.path = path
+        self.timeout = timeout
+        self.bundled = bundled
+
+    @classmethod
+    def default(cls):
+        """The cache on user_wsdl_cache_dir(), where the refreshed WSDLs are."""
+        return cls(path=user_wsdl_cache_dir())
+
+    @staticmethod
+    def filename(url):
+        return re.sub(r'[^A-Za-z0-9._-]+', '_', url.split('://', 1)[-1])
+
+    def _read(self, file_path):
+        with open(file_path, 'rb') as fp:
+            return fp.read()
+
+    def get(self, url):
+        file_name = self.filename(url)
+        if self.path is not None:
+            file_path = os.path.join(self.path, file_name)
+            if os.path.exists(file_path):
+                age = time.time() - os.path.getmtime(file_path)
+                if self.timeout is None or age < self.timeout:
+                    return self._read(file_path)
+        if self.bundled:
+            file_path = os.path.join(bundled_wsdl_dir, file_name)
+            if os.path.exists(file_path):
+                return self._read(file_path)
+        return None
+
+    def add(self, url, content):
+        if self.path is None:
+            return
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        file_path = os.path.join(self.path, self.filename(url))
+        tmp_path = '{}.{}.tmp'.format(file_path, os.getpid())
+        with open(tmp_path, 'wb') as fp:
+            fp.write(content)
+        os.replace(tmp_path, file_path)
+
+
+class CachedTransport(Transport):
+    """zeep Transport that, when `offline` is True, never goes to the network
+    to load service descriptions: they must be found on the cache.
+    """
+    def __init__(self, offline=False, **kwargs):
+        self.offline = offline
+        super(CachedTransport, self).__init__(**kwargs)
+
+    def _load_remote_data(self, url):
+        if self.offline:
+            raise WSDLNotCachedError('{} is not cached and offline mode is on.'.format(url))
+        return super(CachedTransport, self)._load_remote_data(url)
+
+
+def _new_ssl_context(ctx_options):
+    context = create_urllib3_context()
+    context.load_verify_locations(cafile=ctx_options.get('cafile'))
+    if ctx_options.get('cert_data') is not None:
+        with pem_file(ctx_options.get('cert_data'), ctx_options.get('key_passwd')) as pem:
+            context.load_cert_chain(pem.name, password=pem.password)
+    return context
+
+
+def ssl_context(ctx_options=None):
+    """Returns the SSL context used to connect to the eSocial webservices.
+
+    Contexts are built once per certificate and CA bundle and shared (see
+    esocial.utils.CertificateStore).
+
+    Parameters
+    ----------
+    ctx_options: dict with the keys 'cafile', 'cert_data' and 'key_passwd'
+    """
+    if ctx_options is None:
+        return create_urllib3_context()
+    return certificate_store.ssl_context(
+        ctx_options.get('cert_data'),
+        ctx_options.get('cafile'),
+        lambda: _new_ssl_context(ctx_options)
+    )
+
+
+class CustomHTTPSAdapter(HTTPAdapter):
+
+    def __init__(self, ctx_options=None, **kwargs):
+        self.ctx_options = ctx_options
+        super(CustomHTTPSAdapter, self).__init__(**kwargs)
+
+    def _configure_ssl_context(self):
+        return ssl_context(self.ctx_options)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self._configure_ssl_context()
+        return super(CustomHTTPSAdapter, self).init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, *args, **kwargs):
+        kwargs['ssl_context'] = self._configure_ssl_context()
+        return super(CustomHTTPSAdapter, self).proxy_manager_for(*args, **kwargs)
+
+
+class AsyncCachedTransport(AsyncTransport):
+    """Same as CachedTransport, for the asyncio client."""
+    def __init__(self, offline=False, **kwargs):
+        self.offline = offline
+        super(AsyncCachedTransport, self).__init__(**kwargs)
+
+    def _load_remote_data(self, url):
+        if self.offline:
+            raise WSDLNotCachedError('{} is not cached and offline mode is on.'.format(url))
+        return super(AsyncCachedTransport, self)._load_remote_data(url)
@@ -14,13 +14,13 @@
 # ==============================================================================
 import six
 import os
+import hashlib
 import tempfile
+import threading
 import contextlib
 
 # from OpenSSL import crypto
 
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.serialization import pkcs12
 
 def format_xsd_version(str_version):
     chars_to_transform = '.-'
@@ -44,6 +44,10 @@ def normalize_text(text):
 
 
 def pkcs12_data(cert_file, password):
+    # cryptography is only imported when a certificate is loaded
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.serialization import pkcs12
     password = password.encode('utf-8')
     with open(cert_file, 'rb') as fp:
         content_pkcs12 = pkcs12.load_pkcs12(fp.read(), password)
@@ -60,11 +64,13 @@ def pkcs12_data(cert_file, password):
         'cert_str': cert_str,
         'key': pkey,
         'cert': cert_X509,
+        'fingerprint': cert_X509.fingerprint(hashes.SHA256()),
     }
 
 
 @contextlib.contextmanager
 def encrypt_pem_file(cert_data, cert_pass):
+    from cryptography.hazmat.primitives import serialization
     pem_pvkey_bytes = cert_data['key'].private_bytes(
         encoding=serialization.Encoding.PEM,
         format=serialization.PrivateFormat.PKCS8,
@@ -79,3 +85,86 @@ def encrypt_pem_file(cert_data, cert_pass):
         yield fp
     finally:
         os.unlink(fp.name)
+
+
+@contextlib.contextmanager
+def pem_file(cert_data, cert_pass):
+    """Yields a path to a PEM file with the certificate and its private key.
+
+    Where supported (Linux), the file lives only in memory (memfd_create) and
+    the key is not encrypted, since it never touches the disk. Otherwise, an
+    encrypted temporary file is used (see encrypt_pem_file()). The yielded
+    object has the `name` and `password` attributes.
+    """
+    proc_fd = '/proc/self/fd'
+    if hasattr(os, 'memfd_create') and os.path.isdir(proc_fd):
+        fd = os.memfd_create('esocial-cert')
+        try:
+            os.write(fd, cert_data['cert_str'])
+            os.write(fd, cert_data['key_str'])
+            yield _PEMFile(os.path.join(proc_fd, str(fd)), None)
+        finally:
+            os.close(fd)
+    else:
+        with encrypt_pem_file(cert_data, cert_pass) as fp:
+            yield _PEMFile(fp.name, cert_pass)
+
+
+class _PEMFile(object):
+    def __init__(self, name, password):
+        self.name = name
+        self.password = password
+
+
+class CertificateStore(object):
+    """Process-wide store of certificates and SSL contexts.
+
+    Each PFX file is parsed once (it's reloaded if the file changes) and each
+    SSL context is built once per certificate and CA bundle, then shared by
+    every client and thread.
+    """
+    def __init__(self):
+        self._certs = {}
+        self._contexts = {}
+        self._lock = threading.RLock()
+
+    def load(self, cert_file, password):
+        """Same as pkcs12_data(), but cached. When the file changes (e.g. a
+        renewed certificate), the cached certificate is replaced."""
+        cert_file = os.path.abspath(cert_file)
+        key = (cert_file, hashlib.sha256(password.encode('utf-8')).hexdigest())
+        mtime = os.path.getmtime(cert_file)
+        with self._lock:
+            cached = self._certs.get(key)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+            cert_data = pkcs12_data(cert_file, password)
+            self._certs[key] = (mtime, cert_data)
+            if cached is not None:
+                self._discard_contexts(cached[1]['fingerprint'])
+            return cert_data
+
+    def _discard_contexts(self, fingerprint):
+        # Drop the SSL contexts of a certificate no longer cached
+        if any(cert_data['fingerprint'] == fingerprint for mtime, cert_data in self._certs.values()):
+            return
+        for key in [key for key in self._contexts if key[0] == fingerprint]:
+            del self._contexts[key]
+
+    def ssl_context(self, cert_data, cafile, factory):
+        """Returns the SSL context of a certificate, calling factory() to build it on the first use."""
+        key = (cert_data['fingerprint'] if cert_data else None, cafile)
+        with self._lock:
+            context = self._contexts.get(key)
+            if context is None:
+                context = factory()
+                self._contexts[key] = context
+            return context
+
+    def clear(self):
+        with self._lock:
+            self._certs.clear()
+            self._contexts.clear()
+
+
+certificate_store = CertificateStore()
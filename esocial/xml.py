@@ -13,9 +13,14 @@
 # limitations under the License.
 # ==============================================================================
 import os
-import types
+import re
+import copy
+import io
 import codecs
 import json
+import threading
+import functools
+import hashlib
 
 from collections import OrderedDict
 
@@ -23,22 +28,26 @@ import six
 
 from lxml import etree
 
-import signxml
-
-from signxml import XMLSigner
-
-from dotmap import DotMap
+import esocial
 
 from esocial import utils
 from esocial import __esocial_version__
 
 
+here = os.path.dirname(os.path.abspath(__file__))
+
+
 class XMLValidateError(Exception):
     def __init__(self, list_log, message='XML is invalid. {} error(s) found'):
+        self._message = message
         self.message = message.format(len(list_log))
-        self.errors = [e.message for e in list_log]
+        # list_log may also be a list of error messages (e.g. when unpickling)
+        self.errors = [getattr(e, 'message', e) for e in list_log]
         super().__init__(self.message)
 
+    def __reduce__(self):
+        return (self.__class__, (self.errors, self._message))
+
 
 class XMLValidate(object):
     """Validate a XML document against its XSD file.
@@ -78,8 +87,7 @@ class XMLValidate(object):
         """Validate XML doc and returns True or False.
         """
         self.last_errors = None
-        is_valid = self.xsd.validate(self.xml_doc)
-        self.last_errors = self.xsd.error_log
+        is_valid, self.last_errors = schema_validate(self.xsd, self.xml_doc)
         return is_valid
 
     def validate(self):
@@ -89,6 +97,196 @@ class XMLValidate(object):
             raise XMLValidateError(self.last_errors)
 
 
+def _error_entries(error_log):
+    return [
+        {'line': entry.line, 'column': entry.column, 'path': entry.path, 'message': entry.message}
+        for entry in error_log
+    ]
+
+
+def _document_event_name(document):
+    # The event name (the first child of the root tag) without parsing the
+    # whole document
+    if isinstance(document, etree._ElementTree):
+        children = document.getroot().getchildren()
+        return etree.QName(children[0]).localname if children else None
+    if isinstance(document, bytes):
+        document = io.BytesIO(document)
+    depth = 0
+    for action, element in etree.iterparse(document, events=('start',)):
+        depth += 1
+        if depth == 2:
+            return etree.QName(element).localname
+    return None
+
+
+def _validate_chunk(event_name, esocial_version, documents):
+    """Validates (index, document) pairs of the same event against its XSD,
+    returning the failures (see validate_many())."""
+    failures = []
+    try:
+        xsd = xsd_cache.event(event_name, esocial_version=esocial_version)
+    except (IOError, OSError, etree.XMLSchemaParseError) as err:
+        xsd_error = [{'line': None, 'column': None, 'path': None, 'message': 'Can not load the XSD of {}: {}'.format(event_name, err)}]
+        return [(index, xsd_error) for index, document in documents]
+    for index, document in documents:
+        try:
+            if isinstance(document, bytes):
+                document = load_fromstring(document)
+            elif not isinstance(document, etree._ElementTree):
+                document = load_fromfile(document)
+        except etree.XMLSyntaxError as err:
+            failures.append((index, _error_entries(err.error_log)))
+            continue
+        is_valid, error_log = schema_validate(xsd, document)
+        if not is_valid:
+            failures.append((index, _error_entries(error_log)))
+    return failures
+
+
+def validate_many(documents, workers=None, esocial_version=__esocial_version__, executor=None, chunksize=500):
+    """Validate many eSocial events, collecting the errors of all of them.
+
+    The documents are grouped by event, so each XSD is loaded once (per
+    worker process), and validated in chunks of up to `chunksize` documents.
+
+    Parameters
+    ----------
+    documents: iterable of lxml.etree._ElementTree, XML file paths or XML bytes.
+    workers: number of worker processes. If None, os.cpu_count() is used;
+        if 0 or 1, the documents are validated in the current process.
+    esocial_version: eSocial layout version.
+    executor: a process pool to reuse between calls, instead of starting a
+        new one with `workers` processes.
+    chunksize: maximum number of documents validated by each task.
+
+    Returns
+    -------
+    A list with one dict for each invalid document, in the order of
+    `documents`:
+        {
+            'index': position of the document in `documents`,
+            'source': the file path (None for ElementTrees and bytes),
+            'event': the event name (e.g. 'evtMonit'),
+            'errors': [{'line': 1, 'column': 0, 'path': '/eSocial/...', 'message': '...'}, ...]
+        }
+    An empty list means that all documents are valid. ElementTrees validated
+    on worker processes are sent serialized, so their errors have no line
+    and column (which would point into that copy): use the path of the
+    element, with the index of the document.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    in_process = executor is None and workers <= 1
+    sources = {}
+    events = {}
+    groups = OrderedDict()
+    failures = []
+    reserialized = set()
+    for index, document in enumerate(documents):
+        if isinstance(document, six.string_types):
+            sources[index] = document
+        try:
+            event_name = _document_event_name(document)
+        except etree.XMLSyntaxError as err:
+            failures.append((index, _error_entries(err.error_log)))
+            continue
+        events[index] = event_name
+        if event_name is None:
+            failures.append((index, [{'line': None, 'column': None, 'path': None, 'message': 'Event tag not found'}]))
+            continue
+        if isinstance(document, etree._ElementTree) and not in_process:
+            # ElementTrees can not be sent to other processes
+            document = etree.tostring(document)
+            reserialized.add(index)
+        groups.setdefault(event_name, []).append((index, document))
+    chunks = [
+        (event_name, esocial_version, group[i:i + chunksize])
+        for event_name, group in groups.items()
+        for i in range(0, len(group), chunksize)
+    ]
+    if in_process:
+        for chunk in chunks:
+            failures.extend(_validate_chunk(*chunk))
+    else:
+        own_executor = executor is None
+        if own_executor:
+            from concurrent.futures import ProcessPoolExecutor
+            executor = ProcessPoolExecutor(max_workers=workers)
+        try:
+            tasks = [executor.submit(_validate_chunk, *chunk) for chunk in chunks]
+            for task in tasks:
+                failures.extend(task.result())
+        finally:
+            if own_executor:
+                executor.shutdown()
+    for index, errors in failures:
+        if index in reserialized:
+            for error in errors:
+                error['line'] = error['column'] = None
+    return [
+        {'index': index, 'source': sources.get(index), 'event': events.get(index), 'errors': errors}
+        for index, errors in sorted(failures, key=lambda failure: failure[0])
+    ]
+
+
+class ValidatedEvents(object):
+    """Thread-safe LRU set of the digests of the events already validated, so
+    the same event (byte by byte) is validated only once:
+
+        validated = ValidatedEvents()
+        validated.validate(event_signed)
+        validated.validate(event_signed)  # not validated again
+
+    Parameters
+    ----------
+    maxsize: maximum number of digests kept (if None, unbounded)
+    esocial_version: eSocial layout version.
+    """
+    def __init__(self, maxsize=100000, esocial_version=__esocial_version__):
+        self.maxsize = maxsize
+        self.esocial_version = esocial_version
+        self.hits = 0
+        self.misses = 0
+        self._digests = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._digests)
+
+    def validate(self, event, serialized=None):
+        """Validate an event (ElementTree or its serialized bytes) unless the
+        same bytes were validated before. Raises XMLValidateError if invalid.
+
+        `serialized` are the event bytes, when already at hand.
+        """
+        if isinstance(event, bytes):
+            serialized = event
+        elif serialized is None:
+            serialized = etree.tostring(event)
+        digest = hashlib.sha256(serialized).digest()
+        with self._lock:
+            if digest in self._digests:
+                self._digests.move_to_end(digest)
+                self.hits += 1
+                return
+            self.misses += 1
+        if isinstance(event, bytes):
+            event = load_fromstring(event)
+        XMLValidate(event, esocial_version=self.esocial_version).validate()
+        with self._lock:
+            self._digests[digest] = True
+            if self.maxsize is not None:
+                while len(self._digests) > self.maxsize:
+                    self._digests.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._digests.clear()
+            self.hits = 0
+            self.misses = 0
+
+
 class XMLHelper(object):
     """Class to help create XML documents.
 
@@ -105,30 +303,222 @@ class XMLHelper(object):
         self.root = create_root_element(root_element, ns=self.nsmap, **attrs)
     
     def add_element(self, element_tag, tag_name, text=None, **attrs):
+        """Add a tag_name element to the element_tag element, which can be a path
+        from the root (e.g. 'envioLoteEventos/ideEmpregador'), None (the root
+        itself) or an element returned by a previous add_element() call.
+        """
         return add_element(self.root, element_tag, tag_name, text=text, ns=self.nsmap, **attrs)
-    
+
+    def cursor(self, element=None):
+        """Returns a XMLCursor on the element (default: the root element)."""
+        return XMLCursor(self.root if element is None else element, self.nsmap)
+
+
+class XMLCursor(object):
+    """Handle to an element of a document being built, used to add children
+    without searching the tree from the root:
+
+        envelop = XMLHelper('eSocial', xmlns=xmlns)
+        with envelop.cursor().add('envioLoteEventos', grupo='1') as batch:
+            with batch.add('ideEmpregador') as employer:
+                employer.add('tpInsc', text='1')
+                employer.add('nrInsc', text='12345678')
+
+    Parameters
+    ----------
+    element: the lxml element.
+    ns: the namespace map of the document (see add_element()).
+    """
+    __slots__ = ('element', 'ns', '_namespace')
+
+    def __init__(self, element, ns={}):
+        self.element = element
+        self.ns = ns
+        self._namespace = None
+        if len(ns) == 1:
+            self._namespace = list(ns.values())[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def add(self, tag_name, text=None, **attrs):
+        """Add a child element, returning a XMLCursor on it."""
+        if self._namespace is not None:
+            sub_tag = etree.SubElement(self.element, qualified_tag(self._namespace, tag_name), nsmap=self.ns)
+        else:
+            sub_tag = etree.SubElement(self.element, tag_name)
+        _set_element(sub_tag, text, attrs)
+        return XMLCursor(sub_tag, self.ns)
+
+
+class SharedXMLSchema(etree.XMLSchema):
+    """etree.XMLSchema that can be shared by threads.
+
+    lxml keeps the error log of the last validation in the schema object, so
+    the validations of a shared schema run one at a time (see check()).
+    """
+    def __init__(self, *args, **kwargs):
+        super(SharedXMLSchema, self).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+
+    def check(self, document):
+        """Validate `document`, returning (is_valid, error_log of this validation)."""
+        with self._lock:
+            return (self.validate(document), self.error_log)
+
+
+_validation_lock = threading.Lock()
+
+
+def schema_validate(xsd, document):
+    """Validate `document` against `xsd`, returning (is_valid, error_log).
+
+    Schemas other than SharedXMLSchema's (e.g. given to XMLValidate) are
+    validated under a lock shared by all of them.
+    """
+    if isinstance(xsd, SharedXMLSchema):
+        return xsd.check(document)
+    with _validation_lock:
+        return (xsd.validate(document), xsd.error_log)
+
 
 def xsd_fromfile(f):
     with codecs.open(f, 'r', encoding='utf-8') as fxsd:
         xmlschema = etree.parse(fxsd)
-    return etree.XMLSchema(xmlschema)
+    return SharedXMLSchema(xmlschema)
+
+
+def xsd_event_file(event_name, esocial_version=__esocial_version__):
+    """Returns the XSD file path of an eSocial event (e.g. 'evtMonit')."""
+    return os.path.join(here, 'xsd', 'v{}'.format(esocial_version), '{}.xsd'.format(event_name))
+
+
+def xsd_envelop_file(which):
+    """Returns the XSD file path of a webservice envelop (a key of esocial.__xsd_versions__)."""
+    version = utils.format_xsd_version(esocial.__xsd_versions__[which]['version'])
+    return os.path.join(here, 'xsd', esocial.__xsd_versions__[which]['xsd'].format(version))
+
+
+class XMLSchemaCache(object):
+    """Thread-safe LRU cache of compiled XSD schemas.
+
+    Compiling an eSocial XSD (and the tipos.xsd it includes) is by far the most
+    expensive step of a validation, so compiled etree.XMLSchema objects are kept
+    and reused, keyed by (esocial_version, event_name) for events and by
+    ('envelop', which) for the webservices envelops.
+
+    Parameters
+    ----------
+    maxsize: int
+        Maximum number of compiled schemas kept. The least recently used one is
+        evicted when the cache is full. If None, the cache is unbounded.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._schemas = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._schemas)
+
+    def __contains__(self, key):
+        return key in self._schemas
+
+    def get(self, key, xsd_file):
+        """Returns the compiled schema stored under `key`, compiling `xsd_file` on a miss.
+        """
+        with self._lock:
+            xmlschema = self._schemas.get(key)
+            if xmlschema is not None:
+                self._schemas.move_to_end(key)
+                self.hits += 1
+                return xmlschema
+            self.misses += 1
+            xmlschema = xsd_fromfile(xsd_file)
+            self._schemas[key] = xmlschema
+            if self.maxsize is not None:
+                while len(self._schemas) > self.maxsize:
+                    self._schemas.popitem(last=False)
+            return xmlschema
+
+    def event(self, event_name, esocial_version=__esocial_version__):
+        return self.get((esocial_version, event_name), xsd_event_file(event_name, esocial_version))
+
+    def envelop(self, which):
+        return self.get(('envelop', which), xsd_envelop_file(which))
+
+    def preload(self, esocial_version=__esocial_version__, events=None, envelops=True):
+        """Compile schemas ahead of time, e.g. at worker startup.
+
+        Parameters
+        ----------
+        esocial_version: eSocial layout version of the events XSDs.
+        events: list of event names (e.g. ['evtMonit', 'evtExpRisco']). If None,
+            every event XSD available for `esocial_version` is loaded.
+        envelops: if True, also loads the webservices envelops XSDs.
+        """
+        if events is None:
+            xsd_dir = os.path.join(here, 'xsd', 'v{}'.format(esocial_version))
+            events = sorted(
+                f[:-4] for f in os.listdir(xsd_dir) if f.startswith('evt') and f.endswith('.xsd')
+            )
+        for event_name in events:
+            self.event(event_name, esocial_version=esocial_version)
+        if envelops:
+            for which in esocial.__xsd_versions__:
+                self.envelop(which)
+
+    def clear(self):
+        with self._lock:
+            self._schemas.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'maxsize': self.maxsize,
+            'currsize': len(self._schemas),
+        }
+
+
+xsd_cache = XMLSchemaCache()
 
 
 def xsd_fromdoc(xml_doc, esocial_version=__esocial_version__):
     xsd = None
-    xsd_path = os.path.dirname(os.path.abspath(__file__))
     if len(xml_doc.getroot().getchildren()) > 0:
         tag = etree.QName(xml_doc.getroot().getchildren()[0].tag)
-        xsd_file = os.path.join(
-            xsd_path,
-            'xsd',
-            'v{}'.format(esocial_version),
-            '{}.xsd'.format(tag.localname)
-        )
-        xsd = xsd_fromfile(xsd_file)
+        xsd = xsd_cache.event(tag.localname, esocial_version=esocial_version)
     return xsd
 
 
+def event_group(xml_doc):
+    """Returns the batch group (envioLoteEventos/@grupo) of an eSocial event:
+    1 (table events), 2 (non periodic events) or 3 (periodic events).
+    """
+    event_tag = xml_doc.getroot().getchildren()[0]
+    event_name = etree.QName(event_tag).localname
+    if event_name not in esocial._EVENTS:
+        raise ValueError('Event {} can not be sent in a batch.'.format(event_name))
+    code, group = esocial._EVENTS[event_name]
+    if group is None:
+        # S-3000 goes with the group of the excluded event
+        tp_evento = find(event_tag, 'tpEvento')
+        excluded = tp_evento.text if tp_evento is not None else None
+        for code, group in esocial._EVENTS.values():
+            if code == excluded and group is not None:
+                return group
+        raise ValueError('Can not find the group of the excluded event {}.'.format(excluded))
+    return group
+
+
 def create_root_element(root_tag, ns={}, **attrs):
     """Create a root XML element
 
@@ -150,20 +540,34 @@ def create_root_element(root_tag, ns={}, **attrs):
     return root
 
 
+@functools.lru_cache(maxsize=None)
+def qualified_tag(namespace, tag_name):
+    """Clark notation ('{namespace}tag_name') of a tag, cached."""
+    return u''.join([u'{', namespace, u'}', tag_name])
+
+
+def _set_element(element, text, attrs):
+    if attrs:
+        for attr in attrs:
+            element.set(attr, utils.normalize_text(attrs[attr]))
+    if text is not None:
+        element.text = utils.normalize_text(str(text))
+
+
 def add_element(root, element_tag, tag_name, text=None, ns={}, **attrs):
     tag_root = None
     ns_keys = [K for K in ns]
-    if element_tag:
+    if isinstance(element_tag, etree._Element):
+        # An element handle: no need to search for it
+        tag_root = element_tag
+    elif element_tag:
         if len(ns) == 1:
-            search_tags = element_tag.split('/')
             k = None
             if ns_keys[0] is None:
                 k = ns[None]
             else:
                 k = ns_keys[0]
-            for i, t in enumerate(search_tags):
-                 search_tags[i] = '{{{}}}{}'.format(k, t)
-            element_tag = '/'.join(search_tags)
+            element_tag = '/'.join(qualified_tag(k, t) for t in element_tag.split('/'))
         tag_root = root.find(element_tag)
     else:
         tag_root = root
@@ -171,15 +575,11 @@ def add_element(root, element_tag, tag_name, text=None, ns={}, **attrs):
         # MUST be just one name space map!!!
         if len(ns) == 1:
             k = ns_keys[0]
-            tag_name = u''.join([u'{', ns[k], u'}', tag_name])
+            tag_name = qualified_tag(ns[k], tag_name)
             sub_tag = etree.SubElement(tag_root, tag_name, nsmap=ns)
         else:
             sub_tag = etree.SubElement(tag_root, tag_name)
-        if attrs:
-            for attr in attrs:
-                sub_tag.set(attr, utils.normalize_text(attrs[attr]))
-        if text is not None:
-            sub_tag.text = utils.normalize_text(str(text))
+        _set_element(sub_tag, text, attrs)
         return sub_tag
     return None
 
@@ -211,37 +611,135 @@ def dump_tostring(xmlelement, xml_declaration=True, pretty_print=False):
     return ''.join([xml_header, etree.tostring(xmlelement, encoding='unicode', pretty_print=pretty_print)])
 
 
+# Stands for an event in envelop skeletons (see write_envelop())
+EVENT_PLACEHOLDER = 'eventPlaceholder'
+
+
+def _write_skeleton(xf, output, element, events, nsmap=None):
+    # Generator: yields after writing each event
+    if element.tag == EVENT_PLACEHOLDER:
+        event = next(events)
+        if isinstance(event, bytes):
+            # Already serialized: written as is, without its XML declaration
+            if event.startswith(b'<?xml'):
+                event = event.split(b'?>', 1)[1].lstrip()
+            xf.flush()
+            output.write(event)
+        else:
+            xf.write(event.getroot() if isinstance(event, etree._ElementTree) else event)
+        yield
+        return
+    with xf.element(element.tag, element.attrib, nsmap=nsmap):
+        if element.text:
+            xf.write(element.text)
+        for child in element:
+            yield from _write_skeleton(xf, output, child, events)
+
+
+def _write_envelop(output, skeleton, events, xml_declaration):
+    # Generator: yields once each event is written (and flushed) to output
+    if isinstance(skeleton, etree._ElementTree):
+        skeleton = skeleton.getroot()
+    events = iter(events)
+    with etree.xmlfile(output, encoding='utf-8') as xf:
+        if xml_declaration:
+            xf.write_declaration()
+        for _ in _write_skeleton(xf, output, skeleton, events, nsmap=skeleton.nsmap):
+            xf.flush()
+            yield
+
+
+def write_envelop(output, skeleton, events, xml_declaration=False):
+    """Write an envelop to `output` (a binary file-like object) incrementally.
+
+    Each EVENT_PLACEHOLDER element of `skeleton` is replaced by the next
+    event of `events`: an ElementTree (or element), serialized straight from
+    its tree, or the bytes of an already serialized event, written as they
+    are. The envelop with all the events is never built in memory and the
+    events are not changed.
+    """
+    for _ in _write_envelop(output, skeleton, events, xml_declaration):
+        pass
+
+
+class _Chunks(object):
+    # Binary file-like object keeping what is written until taken
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_envelop(skeleton, events, xml_declaration=False):
+    """Same as write_envelop(), but yields the envelop in chunks of bytes, one
+    event at a time, e.g. to be sent as the body of an HTTP request: only one
+    serialized event is in memory at a time.
+    """
+    output = _Chunks()
+    for _ in _write_envelop(output, skeleton, events, xml_declaration):
+        data = output.take()
+        if data:
+            yield data
+    data = output.take()
+    if data:
+        yield data
+
+
+_SPECIAL_KEYS = ('__ATTRS__', '__VALUE__')
+
+
 def _check_attrs(tag_dict):
+    """Split the attributes, namespace map and value of a load_fromjson()
+    node. The node is left untouched."""
     attrs = None
     value = None
     nsmap = {}
     if '__ATTRS__' in tag_dict:
-        if 'xmlns' in tag_dict['__ATTRS__']:
-            nsmap = {None: tag_dict['__ATTRS__'].pop('xmlns')}
-        attrs = tag_dict.pop('__ATTRS__')
+        attrs = tag_dict['__ATTRS__']
+        if 'xmlns' in attrs:
+            nsmap = {None: attrs['xmlns']}
+            attrs = dict((k, v) for k, v in attrs.items() if k != 'xmlns')
     if '__VALUE__' in tag_dict:
-        value = tag_dict.pop('__VALUE__')
+        value = tag_dict['__VALUE__']
     return (attrs, nsmap, value)
 
 
+def _sub_element(parent, tag_name, nsmap, text=None, attrs=None):
+    if nsmap:
+        sub_tag = etree.SubElement(parent, qualified_tag(nsmap[None], tag_name), nsmap=nsmap)
+    else:
+        sub_tag = etree.SubElement(parent, tag_name)
+    _set_element(sub_tag, text, attrs)
+    return sub_tag
+
+
 def recursive_add_element(root, element, nsmap_default={}):
     for ele_k in element:
-        if isinstance(element[ele_k], list):
+        if ele_k in _SPECIAL_KEYS:
+            continue
+        value = element[ele_k]
+        if isinstance(value, list):
             if ele_k == '_':
                 child = root
             else:
-                child = add_element(root, None, ele_k, ns=nsmap_default)
-            for ele_i in element[ele_k]:
+                child = _sub_element(root, ele_k, nsmap_default)
+            for ele_i in value:
                 recursive_add_element(child, ele_i, nsmap_default=nsmap_default)
-        elif isinstance(element[ele_k], dict):
-            attrs, nsmap, value_attr = _check_attrs(element[ele_k])
+        elif isinstance(value, dict):
+            attrs, nsmap, value_attr = _check_attrs(value)
             if value_attr:
-                add_element(root, None, ele_k, text=value_attr, ns=nsmap or nsmap_default, **attrs if attrs else {})
+                _sub_element(root, ele_k, nsmap or nsmap_default, text=value_attr, attrs=attrs)
             else:
-                child = add_element(root, None, ele_k, ns=nsmap or nsmap_default, **attrs if attrs else {})
-                recursive_add_element(child, element[ele_k], nsmap_default=nsmap_default)
+                child = _sub_element(root, ele_k, nsmap or nsmap_default, attrs=attrs)
+                recursive_add_element(child, value, nsmap_default=nsmap_default)
         else:
-            add_element(root, None, ele_k, text=element[ele_k], ns=nsmap_default)
+            _sub_element(root, ele_k, nsmap_default, text=value)
 
 
 def load_fromjson(json_obj, root=None):
@@ -291,7 +789,10 @@ def load_fromjson(json_obj, root=None):
     json_obj : string or DictType
         A JSON string structure or a Python dictionary.
     root : etree element object
-        If None, the first element in the structure will be selected.
+        If None, the first element in the structure will be selected. The
+        element is copied, so it can be reused as the root of many documents.
+
+    The JSON structure is not modified.
 
     Returns
     -------
@@ -318,19 +819,219 @@ def load_fromjson(json_obj, root=None):
     return None
 
 
+def _iter_jsonlines(source):
+    if isinstance(source, six.string_types):
+        with codecs.open(source, 'r', encoding='utf-8') as fp:
+            for line in _iter_jsonlines(fp):
+                yield line
+        return
+    for line in source:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if line:
+            yield json.loads(line, object_pairs_hook=OrderedDict)
+
+
+def iterload_fromjson(source, root=None):
+    """Create ElementTree documents from a JSON-lines source, one document
+    for each line (see load_fromjson() for the JSON structure).
+
+    Lines are read and converted one at a time, so a file with thousands of
+    events is never fully loaded in memory.
+
+    Parameters
+    ----------
+    source: a JSON-lines file name, a file object or any iterable of lines.
+    root: see load_fromjson().
+
+    Returns
+    -------
+    generator of etree ElementTree
+    """
+    for json_obj in _iter_jsonlines(source):
+        yield load_fromjson(json_obj, root=root)
+
+
+def iterdump_fromjson(source, root=None, xml_declaration=True, pretty_print=False):
+    """Like iterload_fromjson(), but yields each document serialized (see
+    dump_tostring()). Each tree is dropped once serialized."""
+    for xml_doc in iterload_fromjson(source, root=root):
+        yield dump_tostring(xml_doc, xml_declaration=xml_declaration, pretty_print=pretty_print)
+
+
+_XMLDSIG_SIGNATURE = '{http://www.w3.org/2000/09/xmldsig#}Signature'
+_PATH_FIRST_INDEX = re.compile(r'\[1\]')
+
+
+class EventTemplate(object):
+    """Precompiled skeleton of an event layout, used to generate many events
+    that share the same structure and differ only in the leaf values.
+
+    The layout is compiled once, from a sample event, and each fill() only
+    copies the skeleton and sets the given values:
+
+        template = EventTemplate('S-2220.xml')
+        evt = template.fill({
+            'evtMonit/@Id': event_id,
+            'evtMonit/ideVinculo/cpfTrab': '12345678901',
+            'evtMonit/exMedOcup/aso/exame[2]/dtExm': '2018-03-20',
+            'evtMonit/ideEvento/nrRecibo': None,
+        })
+
+    Paths are the tag names (without namespace) from the root element, which
+    is not included. Repeated tags are selected by their position, starting
+    at 1 ('exame[2]'; 'exame' is the same as 'exame[1]'), and attributes by
+    '@name'. A None value removes the element (or attribute). The values of
+    the sample are kept for the paths that are not filled and any signature
+    of the sample is dropped.
+
+    Parameters
+    ----------
+    document: the sample event. A XML file name, an ElementTree (or element)
+        or a load_fromjson() structure.
+    """
+
+    def __init__(self, document):
+        if isinstance(document, six.string_types):
+            document = load_fromfile(document)
+        elif isinstance(document, dict):
+            document = load_fromjson(document)
+        if isinstance(document, etree._ElementTree):
+            document = document.getroot()
+        self._skeleton = copy.deepcopy(document)
+        for signature in list(self._skeleton.iter(_XMLDSIG_SIGNATURE)):
+            signature.getparent().remove(signature)
+        self._positions = {}
+        self._compile(self._skeleton, (), '')
+
+    def _compile(self, element, position, path):
+        counts = {}
+        for i, child in enumerate(element):
+            if not isinstance(child.tag, six.string_types):
+                # Comments and processing instructions
+                continue
+            tag_name = etree.QName(child).localname
+            counts[tag_name] = counts.get(tag_name, 0) + 1
+            child_path = '/'.join([path, tag_name]) if path else tag_name
+            if counts[tag_name] > 1:
+                child_path = '{}[{}]'.format(child_path, counts[tag_name])
+            self._positions[child_path] = position + (i,)
+            self._compile(child, position + (i,), child_path)
+
+    @property
+    def paths(self):
+        """The element paths of the layout, in document order."""
+        return sorted(self._positions, key=self._positions.get)
+
+    def _position(self, path):
+        # Aliases ('exame[1]') are resolved on every call: the template is
+        # never changed by fill(), which may run on many threads
+        position = self._positions.get(path)
+        if position is None:
+            position = self._positions.get(_PATH_FIRST_INDEX.sub('', path))
+            if position is None:
+                raise KeyError('Path "{}" not found in the event template'.format(path))
+        return position
+
+    def fill(self, values=None):
+        """Create a new event from the skeleton.
+
+        Parameters
+        ----------
+        values: dictionary of path: value (see EventTemplate).
+
+        Returns
+        -------
+        etree ElementTree
+        """
+        root = copy.deepcopy(self._skeleton)
+        removals = []
+        for path, value in (values or {}).items():
+            path, _, attr = path.partition('@')
+            path = path.rstrip('/')
+            element = root
+            position = self._position(path) if path else ()
+            for i in position:
+                element = element[i]
+            if attr:
+                if value is None:
+                    element.attrib.pop(attr, None)
+                else:
+                    element.set(attr, utils.normalize_text(str(value)))
+            elif value is None:
+                if not position:
+                    raise ValueError('The root element can not be removed')
+                removals.append(position)
+            else:
+                element.text = utils.normalize_text(str(value))
+        # Removing the last elements first, so the other positions still apply
+        for position in sorted(removals, reverse=True):
+            parent = root
+            for i in position[:-1]:
+                parent = parent[i]
+            parent.remove(parent[position[-1]])
+        return etree.ElementTree(root)
+
+
+class Signer(object):
+    """Signs XML documents with one certificate, following the eSocial rules
+    (enveloped RSA-SHA256 signature).
+
+    The private key is loaded once, when the Signer is created, and reused on
+    every signature.
+
+    Parameters
+    ----------
+    cert_data: dict returned by esocial.utils.pkcs12_data(). If it has only the
+        PEM encoded key and certificate (key_str and cert_str), the key is
+        loaded from them.
+    """
+    # signxml (and cryptography) are only imported when the first Signer is created
+    method = 'enveloped'
+    signature_algorithm = 'rsa-sha256'
+    digest_algorithm = 'sha256'
+    c14n_algorithm = 'http://www.w3.org/TR/2001/REC-xml-c14n-20010315'
+
+    def __init__(self, cert_data):
+        self.key = cert_data.get('key')
+        if self.key is None:
+            from cryptography.hazmat.primitives import serialization
+            self.key = serialization.load_pem_private_key(cert_data['key_str'], password=None)
+        self.cert = cert_data['cert_str']
+        self._local = threading.local()
+
+    def _signer(self):
+        # XMLSigner keeps some state while signing, so there is one per thread
+        signer = getattr(self._local, 'signer', None)
+        if signer is None:
+            import signxml
+            method = self.method
+            if isinstance(method, six.string_types):
+                method = getattr(signxml.methods, method)
+            signer = signxml.XMLSigner(
+                method=method,
+                signature_algorithm=self.signature_algorithm,
+                digest_algorithm=self.digest_algorithm,
+                c14n_algorithm=self.c14n_algorithm
+            )
+            self._local.signer = signer
+        return signer
+
+    def sign(self, xml):
+        """Sign a XML document (ElementTree or XML file path), returning a new ElementTree."""
+        if not isinstance(xml, etree._ElementTree):
+            xml = load_fromfile(xml)
+        signed_root = self._signer().sign(xml.getroot(), key=self.key, cert=self.cert)
+        return etree.ElementTree(signed_root)
+
+    def sign_many(self, xmls):
+        """Sign many XML documents, returning a list of ElementTrees."""
+        return [self.sign(xml) for xml in xmls]
+
+
 def sign(xml, cert_data):
-    signer = XMLSigner(
-        method=signxml.methods.enveloped,
-        signature_algorithm='rsa-sha256',
-        digest_algorithm='sha256',
-        c14n_algorithm='http://www.w3.org/TR/2001/REC-xml-c14n-20010315'
-    )
-    xml_root = None
-    if not isinstance(xml, etree._ElementTree):
-        xml = load_fromfile(xml)
-    xml_root = xml.getroot()
-    signed_root = signer.sign(xml_root, key=cert_data['key_str'], cert=cert_data['cert_str'])
-    return etree.ElementTree(signed_root)
+    return Signer(cert_data).sign(xml)
 
 
 def find(element, tagname):
@@ -347,61 +1048,209 @@ def findall(element, tagname):
     return element.findall('.//{{{ns}}}{query}'.format(ns=ns, query=query))
 
 
-def get_status(element, tagname):
+@functools.lru_cache(maxsize=None)
+def local_tag(tag):
+    """The tag name without its namespace ('{namespace}tag_name' -> 'tag_name'), cached."""
+    return tag.rpartition('}')[2]
+
+
+def _children_text(element, skip=None):
+    return dict((local_tag(child.tag), child.text) for child in element if child.tag != skip)
+
+
+def parse_status(element, tagname):
+    """Same as get_status(), returning a dict."""
     ns = element.nsmap[None]
-    status_tag = find(element, tagname)
-    if status_tag is not None:
-        result = DotMap()
-        result.ocorrencias = []
-        for child in status_tag:
-            if child.tag == '{{{ns}}}ocorrencias'.format(ns=ns):
-                for ocur in child:
-                    error = DotMap()
-                    for e in ocur:
-                        error[e.tag.replace('{{{ns}}}'.format(ns=ns), '')] = e.text
-                    result.ocorrencias.append(error)
-            else:
-                result[child.tag.replace('{{{ns}}}'.format(ns=ns), '')] = child.text
-        return result
-    return None
+    status_tag = element.find('.//' + qualified_tag(ns, tagname))
+    if status_tag is None:
+        return None
+    ocorrencias_tag = qualified_tag(ns, 'ocorrencias')
+    result = {'ocorrencias': []}
+    for child in status_tag:
+        if child.tag == ocorrencias_tag:
+            result['ocorrencias'].extend(_children_text(ocur) for ocur in child)
+        else:
+            result[local_tag(child.tag)] = child.text
+    return result
 
 
-def get_receipt(element, tagname):
+def parse_receipt(element, tagname):
+    """Same as get_receipt(), returning a dict."""
     ns = element.nsmap[None]
-    receipt_tag = find(element, tagname)
-    if receipt_tag is not None:
-        result = DotMap()
-        for child in receipt_tag:
-            if child.tag != '{{{ns}}}infoContribuinte'.format(ns=ns):
-                result[child.tag.replace('{{{ns}}}'.format(ns=ns), '')] = child.text
-        return result
-    return None
+    receipt_tag = element.find('.//' + qualified_tag(ns, tagname))
+    if receipt_tag is None:
+        return None
+    return _children_text(receipt_tag, skip=qualified_tag(ns, 'infoContribuinte'))
 
 
-def decode_base_response(response):
-    find_batch_data = './/{{{ns}}}dadosRecepcaoLote'
+def parse_base_response(response):
+    """Same as decode_base_response(), returning plain dicts."""
+    ns = response.nsmap[None]
+    batch_data_tag = response.find('.//' + qualified_tag(ns, 'dadosRecepcaoLote'))
+    return {
+        'status': parse_status(response, 'status'),
+        'lote': None if batch_data_tag is None else _children_text(batch_data_tag),
+    }
+
+
+def parse_response(response):
+    """Decode a webservice response (see decode_response()) into plain dicts
+    and lists, which are much cheaper to build than DotMaps:
+
+        {
+            'status': {'ocorrencias': [...], 'cdResposta': '201', ...},
+            'lote': {'protocoloEnvio': '...', ...},
+            'eventos': [
+                {'id': '...', 'processamento': {...}, 'recibo': {...}},
+                ...
+            ]
+        }
+    """
+    result = parse_base_response(response)
     ns = response.nsmap[None]
-    status_tag = get_status(response, 'status')
-    batch_data_tag = response.find(find_batch_data.format(ns=ns))
-    result = DotMap({'status': status_tag, 'lote': None})
-    if batch_data_tag is not None:
-        result.lote = DotMap()
-        for child in batch_data_tag:
-            result.lote[child.tag.replace('{{{ns}}}'.format(ns=ns), '')] = child.text
+    result['eventos'] = []
+    for evt in response.iterfind('.//' + qualified_tag(ns, 'evento')):
+        event = {'id': evt.get('Id')}
+        # evento/retornoEvento/eSocial
+        for es in evt[0]:
+            event['processamento'] = parse_status(es, 'processamento')
+            event['recibo'] = parse_receipt(es, 'recibo')
+        result['eventos'].append(event)
     return result
 
 
-def decode_response(response):
+def parse_events_ids(response):
+    """Decode the response of the events identifiers webservices
+    (WSClient.get_*_events_ids()):
+
+        {
+            'status': {'ocorrencias': [...], 'cdResposta': '201', ...},
+            'total': total number of events found (qtdeTotEvtsConsulta) or None,
+            'last': date and time of the last event returned (dhUltimoEvtRetornado) or None,
+            'ids': [(event Id, receipt number), ...]
+        }
+    """
     ns = response.nsmap[None]
-    result = decode_base_response(response)
-    event_tags = findall(response, 'evento')
-    if event_tags is not None:
-        result.eventos = []
-        for evt in event_tags:
-            event = DotMap({'id': evt.get('Id')})
-            # evento/retornoEvento/eSocial
-            for es in evt[0]:
-                event.processamento = get_status(es, 'processamento')
-                event.recibo = get_receipt(es, 'recibo')
-            result.eventos.append(event)
+    result = {'status': parse_status(response, 'status'), 'total': None, 'last': None, 'ids': []}
+    ids_tag = response.find('.//' + qualified_tag(ns, 'retornoIdentificadoresEvts'))
+    if ids_tag is not None:
+        total = ids_tag.findtext(qualified_tag(ns, 'qtdeTotEvtsConsulta'))
+        result['total'] = int(total) if total else None
+        result['last'] = ids_tag.findtext(qualified_tag(ns, 'dhUltimoEvtRetornado'))
+        id_tag = qualified_tag(ns, 'id')
+        nr_rec_tag = qualified_tag(ns, 'nrRec')
+        for evt in ids_tag.iterfind('/'.join([qualified_tag(ns, 'identificadoresEvts'), qualified_tag(ns, 'identificadorEvt')])):
+            result['ids'].append((evt.findtext(id_tag), evt.findtext(nr_rec_tag)))
     return result
+
+
+def to_dotmap(result):
+    """Converts the result of a parse_*() function to DotMap (None stays None)."""
+    if result is None:
+        return None
+    from dotmap import DotMap
+    return DotMap(result)
+
+
+def get_status(element, tagname):
+    return to_dotmap(parse_status(element, tagname))
+
+
+def get_receipt(element, tagname):
+    return to_dotmap(parse_receipt(element, tagname))
+
+
+def decode_base_response(response):
+    return to_dotmap(parse_base_response(response))
+
+
+def decode_response(response):
+    return to_dotmap(parse_response(response))
+
+
+class DownloadResponse(object):
+    """Streaming decoder of the download webservices responses
+    (SolicitarDownloadEventosPorId / SolicitarDownloadEventosPorNrRecibo).
+
+    The response (the SOAP message or just its eSocial document) is parsed
+    incrementally, yielding one downloaded file (arquivo) at a time and
+    discarding it from the parsed tree, so responses with many full events
+    are decoded with bounded memory:
+
+        download = DownloadResponse(content, path='/var/lib/esocial/eventos')
+        for arquivo in download:
+            print(arquivo['id'], arquivo['status']['cdResposta'], arquivo['evento'])
+        print(download.status)
+
+    Each arquivo is a dict:
+        {
+            'status': {'cdResposta': '201', 'descResposta': '...'},
+            'id': the event Id (None if the event was not found),
+            'nrRecibo': the receipt number (None if there is no receipt),
+            'evento': ElementTree of the event (or the file path, see `path`),
+            'recibo': ElementTree of the receipt (or the file path, see `path`),
+        }
+
+    Parameters
+    ----------
+    source: the response as bytes, a file-like object or a file path.
+    path: if given, each event is written to `path`/<id>.xml and its receipt
+        to `path`/<id>.recibo.xml, and 'evento'/'recibo' are the file paths.
+
+    The `status` attribute has the status of the whole request (see
+    parse_status()), available once the iteration has started.
+    """
+    def __init__(self, source, path=None):
+        self.source = source
+        self.path = path
+        self.status = None
+
+    def _content(self, element, file_name):
+        # The event (or receipt) root element is the only child of evt (or rec)
+        if element is None or len(element) == 0:
+            return None
+        if self.path is None:
+            return etree.ElementTree(copy.deepcopy(element[0]))
+        file_path = os.path.join(self.path, file_name)
+        with open(file_path, 'wb') as fp:
+            fp.write(etree.tostring(element[0], xml_declaration=True, encoding='UTF-8'))
+        return file_path
+
+    def _arquivo(self, element):
+        status = evt = rec = None
+        for child in element:
+            tag = local_tag(child.tag)
+            if tag == 'status':
+                status = _children_text(child)
+            elif tag == 'evt':
+                evt = child
+            elif tag == 'rec':
+                rec = child
+        event_id = evt.get('Id') if evt is not None else None
+        nr_recibo = rec.get('nrRec') if rec is not None else None
+        file_id = event_id or nr_recibo
+        return {
+            'status': status,
+            'id': event_id,
+            'nrRecibo': nr_recibo,
+            'evento': self._content(evt, '{}.xml'.format(file_id)),
+            'recibo': self._content(rec, '{}.recibo.xml'.format(file_id)),
+        }
+
+    def __iter__(self):
+        source = self.source
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
+        if self.path is not None and not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for action, element in etree.iterparse(source, events=('end',), tag=('{*}status', '{*}arquivo')):
+            if local_tag(element.tag) == 'status':
+                parent = element.getparent()
+                if parent is not None and local_tag(parent.tag) == 'download':
+                    self.status = parse_status(parent, 'status')
+                continue
+            yield self._arquivo(element)
+            # Dropping the processed files from the tree
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
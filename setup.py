@@ -16,6 +16,10 @@ install_requires = [
     'six>=1.11.0',
 ]
 
+extras_require = {
+    'async': ['httpx>=0.15.0'],
+}
+
 
 def read_file(*parts):
     with open(os.path.join(here, *parts), 'r', encoding='utf-8') as fp:
@@ -43,6 +47,7 @@ setup(
     packages=find_packages(exclude=['contrib', 'docs']),
     include_package_data=True,
     install_requires=install_requires,
+    extras_require=extras_require,
     zip_safe=False,
     classifiers=[
         'Development Status :: 3 - Alpha',